@@ -57,21 +57,32 @@ CREATE TABLE IF NOT EXISTS raw_files (
 CREATE TABLE IF NOT EXISTS stacking_jobs (
     id                INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
     user_id           INT UNSIGNED NOT NULL,
-    upload_session_id INT UNSIGNED NOT NULL,
-    chunk_key         VARCHAR(32) NOT NULL,
+    job_type          ENUM('chunk','deep','lightcurve') NOT NULL DEFAULT 'chunk',
+    upload_session_id INT UNSIGNED NULL,
+    chunk_key         VARCHAR(32) NULL,
+    deep_stack_id     INT UNSIGNED NULL,
+    light_curve_id    INT UNSIGNED NULL,
     object_name       VARCHAR(255) NULL,
     pointing_key      VARCHAR(32) NULL,
     frame_count       INT UNSIGNED NOT NULL DEFAULT 0,
     status            ENUM('pending','processing','completed','failed','retry') NOT NULL DEFAULT 'pending',
     worker_id         VARCHAR(64) NULL,
     started_at        DATETIME NULL,
+    lease_expires_at  DATETIME NULL,
+    heartbeat_at      DATETIME NULL,
+    progress_stage    VARCHAR(32) NULL,
+    progress_done     INT UNSIGNED NULL,
+    progress_total    INT UNSIGNED NULL,
     completed_at      DATETIME NULL,
     error_message     TEXT NULL,
     retry_count       TINYINT UNSIGNED NOT NULL DEFAULT 0,
     created_at        DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (upload_session_id) REFERENCES upload_sessions(id) ON DELETE CASCADE,
-    INDEX idx_status (status, created_at)
+    INDEX idx_status (status, created_at),
+    INDEX idx_deep (deep_stack_id, status),
+    INDEX idx_lightcurve (light_curve_id, status),
+    INDEX idx_lease (status, lease_expires_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 CREATE TABLE IF NOT EXISTS stacked_frames (
@@ -80,8 +91,11 @@ CREATE TABLE IF NOT EXISTS stacked_frames (
     user_id           INT UNSIGNED NOT NULL,
     object_name       VARCHAR(255) NULL,
     chunk_key         VARCHAR(32) NOT NULL,
+    cadence_min       TINYINT UNSIGNED NOT NULL DEFAULT 15,
+    slot_index        TINYINT UNSIGNED NOT NULL DEFAULT 0,
     ucloud_path       VARCHAR(512) NOT NULL,
     thumbnail_path    VARCHAR(512) NULL,
+    catalog_path      VARCHAR(512) NULL,
     n_frames_input    INT UNSIGNED NOT NULL,
     n_frames_aligned  INT UNSIGNED NOT NULL,
     total_exptime     FLOAT NULL,
@@ -91,9 +105,68 @@ CREATE TABLE IF NOT EXISTS stacked_frames (
     dec_deg           DOUBLE NULL,
     file_size_bytes   BIGINT UNSIGNED NOT NULL DEFAULT 0,
     n_stars_detected  INT UNSIGNED NULL,
+    compression       VARCHAR(32) NULL,
+    uncompressed_bytes BIGINT UNSIGNED NULL,
+    upload_seconds    FLOAT NULL,
     created_at        DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (stacking_job_id) REFERENCES stacking_jobs(id) ON DELETE CASCADE,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-    INDEX idx_user_object (user_id, object_name),
+    INDEX idx_user_object (user_id, object_name, date_obs_start),
     INDEX idx_user_date (user_id, date_obs_start)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS deep_stacks (
+    id                INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    user_id           INT UNSIGNED NOT NULL,
+    object_name       VARCHAR(255) NULL,
+    pointing_key      VARCHAR(32) NOT NULL,
+    ucloud_path       VARCHAR(512) NULL,
+    state_path        VARCHAR(512) NULL,
+    thumbnail_path    VARCHAR(512) NULL,
+    n_stacks          INT UNSIGNED NOT NULL DEFAULT 0,
+    n_frames          INT UNSIGNED NOT NULL DEFAULT 0,
+    total_exptime     FLOAT NULL,
+    date_obs_start    DATETIME NULL,
+    date_obs_end      DATETIME NULL,
+    ra_deg            DOUBLE NULL,
+    dec_deg           DOUBLE NULL,
+    file_size_bytes   BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    n_stars_detected  INT UNSIGNED NULL,
+    compression       VARCHAR(32) NULL,
+    created_at        DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at        DATETIME NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    UNIQUE KEY uniq_user_pointing (user_id, pointing_key)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS deep_stack_members (
+    deep_stack_id     INT UNSIGNED NOT NULL,
+    stacked_frame_id  INT UNSIGNED NOT NULL,
+    PRIMARY KEY (deep_stack_id, stacked_frame_id),
+    FOREIGN KEY (deep_stack_id) REFERENCES deep_stacks(id) ON DELETE CASCADE,
+    FOREIGN KEY (stacked_frame_id) REFERENCES stacked_frames(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS light_curves (
+    id                INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    user_id           INT UNSIGNED NOT NULL,
+    object_name       VARCHAR(255) NULL,
+    pointing_key      VARCHAR(32) NOT NULL,
+    store_path        VARCHAR(512) NULL,
+    n_sources         INT UNSIGNED NOT NULL DEFAULT 0,
+    n_epochs          INT UNSIGNED NOT NULL DEFAULT 0,
+    n_points          BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    file_size_bytes   BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    created_at        DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at        DATETIME NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    UNIQUE KEY uniq_user_pointing (user_id, pointing_key)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS light_curve_members (
+    light_curve_id    INT UNSIGNED NOT NULL,
+    stacked_frame_id  INT UNSIGNED NOT NULL,
+    PRIMARY KEY (light_curve_id, stacked_frame_id),
+    FOREIGN KEY (light_curve_id) REFERENCES light_curves(id) ON DELETE CASCADE,
+    FOREIGN KEY (stacked_frame_id) REFERENCES stacked_frames(id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -1,47 +1,145 @@
 """
 Upload files to UCloud WebDAV share
+
+Files are uploaded concurrently over one keep-alive session, retried on
+transient errors and verified by size afterwards. With a Nextcloud user
+account (--uploads-url/--files-url/--user/--password) large files are sent in
+parallel chunks and resume where they stopped if the upload is run again.
+
+With --ingest, a Seestar night folder (and its subfolders) is uploaded as
+frames grouped by chunk key: only each frame's header blocks are read, chunk
+keys are computed as fits_utils.php does, and a state file in the folder
+remembers what was sent, so re-running an unchanged night does no I/O beyond
+listing the folder.
 """
 
+import argparse
+import json
 import os
-import requests
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from worker.chunked_upload import UploadReport, put_file, sha1_file, upload_chunked
 
 
 # UCloud configuration
-UCLOUD_WEBDAV_URL = "https://ucloud.univie.ac.at/public.php/webdav"
-UCLOUD_SHARE_TOKEN = "P3GxzHdXDixNLeW"
+UCLOUD_WEBDAV_URL = os.environ.get("UCLOUD_WEBDAV_URL", "https://ucloud.univie.ac.at/public.php/webdav")
+UCLOUD_SHARE_TOKEN = os.environ.get("UCLOUD_SHARE_TOKEN", "P3GxzHdXDixNLeW")
+
+# Chunked uploads need a user account; leave empty to upload through the share only
+UCLOUD_UPLOADS_URL = os.environ.get("UCLOUD_UPLOADS_URL", "")
+UCLOUD_FILES_URL = os.environ.get("UCLOUD_FILES_URL", "")
+UCLOUD_USER = os.environ.get("UCLOUD_USER", "")
+UCLOUD_APP_PASSWORD = os.environ.get("UCLOUD_APP_PASSWORD", "")
+
+PARALLEL = 4
+CHUNK_SIZE_MB = 10
+
+# Ingest: frame extensions (ALLOWED_EXTENSIONS in config.php), state file kept
+# in the night folder, threads reading headers and hashing, and how often the
+# state is saved while uploading [s]
+FITS_EXTENSIONS = (".fit", ".fits")
+INGEST_STATE = ".crowdsky_ingest.json"
+SCAN_THREADS = 8
+STATE_SAVE_INTERVAL = 5.0
+
+# Header keywords kept per frame (as parseFitsHeader in fits_utils.php)
+HEADER_KEYWORDS = ("DATE-OBS", "OBJECT", "EXPTIME", "RA", "DEC")
+FITS_BLOCK = 2880
+FITS_MAGIC = b"SIMPLE  =                    T"
+MAX_HEADER_BLOCKS = 10
+
+
+def _session(auth, pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.auth = auth
+    return session
+
+
+def _mkcol(session: requests.Session, url: str) -> bool:
+    """Create a remote folder. Returns True if it was created, False if it existed."""
+    response = session.request("MKCOL", url)
+    if response.status_code == 405:
+        return False
+    response.raise_for_status()
+    return True
+
+
+def _uploader(parallel: int, chunk_size_mb: int) -> Tuple[requests.Session, Callable[[Path, str], UploadReport]]:
+    """
+    The share session and ``upload(file_path, remote_path)``, which sends one
+    file to ``remote_path`` (relative to the share), chunked above
+    ``chunk_size_mb`` if chunking is configured.
+    """
+    # WebDAV authentication (token as username, empty password)
+    session = _session((UCLOUD_SHARE_TOKEN, ""), parallel)
+    chunk_session = None
+    if UCLOUD_UPLOADS_URL:
+        chunk_session = _session((UCLOUD_USER, UCLOUD_APP_PASSWORD), parallel * parallel)
+
+    def upload(file_path: Path, remote_path: str) -> UploadReport:
+        size = file_path.stat().st_size
+        if chunk_session is not None and size > chunk_size_mb * 1024 * 1024:
+            return upload_chunked(
+                chunk_session,
+                UCLOUD_UPLOADS_URL,
+                f"{UCLOUD_FILES_URL}/{remote_path}",
+                file_path,
+                chunk_size=chunk_size_mb * 1024 * 1024,
+                parallel=parallel,
+            )
+        return put_file(session, f"{UCLOUD_WEBDAV_URL}/{remote_path}", file_path)
+
+    return session, upload
 
 
-def upload_folder(local_folder: str, remote_folder: Optional[str] = None) -> None:
+def upload_folder(
+    local_folder: str,
+    remote_folder: Optional[str] = None,
+    parallel: int = PARALLEL,
+    chunk_size_mb: int = CHUNK_SIZE_MB,
+) -> None:
     """
     Upload a local folder to UCloud WebDAV share.
-    
+
     Args:
         local_folder: Path to local folder to upload
         remote_folder: Name for remote folder (defaults to local folder name)
+        parallel: Files uploaded at once (and chunks per file when chunking)
+        chunk_size_mb: Files above this size are chunked, if chunking is configured
     """
     local_path = Path(local_folder)
-    
+
     if not local_path.exists():
         raise FileNotFoundError(f"Local folder not found: {local_folder}")
-    
+
     if not local_path.is_dir():
         raise ValueError(f"Path is not a directory: {local_folder}")
-    
+
     # Use local folder name if remote name not specified
     if remote_folder is None:
         remote_folder = local_path.name
-    
-    # WebDAV authentication (token as username, empty password)
-    auth = (UCLOUD_SHARE_TOKEN, "")
-    
+
+    session, upload = _uploader(parallel, chunk_size_mb)
+
     # Create remote folder
     folder_url = f"{UCLOUD_WEBDAV_URL}/{remote_folder}"
     print(f"📁 Creating remote folder: {remote_folder}")
-    
+
     try:
-        response = requests.request("MKCOL", folder_url, auth=auth)
+        response = session.request("MKCOL", folder_url)
         if response.status_code == 201:
             print(f"✓ Folder created")
         elif response.status_code == 405:
@@ -51,84 +149,329 @@ def upload_folder(local_folder: str, remote_folder: Optional[str] = None) -> Non
     except requests.exceptions.RequestException as e:
         print(f"❌ Failed to create folder: {e}")
         raise
-    
+
     # Get all files in local folder
     files = [f for f in local_path.iterdir() if f.is_file()]
     total_files = len(files)
     total_size = sum(f.stat().st_size for f in files)
-    
-    print(f"📤 Uploading {total_files} files ({total_size / 1024 / 1024:.1f} MB)...")
-    
-    # Upload each file
+
+    print(f"📤 Uploading {total_files} files ({total_size / 1024 / 1024:.1f} MB), {parallel} at a time...")
+
     uploaded = 0
     failed = 0
-    
-    for idx, file_path in enumerate(files, 1):
-        file_url = f"{UCLOUD_WEBDAV_URL}/{remote_folder}/{file_path.name}"
-        file_size_mb = file_path.stat().st_size / 1024 / 1024
-        
-        print(f"  [{idx}/{total_files}] {file_path.name} ({file_size_mb:.2f} MB)", end="", flush=True)
-        
-        try:
-            with open(file_path, "rb") as f:
-                response = requests.put(file_url, data=f, auth=auth)
-            
-            if response.status_code in (200, 201, 204):
-                print(" ✓")
-                uploaded += 1
-            else:
-                print(f" ❌ (HTTP {response.status_code})")
-                failed += 1
-        except Exception as e:
-            print(f" ❌ ({e})")
-            failed += 1
-    
+    uploaded_bytes = 0
+    print_lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        futures = {pool.submit(upload, f, f"{remote_folder}/{f.name}"): f for f in files}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            file_size_mb = file_path.stat().st_size / 1024 / 1024
+            with print_lock:
+                done = uploaded + failed + 1
+                try:
+                    report = future.result()
+                    resumed = f", {report.n_chunks_resumed} chunks resumed" if report.n_chunks_resumed else ""
+                    print(f"  [{done}/{total_files}] {file_path.name} ({file_size_mb:.2f} MB) ✓{resumed}")
+                    uploaded += 1
+                    uploaded_bytes += report.n_bytes
+                except Exception as e:
+                    print(f"  [{done}/{total_files}] {file_path.name} ({file_size_mb:.2f} MB) ❌ ({e})")
+                    failed += 1
+
     print(f"\n{'='*60}")
     print(f"✓ Upload complete: {uploaded} succeeded, {failed} failed")
-    print(f"📊 Total uploaded: {sum(f.stat().st_size for f in files[:uploaded]) / 1024 / 1024:.1f} MB")
-    
+    print(f"📊 Total uploaded: {uploaded_bytes / 1024 / 1024:.1f} MB")
+
+
+def read_fits_header(path: Path) -> Optional[dict]:
+    """
+    HEADER_KEYWORDS from a FITS file's primary header, reading only its
+    2880-byte header blocks (as parseFitsHeader in fits_utils.php: string
+    values unquoted, numbers as float). Returns None if it is not a FITS file.
+    """
+    values = dict.fromkeys(HEADER_KEYWORDS)
+    with open(path, "rb") as f:
+        if f.read(len(FITS_MAGIC)) != FITS_MAGIC:
+            return None
+        f.seek(0)
+        for _ in range(MAX_HEADER_BLOCKS):
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                break
+            for i in range(0, FITS_BLOCK, 80):
+                card = block[i:i + 80].decode("ascii", "replace")
+                key = card[:8].strip()
+                if key == "END":
+                    return values
+                if key not in values:
+                    continue
+                value = card[10:]
+                if value.startswith("'"):
+                    end = value.find("'", 1)
+                    if end != -1:
+                        values[key] = value[1:end].strip()
+                    continue
+                value = value.split("/", 1)[0].strip()
+                try:
+                    values[key] = float(value)
+                except ValueError:
+                    values[key] = value
+    return values
+
+
+def _round1(value: float) -> Decimal:
+    """``round($value, 1)`` as PHP does it (half away from zero, on the shortest repr)."""
+    return Decimal(repr(value)).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP)
+
+
+def chunk_key(date_obs: Optional[str], ra=None, dec=None) -> Optional[str]:
+    """
+    Chunk key of a frame, as computeChunkKey in fits_utils.php:
+    ``YYYYMMDD.CC_RRR.R_sDD.D`` with CC the 15-min slot of the UTC day.
+    None if DATE-OBS is missing or unparseable.
+    """
+    if not date_obs or not isinstance(date_obs, str):
+        return None
+    try:
+        t = datetime.fromisoformat(date_obs.strip())
+    except ValueError:
+        return None
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc)
+    key = f"{t:%Y%m%d}.{(t.hour * 3600 + t.minute * 60 + t.second) // 900:02d}"
+    if isinstance(ra, float) and isinstance(dec, float):
+        sign = "+" if dec >= 0 else "-"
+        key += f"_{_round1(ra):.1f}_{sign}{abs(_round1(dec)):.1f}"
+    return key
+
+
+def _scan_frame(path: Path, rel: str, previous: Optional[dict]) -> Optional[dict]:
+    """
+    State entry of a frame: reused from ``previous`` if size and mtime are
+    unchanged, otherwise from its header and content hash. None if the file
+    is not a FITS file.
+    """
+    st = path.stat()
+    if previous and previous["size"] == st.st_size and previous["mtime_ns"] == st.st_mtime_ns:
+        return previous
+    header = read_fits_header(path)
+    if header is None:
+        return None
+    return {
+        "path": rel,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha1": sha1_file(path),
+        "header": header,
+        "chunk_key": chunk_key(header["DATE-OBS"], header["RA"], header["DEC"]),
+        "remote": None,
+        "uploaded": False,
+    }
+
+
+def _save_state(state_path: Path, state: dict) -> None:
+    tmp = state_path.with_name(state_path.name + ".tmp")
+    tmp.write_text(json.dumps(state, indent=1))
+    os.replace(tmp, state_path)
+
+
+def ingest_folder(
+    local_folder: str,
+    remote_folder: Optional[str] = None,
+    parallel: int = PARALLEL,
+    chunk_size_mb: int = CHUNK_SIZE_MB,
+    state_path: Optional[str] = None,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """
+    Upload a Seestar night folder to the share, grouped by chunk key.
+
+    Frames (``.fit``/``.fits`` in the folder and its subfolders) go to
+    ``{remote_folder}/{chunk_key}/{name}`` (``unknown`` without DATE-OBS),
+    with a ``manifest.json`` of every frame's header values, chunk key and
+    SHA-1 next to them. The state file (INGEST_STATE in the folder by
+    default) records each frame's size, mtime, hash, header and whether it
+    was uploaded, and is saved as uploads finish, so:
+
+    - frames whose size and mtime are unchanged are not read again
+    - frames already uploaded are skipped, as are frames whose content
+      (SHA-1) was already uploaded or is queued under another name
+    - an interrupted run resumes with the frames still missing
+
+    Args:
+        local_folder: Night folder to ingest
+        remote_folder: Name for remote folder (defaults to local folder name)
+        parallel: Files uploaded at once (and chunks per file when chunking)
+        chunk_size_mb: Files above this size are chunked, if chunking is configured
+        state_path: State file (defaults to INGEST_STATE in ``local_folder``)
+        dry_run: Scan and report the chunks without uploading
+
+    Returns:
+        Counts of frames ``uploaded``, ``failed``, ``skipped`` (already
+        uploaded), ``duplicates`` and ``ignored`` (not FITS).
+    """
+    local_path = Path(local_folder)
+    if not local_path.is_dir():
+        raise FileNotFoundError(f"Local folder not found: {local_folder}")
+    if remote_folder is None:
+        remote_folder = local_path.name
+    state_file = Path(state_path) if state_path else local_path / INGEST_STATE
+
+    state = {"remote_folder": remote_folder, "folders": [], "frames": {}}
+    if state_file.exists():
+        state = json.loads(state_file.read_text())
+        if state.get("remote_folder") != remote_folder:
+            # A different destination: everything has to go there again
+            for entry in state["frames"].values():
+                entry["uploaded"] = False
+            state.update(remote_folder=remote_folder, folders=[])
+
+    # Scan: stat every frame; read headers and hash only new or changed ones
+    start = time.monotonic()
+    paths = sorted(
+        p for p in local_path.rglob("*")
+        if p.suffix.lower() in FITS_EXTENSIONS and p.is_file()
+    )
+    rels = [p.relative_to(local_path).as_posix() for p in paths]
+    with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+        entries = list(pool.map(
+            lambda p, rel: _scan_frame(p, rel, state["frames"].get(rel)), paths, rels,
+        ))
+    frames = {rel: e for rel, e in zip(rels, entries) if e is not None}
+    ignored = len(paths) - len(frames)
+    state["frames"] = frames
+
+    # Destinations, and what is left to send
+    uploaded_hashes = {e["sha1"] for e in frames.values() if e["uploaded"]}
+    taken = {e["remote"]: e["sha1"] for e in frames.values() if e["uploaded"]}
+    todo: List[dict] = []
+    duplicates = 0
+    for entry in frames.values():
+        if entry["uploaded"]:
+            continue
+        if entry["sha1"] in uploaded_hashes:
+            duplicates += 1
+            continue
+        name = Path(entry["path"]).name
+        remote = f"{remote_folder}/{entry['chunk_key'] or 'unknown'}/{name}"
+        if taken.get(remote, entry["sha1"]) != entry["sha1"]:
+            # Same file name in two subfolders
+            remote = f"{remote_folder}/{entry['chunk_key'] or 'unknown'}/{entry['sha1'][:8]}_{name}"
+        entry["remote"] = remote
+        taken[remote] = entry["sha1"]
+        uploaded_hashes.add(entry["sha1"])
+        todo.append(entry)
+
+    skipped = len(frames) - len(todo) - duplicates
+    chunks = Counter(e["chunk_key"] or "unknown" for e in frames.values())
+    todo_bytes = sum(e["size"] for e in todo)
+    print(
+        f"🔍 {len(frames)} frames in {len(chunks)} chunks scanned in {time.monotonic() - start:.1f}s: "
+        f"{len(todo)} to upload ({todo_bytes / 1024 / 1024:.1f} MB), {skipped} already uploaded, "
+        f"{duplicates} duplicates, {ignored} not FITS"
+    )
+    counts = {"uploaded": 0, "failed": 0, "skipped": skipped, "duplicates": duplicates, "ignored": ignored}
+    if dry_run:
+        for key, n in sorted(chunks.items()):
+            print(f"  {key}: {n} frames")
+        return counts
+    if not todo:
+        _save_state(state_file, state)
+        return counts
+
+    session, upload = _uploader(parallel, chunk_size_mb)
+    for folder in sorted({remote_folder} | {e["remote"].rsplit("/", 1)[0] for e in todo}):
+        if folder not in state["folders"]:
+            _mkcol(session, f"{UCLOUD_WEBDAV_URL}/{folder}")
+            state["folders"].append(folder)
+
+    print(f"📤 Uploading {len(todo)} frames, {parallel} at a time...")
+    lock = threading.Lock()
+    last_save = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            futures = {pool.submit(upload, local_path / e["path"], e["remote"]): e for e in todo}
+            for future in as_completed(futures):
+                entry = futures[future]
+                with lock:
+                    done = counts["uploaded"] + counts["failed"] + 1
+                    try:
+                        future.result()
+                        entry["uploaded"] = True
+                        counts["uploaded"] += 1
+                        print(f"  [{done}/{len(todo)}] {entry['remote']} ✓")
+                    except Exception as e:
+                        counts["failed"] += 1
+                        print(f"  [{done}/{len(todo)}] {entry['remote']} ❌ ({e})")
+                    if time.monotonic() - last_save > STATE_SAVE_INTERVAL:
+                        _save_state(state_file, state)
+                        last_save = time.monotonic()
+    finally:
+        _save_state(state_file, state)
+
+    manifest = [
+        {k: e[k] for k in ("remote", "chunk_key", "sha1", "size", "header")}
+        for e in frames.values() if e["uploaded"]
+    ]
+    response = session.put(
+        f"{UCLOUD_WEBDAV_URL}/{remote_folder}/manifest.json",
+        data=json.dumps(manifest, indent=1).encode(), timeout=300,
+    )
+    response.raise_for_status()
+
+    print(f"\n{'='*60}")
+    print(f"✓ Ingest complete: {counts['uploaded']} uploaded, {counts['failed']} failed "
+          f"(run again to retry), {skipped} already uploaded, {duplicates} duplicates")
+    return counts
+
 
 def upload_file(local_file: str, remote_path: str) -> bool:
     """
     Upload a single file to UCloud WebDAV share.
-    
+
     Args:
         local_file: Path to local file
         remote_path: Remote path (e.g., "folder/file.fits")
-    
+
     Returns:
         True if successful, False otherwise
     """
     local_path = Path(local_file)
-    
+
     if not local_path.exists():
         raise FileNotFoundError(f"Local file not found: {local_file}")
-    
-    auth = (UCLOUD_SHARE_TOKEN, "")
+
+    session = _session((UCLOUD_SHARE_TOKEN, ""), 1)
     file_url = f"{UCLOUD_WEBDAV_URL}/{remote_path}"
-    
+
     try:
-        with open(local_path, "rb") as f:
-            response = requests.put(file_url, data=f, auth=auth)
-        
-        return response.status_code in (200, 201, 204)
+        put_file(session, file_url, local_path)
+        return True
     except Exception as e:
         print(f"❌ Upload failed: {e}")
         return False
 
 
-# Example usage
 if __name__ == "__main__":
-    import sys
-    
-    if len(sys.argv) < 2:
-        print("Usage: python upload.py <folder_path> [remote_folder_name]")
-        print("\nExamples:")
-        print("  python ucloud_upload.py ./Corot_1_sub")
-        print("  python ucloud_upload.py ./Corot_1_sub CustomFolderName")
-        sys.exit(1)
-    
-    local_folder = sys.argv[1]
-    remote_folder = sys.argv[2] if len(sys.argv) > 2 else None
-    
-    upload_folder(local_folder, remote_folder)
+    parser = argparse.ArgumentParser(
+        description="Upload a folder to the UCloud WebDAV share",
+        epilog="Example: python upload.py ./Corot_1_sub CustomFolderName",
+    )
+    parser.add_argument("folder_path")
+    parser.add_argument("remote_folder_name", nargs="?")
+    parser.add_argument("--parallel", type=int, default=PARALLEL,
+                        help="Files uploaded at once (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE_MB,
+                        help="Chunk size in MB for chunked uploads (default: %(default)s)")
+    parser.add_argument("--ingest", action="store_true",
+                        help="Upload a night folder grouped by chunk key, skipping frames already sent")
+    parser.add_argument("--state", help=f"Ingest state file (default: FOLDER/{INGEST_STATE})")
+    parser.add_argument("--dry-run", action="store_true", help="With --ingest: scan and list chunks only")
+    args = parser.parse_args()
+
+    if args.ingest:
+        ingest_folder(args.folder_path, args.remote_folder_name, args.parallel, args.chunk_size,
+                      args.state, args.dry_run)
+    else:
+        upload_folder(args.folder_path, args.remote_folder_name, args.parallel, args.chunk_size)
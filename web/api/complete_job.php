@@ -8,11 +8,38 @@
  * POST body (JSON):
  *   job_id, ucloud_path, thumbnail_path, n_frames_input, n_frames_aligned,
  *   total_exptime, date_obs_start, date_obs_end, ra_deg, dec_deg,
- *   file_size_bytes, n_stars_detected
+ *   file_size_bytes, n_stars_detected, [cadence_min, slot_index],
+ *   [compression, uncompressed_bytes, upload_s], [catalog_path], [worker_id],
+ *   [products: [{cadence_min, slot_index, ucloud_path, ...same fields}, ...]]
+ *
+ * The top-level fields describe the chunk stack (15 min). Finer-cadence
+ * stacks made in the same pass come in `products`; every stack becomes its
+ * own stacked_frames row. file_size_bytes is the size as stored (after
+ * compression); uncompressed_bytes is the size before. For owners in a
+ * TIER_DEEP tier, a deep job for the chunk's pointing is queued as well, and
+ * for TIER_LIGHTCURVES tiers a light-curve job.
+ *
+ * Deep jobs (job_type 'deep') send the co-add instead: ucloud_path,
+ * thumbnail_path, state_path, n_stacks, n_frames_aligned, total_exptime,
+ * dates, ra_deg, dec_deg, file_size_bytes, n_stars_detected, compression,
+ * and members (the stacked_frames ids the job folded in or left out). The
+ * deep_stacks row is updated; no raws are involved. A deep job whose stacks
+ * could not start a new co-add sends only members, and the row is left as is.
+ *
+ * Light-curve jobs (job_type 'lightcurve') send the store: store_path,
+ * file_size_bytes, n_sources, n_epochs, n_points and members (the
+ * stacked_frames ids whose catalogs the job matched in or left out).
+ *
+ * With worker_id, the job must still be leased to that worker (409 otherwise,
+ * e.g. after its lease expired and another worker claimed it).
  */
 
 require_once __DIR__ . '/../config.php';
 require_once __DIR__ . '/../db.php';
+require_once __DIR__ . '/../deep_stacks.php';
+require_once __DIR__ . '/../job_leases.php';
+require_once __DIR__ . '/../light_curves.php';
+require_once __DIR__ . '/../job_signal.php';
 
 header('Content-Type: application/json');
 
@@ -57,38 +84,65 @@ if (!$job) {
     exit;
 }
 
+if (!leaseHeldBy($job, $input)) {
+    http_response_code(409);
+    echo json_encode(['error' => 'Job is leased to another worker.']);
+    exit;
+}
+
+if ($job['job_type'] === 'deep') {
+    completeDeepJob($db, $job, $input);
+    exit;
+}
+
+if ($job['job_type'] === 'lightcurve') {
+    completeLightCurveJob($db, $job, $input);
+    exit;
+}
+
 $db->beginTransaction();
 
 try {
-    // Insert stacked_frames row
+    // Insert one stacked_frames row per product (chunk stack first)
     $stmt = $db->prepare(
         'INSERT INTO stacked_frames
-            (stacking_job_id, user_id, object_name, chunk_key, ucloud_path, thumbnail_path,
+            (stacking_job_id, user_id, object_name, chunk_key, cadence_min, slot_index,
+             ucloud_path, thumbnail_path, catalog_path,
              n_frames_input, n_frames_aligned, total_exptime, date_obs_start, date_obs_end,
-             ra_deg, dec_deg, file_size_bytes, n_stars_detected)
-         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+             ra_deg, dec_deg, file_size_bytes, n_stars_detected,
+             compression, uncompressed_bytes, upload_seconds)
+         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
     );
-    $stmt->execute([
-        $jobId,
-        $job['user_id'],
-        $job['object_name'],
-        $job['chunk_key'],
-        $input['ucloud_path'] ?? '',
-        $input['thumbnail_path'] ?? null,
-        (int)($input['n_frames_input'] ?? $job['frame_count']),
-        (int)($input['n_frames_aligned'] ?? 0),
-        $input['total_exptime'] ?? null,
-        $input['date_obs_start'] ?? null,
-        $input['date_obs_end'] ?? null,
-        $input['ra_deg'] ?? null,
-        $input['dec_deg'] ?? null,
-        (int)($input['file_size_bytes'] ?? 0),
-        isset($input['n_stars_detected']) ? (int)$input['n_stars_detected'] : null,
-    ]);
+    $products = array_merge([$input], is_array($input['products'] ?? null) ? $input['products'] : []);
+    foreach ($products as $product) {
+        $stmt->execute([
+            $jobId,
+            $job['user_id'],
+            $job['object_name'],
+            $job['chunk_key'],
+            (int)($product['cadence_min'] ?? 15),
+            (int)($product['slot_index'] ?? 0),
+            $product['ucloud_path'] ?? '',
+            $product['thumbnail_path'] ?? null,
+            $product['catalog_path'] ?? null,
+            (int)($product['n_frames_input'] ?? $job['frame_count']),
+            (int)($product['n_frames_aligned'] ?? 0),
+            $product['total_exptime'] ?? null,
+            $product['date_obs_start'] ?? null,
+            $product['date_obs_end'] ?? null,
+            $product['ra_deg'] ?? null,
+            $product['dec_deg'] ?? null,
+            (int)($product['file_size_bytes'] ?? 0),
+            isset($product['n_stars_detected']) ? (int)$product['n_stars_detected'] : null,
+            $product['compression'] ?? null,
+            isset($product['uncompressed_bytes']) ? (int)$product['uncompressed_bytes'] : null,
+            $product['upload_s'] ?? null,
+        ]);
+    }
 
     // Mark job completed
     $db->prepare(
-        'UPDATE stacking_jobs SET status = ?, completed_at = NOW() WHERE id = ?'
+        'UPDATE stacking_jobs SET status = ?, completed_at = NOW(), lease_expires_at = NULL WHERE id = ?'
     )->execute(['completed', $jobId]);
 
     // Delete local raw files from webspace disk and mark as deleted in DB
@@ -127,7 +181,23 @@ try {
         }
     }
 
+    // Fold the new stack into the owner's deep co-add of this pointing
+    $tierStmt = $db->prepare('SELECT tier FROM users WHERE id = ?');
+    $tierStmt->execute([$job['user_id']]);
+    $tier = $tierStmt->fetchColumn();
+    $deepTiers = defined('TIER_DEEP') ? TIER_DEEP : [];
+    $deepQueued = $job['pointing_key'] !== null && in_array($tier, $deepTiers, true)
+        && queueDeepJob($db, (int)$job['user_id'], $job['object_name'], $job['pointing_key']);
+
+    // ... and its catalogs into the owner's light curves of this pointing
+    $lcTiers = defined('TIER_LIGHTCURVES') ? TIER_LIGHTCURVES : [];
+    $lcQueued = $job['pointing_key'] !== null && in_array($tier, $lcTiers, true)
+        && queueLightCurveJob($db, (int)$job['user_id'], $job['object_name'], $job['pointing_key']);
+
     $db->commit();
+    if ($deepQueued || $lcQueued) {
+        signalJobsAvailable();
+    }
     echo json_encode(['ok' => true]);
 } catch (Exception $e) {
     $db->rollBack();
@@ -135,3 +205,119 @@ try {
     echo json_encode(['error' => 'Internal error.']);
     error_log('complete_job error: ' . $e->getMessage());
 }
+
+/**
+ * Record a deep job's co-add and its new members; queue another deep job if
+ * stacks arrived (or were left over) meanwhile.
+ */
+function completeDeepJob(PDO $db, array $job, array $input): void
+{
+    $db->beginTransaction();
+    try {
+        // Without ucloud_path no co-add was made: only record the members
+        if (isset($input['ucloud_path'])) {
+            $db->prepare(
+                'UPDATE deep_stacks
+                 SET ucloud_path = ?, thumbnail_path = ?, state_path = ?, n_stacks = ?, n_frames = ?,
+                     total_exptime = ?, date_obs_start = ?, date_obs_end = ?, ra_deg = ?, dec_deg = ?,
+                     file_size_bytes = ?, n_stars_detected = ?, compression = ?, updated_at = NOW()
+                 WHERE id = ?'
+            )->execute([
+                $input['ucloud_path'] ?? null,
+                $input['thumbnail_path'] ?? null,
+                $input['state_path'] ?? null,
+                (int)($input['n_stacks'] ?? 0),
+                (int)($input['n_frames_aligned'] ?? 0),
+                $input['total_exptime'] ?? null,
+                $input['date_obs_start'] ?? null,
+                $input['date_obs_end'] ?? null,
+                $input['ra_deg'] ?? null,
+                $input['dec_deg'] ?? null,
+                (int)($input['file_size_bytes'] ?? 0),
+                isset($input['n_stars_detected']) ? (int)$input['n_stars_detected'] : null,
+                $input['compression'] ?? null,
+                $job['deep_stack_id'],
+            ]);
+        }
+
+        $member = $db->prepare(
+            'INSERT IGNORE INTO deep_stack_members (deep_stack_id, stacked_frame_id) VALUES (?, ?)'
+        );
+        foreach (is_array($input['members'] ?? null) ? $input['members'] : [] as $frameId) {
+            $member->execute([$job['deep_stack_id'], (int)$frameId]);
+        }
+
+        $db->prepare(
+            'UPDATE stacking_jobs SET status = ?, completed_at = NOW(), lease_expires_at = NULL WHERE id = ?'
+        )->execute(['completed', $job['id']]);
+
+        $deepStmt = $db->prepare('SELECT * FROM deep_stacks WHERE id = ?');
+        $deepStmt->execute([$job['deep_stack_id']]);
+        $deep = $deepStmt->fetch();
+        $deepQueued = $deep && deepStackNewFrames($db, $deep, 1)
+            && queueDeepJob($db, (int)$deep['user_id'], $deep['object_name'], $deep['pointing_key']);
+
+        $db->commit();
+        if ($deepQueued) {
+            signalJobsAvailable();
+        }
+        echo json_encode(['ok' => true]);
+    } catch (Exception $e) {
+        $db->rollBack();
+        http_response_code(500);
+        echo json_encode(['error' => 'Internal error.']);
+        error_log('complete_job error: ' . $e->getMessage());
+    }
+}
+
+/**
+ * Record a light-curve job's store and its new members; queue another
+ * light-curve job if catalogs arrived (or were left over) meanwhile.
+ */
+function completeLightCurveJob(PDO $db, array $job, array $input): void
+{
+    $db->beginTransaction();
+    try {
+        $db->prepare(
+            'UPDATE light_curves
+             SET store_path = ?, n_sources = ?, n_epochs = ?, n_points = ?, file_size_bytes = ?,
+                 updated_at = NOW()
+             WHERE id = ?'
+        )->execute([
+            $input['store_path'] ?? null,
+            (int)($input['n_sources'] ?? 0),
+            (int)($input['n_epochs'] ?? 0),
+            (int)($input['n_points'] ?? 0),
+            (int)($input['file_size_bytes'] ?? 0),
+            $job['light_curve_id'],
+        ]);
+
+        $member = $db->prepare(
+            'INSERT IGNORE INTO light_curve_members (light_curve_id, stacked_frame_id) VALUES (?, ?)'
+        );
+        foreach (is_array($input['members'] ?? null) ? $input['members'] : [] as $frameId) {
+            $member->execute([$job['light_curve_id'], (int)$frameId]);
+        }
+
+        $db->prepare(
+            'UPDATE stacking_jobs SET status = ?, completed_at = NOW(), lease_expires_at = NULL WHERE id = ?'
+        )->execute(['completed', $job['id']]);
+
+        $lcStmt = $db->prepare('SELECT * FROM light_curves WHERE id = ?');
+        $lcStmt->execute([$job['light_curve_id']]);
+        $lc = $lcStmt->fetch();
+        $lcQueued = $lc && lightCurveNewCatalogs($db, $lc, 1)
+            && queueLightCurveJob($db, (int)$lc['user_id'], $lc['object_name'], $lc['pointing_key']);
+
+        $db->commit();
+        if ($lcQueued) {
+            signalJobsAvailable();
+        }
+        echo json_encode(['ok' => true]);
+    } catch (Exception $e) {
+        $db->rollBack();
+        http_response_code(500);
+        echo json_encode(['error' => 'Internal error.']);
+        error_log('complete_job error: ' . $e->getMessage());
+    }
+}
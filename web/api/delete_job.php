@@ -93,7 +93,7 @@ try {
 
     // 4. If job produced stacked_frames, delete from u:cloud
     $stmt = $db->prepare(
-        'SELECT id, ucloud_path, thumbnail_path FROM stacked_frames WHERE stacking_job_id = ?'
+        'SELECT id, ucloud_path, thumbnail_path, catalog_path FROM stacked_frames WHERE stacking_job_id = ?'
     );
     $stmt->execute([$jobId]);
     $stacks = $stmt->fetchAll();
@@ -104,6 +104,13 @@ try {
         }
         if (!empty($stack['thumbnail_path'])) {
             deleteFromUcloud($stack['thumbnail_path']);
+            // Other preview sizes live next to the 512 px thumbnail
+            foreach ([256, 1024] as $size) {
+                deleteFromUcloud(preg_replace('/_thumb\.png$/', "_thumb_{$size}.png", $stack['thumbnail_path']));
+            }
+        }
+        if (!empty($stack['catalog_path'])) {
+            deleteFromUcloud($stack['catalog_path']);
         }
     }
 
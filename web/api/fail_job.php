@@ -5,11 +5,17 @@
  * Marks a stacking job as failed with an error message.
  * Authenticated with Bearer WORKER_API_KEY.
  *
- * POST body (JSON): { job_id, error_message }
+ * POST body (JSON): { job_id, error_message, [worker_id], [release] }
+ *
+ * With worker_id, the job must still be leased to that worker (409 otherwise).
+ * With release, the job was claimed but never started (the worker is shutting
+ * down): it goes back to 'pending' without counting an attempt.
  */
 
 require_once __DIR__ . '/../config.php';
 require_once __DIR__ . '/../db.php';
+require_once __DIR__ . '/../job_leases.php';
+require_once __DIR__ . '/../job_signal.php';
 
 header('Content-Type: application/json');
 
@@ -45,7 +51,7 @@ $errorMessage = $input['error_message'] ?? 'Unknown error';
 
 $db = getDb();
 
-$stmt = $db->prepare('SELECT id, retry_count FROM stacking_jobs WHERE id = ? AND status = ?');
+$stmt = $db->prepare('SELECT id, retry_count, worker_id FROM stacking_jobs WHERE id = ? AND status = ?');
 $stmt->execute([$jobId, 'processing']);
 $job = $stmt->fetch();
 
@@ -55,15 +61,37 @@ if (!$job) {
     exit;
 }
 
+if (!leaseHeldBy($job, $input)) {
+    http_response_code(409);
+    echo json_encode(['error' => 'Job is leased to another worker.']);
+    exit;
+}
+
+if (!empty($input['release'])) {
+    $db->prepare(
+        'UPDATE stacking_jobs
+         SET status = \'pending\', worker_id = NULL, started_at = NULL, lease_expires_at = NULL
+         WHERE id = ?'
+    )->execute([$jobId]);
+    signalJobsAvailable();
+    echo json_encode(['ok' => true, 'status' => 'pending']);
+    exit;
+}
+
 // If under retry limit, mark as retry; otherwise mark as failed
 $newStatus = ($job['retry_count'] < 3) ? 'retry' : 'failed';
 
 $db->prepare(
     'UPDATE stacking_jobs
-     SET status = ?, error_message = ?, retry_count = retry_count + 1, completed_at = NOW()
+     SET status = ?, error_message = ?, retry_count = retry_count + 1, completed_at = NOW(),
+         lease_expires_at = NULL
      WHERE id = ?'
 )->execute([$newStatus, $errorMessage, $jobId]);
 
+if ($newStatus === 'retry') {
+    signalJobsAvailable();
+}
+
 echo json_encode([
     'ok'     => true,
     'status' => $newStatus,
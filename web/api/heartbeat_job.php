@@ -0,0 +1,84 @@
+<?php
+/**
+ * Worker API: POST /api/heartbeat_job.php
+ *
+ * Renews the leases of a worker's jobs and records their progress.
+ * Authenticated with Bearer WORKER_API_KEY.
+ *
+ * POST body (JSON):
+ *   { worker_id, jobs: [{job_id, stage, [done], [total]}, ...] }
+ *
+ * Returns { ok, lease_s, lost: [job_id, ...] }: lost lists the jobs that are
+ * no longer leased to this worker (the lease expired and the job went back to
+ * the queue, or it was deleted); the worker stops them.
+ */
+
+require_once __DIR__ . '/../config.php';
+require_once __DIR__ . '/../db.php';
+require_once __DIR__ . '/../job_leases.php';
+
+header('Content-Type: application/json');
+
+if ($_SERVER['REQUEST_METHOD'] !== 'POST') {
+    http_response_code(405);
+    echo json_encode(['error' => 'POST required.']);
+    exit;
+}
+
+// Authenticate worker
+$authHeader = $_SERVER['HTTP_AUTHORIZATION'] ?? '';
+if (!preg_match('/^Bearer\s+(.+)$/i', $authHeader, $m) || !hash_equals(WORKER_API_KEY, $m[1])) {
+    http_response_code(401);
+    echo json_encode(['error' => 'Unauthorized.']);
+    exit;
+}
+
+$input = json_decode(file_get_contents('php://input'), true);
+if (!$input || !isset($input['worker_id']) || !is_array($input['jobs'] ?? null)) {
+    http_response_code(400);
+    echo json_encode(['error' => 'Expected worker_id and jobs.']);
+    exit;
+}
+
+$workerId = (string)$input['worker_id'];
+$leaseSeconds = jobLeaseSeconds();
+
+$db = getDb();
+
+$renew = $db->prepare(
+    'UPDATE stacking_jobs
+     SET lease_expires_at = NOW() + INTERVAL ? SECOND, heartbeat_at = NOW(),
+         progress_stage = ?, progress_done = ?, progress_total = ?
+     WHERE id = ? AND worker_id = ? AND status = ?'
+);
+$held = $db->prepare(
+    'SELECT COUNT(*) FROM stacking_jobs WHERE id = ? AND worker_id = ? AND status = ?'
+);
+
+$lost = [];
+foreach ($input['jobs'] as $job) {
+    $jobId = (int)($job['job_id'] ?? 0);
+    if ($jobId <= 0) {
+        continue;
+    }
+    $renew->execute([
+        $leaseSeconds,
+        isset($job['stage']) ? substr((string)$job['stage'], 0, 32) : null,
+        isset($job['done']) ? (int)$job['done'] : null,
+        isset($job['total']) ? (int)$job['total'] : null,
+        $jobId,
+        $workerId,
+        'processing',
+    ]);
+    // rowCount() only counts changed rows, so check ownership explicitly
+    $held->execute([$jobId, $workerId, 'processing']);
+    if ((int)$held->fetchColumn() === 0) {
+        $lost[] = $jobId;
+    }
+}
+
+echo json_encode([
+    'ok'      => true,
+    'lease_s' => $leaseSeconds,
+    'lost'    => $lost,
+]);
@@ -2,14 +2,36 @@
 /**
  * Worker API: GET /api/next_job.php
  *
- * Claims the next pending stacking job atomically.
+ * Claims the next pending stacking job(s) atomically.
  * Authenticated with Bearer WORKER_API_KEY.
  *
- * Returns JSON with job details, or 204 if no jobs available.
+ * GET ?worker_id=X[&limit=n][&wait=s]
+ *
+ * Returns JSON with job details ({"jobs": [...]} when limit is given, max 10),
+ * or 204 if no jobs available. Each job lists the stack cadences (minutes) to
+ * produce for the owner's tier and the stack compression for that tier, and
+ * the total size of its raws (for the worker's memory / disk admission). With wait, the request is held open for up to
+ * s seconds (max LONG_POLL_MAX) until a job can be claimed.
+ *
+ * Every job has a type: "chunk" (stack a chunk's raws), "deep" (fold the
+ * pointing's new 15-min stacks, listed in `stacks`, into its deep co-add; see
+ * deep_stacks.php) or "lightcurve" (match the source catalogs of the
+ * pointing's new stacks, listed in `catalogs`, into its light curves; see
+ * light_curves.php). A deep or light-curve job is not claimed while another
+ * one of the same co-add or store is processing, and one with nothing new
+ * left is completed here.
+ *
+ * Claimed jobs are leased to the worker for JOB_LEASE_SECONDS; the worker
+ * renews the lease with heartbeat_job.php. Jobs whose lease expired are put
+ * back in the queue (see job_leases.php) before claiming.
  */
 
 require_once __DIR__ . '/../config.php';
 require_once __DIR__ . '/../db.php';
+require_once __DIR__ . '/../deep_stacks.php';
+require_once __DIR__ . '/../job_leases.php';
+require_once __DIR__ . '/../light_curves.php';
+require_once __DIR__ . '/../job_signal.php';
 
 header('Content-Type: application/json');
 
@@ -23,66 +45,226 @@ if (!preg_match('/^Bearer\s+(.+)$/i', $authHeader, $m) || !hash_equals(WORKER_AP
 
 $workerId = $_GET['worker_id'] ?? 'default';
 
+// Optional batch claim: ?limit=n returns {"jobs": [...]} with up to n jobs.
+// Without limit the response is a single job object (original format).
+$batch = isset($_GET['limit']);
+$limit = max(1, min(10, (int)($_GET['limit'] ?? 1)));
+
+// Optional long poll: ?wait=s holds the request until a job can be claimed
+$maxWait = defined('LONG_POLL_MAX') ? LONG_POLL_MAX : 25;
+$wait = max(0, min($maxWait, (int)($_GET['wait'] ?? 0)));
+set_time_limit($wait + 30);
+
 $db = getDb();
 
-// Claim next pending job atomically
-$db->beginTransaction();
+/**
+ * Lock up to $n claimable jobs with the given status, oldest first.
+ */
+function lockJobs(PDO $db, string $status, int $n): array
+{
+    $sql = 'SELECT id, user_id, job_type, upload_session_id, chunk_key, deep_stack_id,
+                   light_curve_id, object_name, pointing_key, frame_count
+            FROM stacking_jobs
+            WHERE status = ?' . ($status === 'retry' ? ' AND retry_count < 3' : '') . '
+              AND NOT EXISTS (
+                  SELECT 1 FROM stacking_jobs busy
+                  WHERE (busy.deep_stack_id = stacking_jobs.deep_stack_id
+                         OR busy.light_curve_id = stacking_jobs.light_curve_id)
+                    AND busy.status = \'processing\'
+              )
+            ORDER BY created_at ASC
+            LIMIT ?
+            FOR UPDATE SKIP LOCKED';
+    $stmt = $db->prepare($sql);
+    $stmt->bindValue(1, $status);
+    $stmt->bindValue(2, $n, PDO::PARAM_INT);
+    $stmt->execute();
+    return $stmt->fetchAll();
+}
 
-try {
-    $stmt = $db->prepare(
-        'SELECT id, user_id, upload_session_id, chunk_key, object_name, frame_count
-         FROM stacking_jobs
-         WHERE status = ?
-         ORDER BY created_at ASC
-         LIMIT 1
-         FOR UPDATE SKIP LOCKED'
-    );
-    $stmt->execute(['pending']);
-    $job = $stmt->fetch();
-
-    if (!$job) {
-        // Also check for retry jobs
-        $stmt = $db->prepare(
-            'SELECT id, user_id, upload_session_id, chunk_key, object_name, frame_count
-             FROM stacking_jobs
-             WHERE status = ? AND retry_count < 3
-             ORDER BY created_at ASC
-             LIMIT 1
-             FOR UPDATE SKIP LOCKED'
+/**
+ * Atomically claim up to $n jobs for $workerId. Returns the claimed rows.
+ */
+function claimJobs(PDO $db, string $workerId, int $n): array
+{
+    $db->beginTransaction();
+    try {
+        reclaimExpiredJobs($db);
+        $jobs = lockJobs($db, 'pending', $n);
+
+        if (count($jobs) < $n) {
+            // Also check for retry jobs
+            $jobs = array_merge($jobs, lockJobs($db, 'retry', $n - count($jobs)));
+        }
+
+        // Mark as processing, leased to this worker
+        $update = $db->prepare(
+            'UPDATE stacking_jobs
+             SET status = ?, worker_id = ?, started_at = NOW(),
+                 lease_expires_at = NOW() + INTERVAL ? SECOND, heartbeat_at = NULL,
+                 progress_stage = NULL, progress_done = NULL, progress_total = NULL
+             WHERE id = ?'
         );
-        $stmt->execute(['retry']);
-        $job = $stmt->fetch();
+        foreach ($jobs as $job) {
+            $update->execute(['processing', $workerId, jobLeaseSeconds(), $job['id']]);
+        }
+        $db->commit();
+        return $jobs;
+    } catch (Exception $e) {
+        $db->rollBack();
+        throw $e;
     }
+}
 
-    if (!$job) {
-        $db->commit();
+try {
+    $deadline = microtime(true) + $wait;
+    $lastSignal = jobSignalValue();
+    $lastTry = microtime(true);
+    $jobs = claimJobs($db, $workerId, $limit);
+
+    // Long poll: re-query when finalize.php signals new jobs, or every 5 s
+    // to pick up retries and jobs created by other means
+    while (!$jobs && microtime(true) < $deadline) {
+        usleep(250000);
+        $signal = jobSignalValue();
+        if ($signal !== $lastSignal || microtime(true) - $lastTry >= 5) {
+            $lastSignal = $signal;
+            $lastTry = microtime(true);
+            $jobs = claimJobs($db, $workerId, $limit);
+        }
+    }
+
+    if (!$jobs) {
         http_response_code(204);
         exit;
     }
 
-    // Mark as processing
-    $update = $db->prepare(
-        'UPDATE stacking_jobs SET status = ?, worker_id = ?, started_at = NOW() WHERE id = ?'
+    // Get the upload sessions' local paths and the owners' tiers
+    $sessStmt = $db->prepare('SELECT ucloud_path FROM upload_sessions WHERE id = ?');
+    $tierStmt = $db->prepare('SELECT tier FROM users WHERE id = ?');
+    $sizeStmt = $db->prepare(
+        'SELECT COALESCE(SUM(file_size_bytes), 0) FROM raw_files
+         WHERE upload_session_id = ? AND chunk_key = ? AND is_deleted = 0'
     );
-    $update->execute(['processing', $workerId, $job['id']]);
-    $db->commit();
-
-    // Get the upload session's u:cloud path
-    $stmt = $db->prepare('SELECT ucloud_path FROM upload_sessions WHERE id = ?');
-    $stmt->execute([$job['upload_session_id']]);
-    $session = $stmt->fetch();
-
-    echo json_encode([
-        'job_id'            => (int)$job['id'],
-        'user_id'           => (int)$job['user_id'],
-        'upload_session_id' => (int)$job['upload_session_id'],
-        'chunk_key'         => $job['chunk_key'],
-        'object_name'       => $job['object_name'],
-        'frame_count'       => (int)$job['frame_count'],
-        'session_ucloud_path' => $session['ucloud_path'] ?? null,
-    ]);
+    $deepStmt = $db->prepare('SELECT * FROM deep_stacks WHERE id = ?');
+    $lcStmt = $db->prepare('SELECT * FROM light_curves WHERE id = ?');
+    $doneStmt = $db->prepare(
+        'UPDATE stacking_jobs SET status = ?, completed_at = NOW(), lease_expires_at = NULL WHERE id = ?'
+    );
+    $tierCadences = defined('TIER_CADENCES') ? TIER_CADENCES : [];
+    $tierCompression = defined('TIER_COMPRESSION') ? TIER_COMPRESSION : [];
+    $deepLimit = defined('DEEP_STACKS_PER_JOB') ? DEEP_STACKS_PER_JOB : 48;
+    $lcLimit = defined('LIGHTCURVE_CATALOGS_PER_JOB') ? LIGHTCURVE_CATALOGS_PER_JOB : 500;
+    $payload = [];
+    foreach ($jobs as $job) {
+        if ($job['job_type'] === 'deep') {
+            $deepStmt->execute([$job['deep_stack_id']]);
+            $deep = $deepStmt->fetch();
+            $stacks = $deep ? deepStackNewFrames($db, $deep, $deepLimit) : [];
+            if (!$stacks) {
+                // Nothing new since the job was queued (e.g. folded in by a retry)
+                $doneStmt->execute(['completed', $job['id']]);
+                continue;
+            }
+            $tierStmt->execute([$job['user_id']]);
+            $tier = $tierStmt->fetchColumn();
+
+            $payload[] = [
+                'job_id'        => (int)$job['id'],
+                'type'          => 'deep',
+                'user_id'       => (int)$job['user_id'],
+                'deep_stack_id' => (int)$job['deep_stack_id'],
+                'chunk_key'     => null,
+                'object_name'   => $job['object_name'],
+                'pointing_key'  => $job['pointing_key'],
+                'frame_count'   => count($stacks),
+                'raw_bytes'     => array_sum(array_column($stacks, 'file_size_bytes')),
+                'ucloud_path'   => $deep['ucloud_path'],
+                'state_path'    => $deep['state_path'],
+                'stacks'        => array_map(static function (array $s): array {
+                    return [
+                        'id'               => (int)$s['id'],
+                        'ucloud_path'      => $s['ucloud_path'],
+                        'total_exptime'    => $s['total_exptime'] !== null ? (float)$s['total_exptime'] : null,
+                        'n_frames_input'   => (int)$s['n_frames_input'],
+                        'n_frames_aligned' => (int)$s['n_frames_aligned'],
+                        'date_obs_start'   => $s['date_obs_start'],
+                        'date_obs_end'     => $s['date_obs_end'],
+                        'ra_deg'           => $s['ra_deg'] !== null ? (float)$s['ra_deg'] : null,
+                        'dec_deg'          => $s['dec_deg'] !== null ? (float)$s['dec_deg'] : null,
+                        'file_size_bytes'  => (int)$s['file_size_bytes'],
+                    ];
+                }, $stacks),
+                'cadences'      => [15],
+                'compression'   => $tierCompression[$tier] ?? null,
+            ];
+            continue;
+        }
+
+        if ($job['job_type'] === 'lightcurve') {
+            $lcStmt->execute([$job['light_curve_id']]);
+            $lc = $lcStmt->fetch();
+            $catalogs = $lc ? lightCurveNewCatalogs($db, $lc, $lcLimit) : [];
+            if (!$catalogs) {
+                $doneStmt->execute(['completed', $job['id']]);
+                continue;
+            }
+
+            $payload[] = [
+                'job_id'         => (int)$job['id'],
+                'type'           => 'lightcurve',
+                'user_id'        => (int)$job['user_id'],
+                'light_curve_id' => (int)$job['light_curve_id'],
+                'chunk_key'      => null,
+                'object_name'    => $job['object_name'],
+                'pointing_key'   => $job['pointing_key'],
+                'frame_count'    => count($catalogs),
+                'store_path'     => $lc['store_path'],
+                'n_points'       => (int)$lc['n_points'],
+                'catalogs'       => array_map(static function (array $c): array {
+                    return [
+                        'id'             => (int)$c['id'],
+                        'catalog_path'   => $c['catalog_path'],
+                        'cadence_min'    => (int)$c['cadence_min'],
+                        'slot_index'     => (int)$c['slot_index'],
+                        'total_exptime'  => $c['total_exptime'] !== null ? (float)$c['total_exptime'] : null,
+                        'date_obs_start' => $c['date_obs_start'],
+                        'date_obs_end'   => $c['date_obs_end'],
+                    ];
+                }, $catalogs),
+            ];
+            continue;
+        }
+
+        $sessStmt->execute([$job['upload_session_id']]);
+        $session = $sessStmt->fetch();
+        $tierStmt->execute([$job['user_id']]);
+        $tier = $tierStmt->fetchColumn();
+        $sizeStmt->execute([$job['upload_session_id'], $job['chunk_key']]);
+
+        $payload[] = [
+            'job_id'            => (int)$job['id'],
+            'type'              => 'chunk',
+            'user_id'           => (int)$job['user_id'],
+            'upload_session_id' => (int)$job['upload_session_id'],
+            'chunk_key'         => $job['chunk_key'],
+            'object_name'       => $job['object_name'],
+            'pointing_key'      => $job['pointing_key'],
+            'frame_count'       => (int)$job['frame_count'],
+            'raw_bytes'         => (int)$sizeStmt->fetchColumn(),
+            'session_ucloud_path' => $session['ucloud_path'] ?? null,
+            'cadences'          => $tierCadences[$tier] ?? [15],
+            'compression'       => $tierCompression[$tier] ?? null,
+        ];
+    }
+
+    if (!$payload) {
+        http_response_code(204);
+        exit;
+    }
+
+    echo json_encode($batch ? ['jobs' => $payload] : $payload[0]);
 } catch (Exception $e) {
-    $db->rollBack();
     http_response_code(500);
     echo json_encode(['error' => 'Internal error.']);
     error_log('next_job error: ' . $e->getMessage());
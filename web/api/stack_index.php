@@ -0,0 +1,50 @@
+<?php
+/**
+ * Worker API: GET /api/stack_index.php?after_id=X&limit=N
+ *
+ * Returns the stacked frames of all users with an id above after_id (at most
+ * limit, by id) for the worker's sky-position index (worker/sky_index.py),
+ * plus n_upto, the number of stacked frames with an id up to after_id, so the
+ * index can tell that stacks it holds were deleted.
+ * Authenticated with Bearer WORKER_API_KEY.
+ */
+
+require_once __DIR__ . '/../config.php';
+require_once __DIR__ . '/../db.php';
+
+header('Content-Type: application/json');
+
+// Authenticate worker
+$authHeader = $_SERVER['HTTP_AUTHORIZATION'] ?? '';
+if (!preg_match('/^Bearer\s+(.+)$/i', $authHeader, $m) || !hash_equals(WORKER_API_KEY, $m[1])) {
+    http_response_code(401);
+    echo json_encode(['error' => 'Unauthorized.']);
+    exit;
+}
+
+$afterId = max(0, (int)($_GET['after_id'] ?? 0));
+$limit = max(1, min(10000, (int)($_GET['limit'] ?? 1000)));
+
+$db = getDb();
+
+// Primary-key range scans: cheap however many stacks there are
+$stmt = $db->prepare(
+    'SELECT id, user_id, object_name, ra_deg, dec_deg, date_obs_start, date_obs_end,
+            cadence_min, total_exptime, n_frames_aligned
+     FROM stacked_frames
+     WHERE id > ?
+     ORDER BY id ASC
+     LIMIT ?'
+);
+$stmt->bindValue(1, $afterId, PDO::PARAM_INT);
+$stmt->bindValue(2, $limit, PDO::PARAM_INT);
+$stmt->execute();
+$stacks = $stmt->fetchAll();
+
+$count = $db->prepare('SELECT COUNT(*) FROM stacked_frames WHERE id <= ?');
+$count->execute([$afterId]);
+
+echo json_encode([
+    'stacks' => $stacks,
+    'n_upto' => (int)$count->fetchColumn(),
+]);
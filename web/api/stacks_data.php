@@ -3,6 +3,8 @@
  * Return stacked frames data as JSON for the sky map visualization.
  *
  * GET — requires session cookie (logged-in user).
+ * Optional ?object=NAME returns only that object's stacks. Only stacks with
+ * coordinates are returned (the map cannot place the others).
  */
 
 require_once __DIR__ . '/../auth.php';
@@ -19,22 +21,31 @@ if ($userId === null) {
 
 $db = getDb();
 
-$stmt = $db->prepare(
-    'SELECT sf.id, sf.ra_deg, sf.dec_deg, sf.object_name, sf.chunk_key,
-            sf.date_obs_start, sf.n_frames_input, sf.n_frames_aligned,
-            sf.total_exptime, sf.file_size_bytes
-     FROM stacked_frames sf
-     WHERE sf.user_id = ?
-     ORDER BY sf.date_obs_start DESC'
-);
-$stmt->execute([$userId]);
+$sql = 'SELECT sf.id, sf.ra_deg, sf.dec_deg, sf.object_name, sf.chunk_key,
+               sf.cadence_min, sf.slot_index, sf.date_obs_start, sf.n_frames_input, sf.n_frames_aligned,
+               sf.total_exptime, sf.file_size_bytes
+        FROM stacked_frames sf
+        WHERE sf.user_id = ? AND sf.ra_deg IS NOT NULL AND sf.dec_deg IS NOT NULL';
+$params = [$userId];
+
+$objectFilter = $_GET['object'] ?? null;
+if ($objectFilter !== null && $objectFilter !== '') {
+    $sql .= ' AND sf.object_name = ?';
+    $params[] = $objectFilter;
+}
+$sql .= ' ORDER BY sf.date_obs_start DESC';
+
+$stmt = $db->prepare($sql);
+$stmt->execute($params);
 $stacks = $stmt->fetchAll();
 
 // Cast numeric fields
 foreach ($stacks as &$s) {
     $s['id'] = (int)$s['id'];
-    $s['ra_deg'] = $s['ra_deg'] !== null ? (float)$s['ra_deg'] : null;
-    $s['dec_deg'] = $s['dec_deg'] !== null ? (float)$s['dec_deg'] : null;
+    $s['cadence_min'] = (int)$s['cadence_min'];
+    $s['slot_index'] = (int)$s['slot_index'];
+    $s['ra_deg'] = (float)$s['ra_deg'];
+    $s['dec_deg'] = (float)$s['dec_deg'];
     $s['n_frames_input'] = (int)$s['n_frames_input'];
     $s['n_frames_aligned'] = (int)$s['n_frames_aligned'];
     $s['total_exptime'] = $s['total_exptime'] !== null ? (float)$s['total_exptime'] : null;
@@ -17,6 +17,34 @@ define('UCLOUD_BASE_PATH', '/crowdsky');
 
 // Worker API
 define('WORKER_API_KEY', 'CHANGE_ME_GENERATE_A_RANDOM_64_CHAR_STRING');
+define('LONG_POLL_MAX', 25);  // max seconds next_job.php holds a long-poll request
+define('JOB_LEASE_SECONDS', 180);  // claimed jobs return to the queue this long after the last heartbeat
+
+// Stack cadences (minutes) per user tier; each must divide 15 and the next coarser one
+define('TIER_CADENCES', [
+    'free' => [15],
+    'pro'  => [15, 3, 1],
+    'raw'  => [15, 3, 1],
+]);
+
+// Stack FITS tile compression per user tier (omitted tier = uncompressed).
+// quantize: steps per background sigma, larger = closer to lossless;
+// 0 = lossless (GZIP_2 only)
+define('TIER_COMPRESSION', [
+    'free' => ['type' => 'RICE_1', 'quantize' => 4],
+    'pro'  => ['type' => 'RICE_1', 'quantize' => 16],
+    'raw'  => ['type' => 'GZIP_2', 'quantize' => 0],
+]);
+
+// Tiers whose 15-min stacks are also folded into a deep co-add per pointing
+// (omitted tier = none), and the most stacks one deep job takes at a time
+define('TIER_DEEP', ['pro', 'raw']);
+define('DEEP_STACKS_PER_JOB', 48);
+
+// Tiers whose stacks' source catalogs are matched into per-pointing light
+// curves (omitted tier = none), and the most catalogs one light-curve job takes
+define('TIER_LIGHTCURVES', ['free', 'pro', 'raw']);
+define('LIGHTCURVE_CATALOGS_PER_JOB', 500);
 
 // Local raw file storage (webspace disk, temporary until stacking completes)
 define('UPLOAD_DIR', __DIR__ . '/uploads');  // 50 GB webspace buffer
@@ -0,0 +1,65 @@
+<?php
+/**
+ * Deep co-adds: one per user and pointing, built by the worker from the
+ * pointing's 15-minute stacks (see worker/deep_stack.py).
+ *
+ * Deep jobs are stacking_jobs rows with job_type 'deep'. complete_job.php
+ * queues one whenever a chunk of a TIER_DEEP user completes; the job folds
+ * in the 15-min stacks that are not yet members of the co-add.
+ */
+
+require_once __DIR__ . '/config.php';
+
+/**
+ * 15-min stacks of a deep co-add's pointing that are not in it yet, oldest first.
+ */
+function deepStackNewFrames(PDO $db, array $deep, int $limit): array
+{
+    $stmt = $db->prepare(
+        'SELECT sf.id, sf.ucloud_path, sf.total_exptime, sf.n_frames_input, sf.n_frames_aligned,
+                sf.date_obs_start, sf.date_obs_end, sf.ra_deg, sf.dec_deg, sf.file_size_bytes
+         FROM stacked_frames sf
+         JOIN stacking_jobs sj ON sj.id = sf.stacking_job_id
+         LEFT JOIN deep_stack_members m
+                ON m.deep_stack_id = ? AND m.stacked_frame_id = sf.id
+         WHERE sf.user_id = ? AND sj.pointing_key = ? AND sf.cadence_min = 15
+               AND m.stacked_frame_id IS NULL
+         ORDER BY sf.date_obs_start ASC, sf.id ASC
+         LIMIT ?'
+    );
+    $stmt->bindValue(1, (int)$deep['id'], PDO::PARAM_INT);
+    $stmt->bindValue(2, (int)$deep['user_id'], PDO::PARAM_INT);
+    $stmt->bindValue(3, $deep['pointing_key']);
+    $stmt->bindValue(4, $limit, PDO::PARAM_INT);
+    $stmt->execute();
+    return $stmt->fetchAll();
+}
+
+/**
+ * Create the deep co-add of a user's pointing if needed and queue a deep job
+ * for it, unless one is already waiting. Returns true if a job was queued.
+ */
+function queueDeepJob(PDO $db, int $userId, ?string $objectName, string $pointingKey): bool
+{
+    $db->prepare(
+        'INSERT INTO deep_stacks (user_id, object_name, pointing_key) VALUES (?, ?, ?)
+         ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)'
+    )->execute([$userId, $objectName, $pointingKey]);
+    $deepId = (int)$db->lastInsertId();
+
+    $waiting = $db->prepare(
+        'SELECT COUNT(*) FROM stacking_jobs
+         WHERE deep_stack_id = ?
+               AND (status = \'pending\' OR (status = \'retry\' AND retry_count < 3))'
+    );
+    $waiting->execute([$deepId]);
+    if ((int)$waiting->fetchColumn() > 0) {
+        return false;
+    }
+
+    $db->prepare(
+        'INSERT INTO stacking_jobs (user_id, job_type, deep_stack_id, object_name, pointing_key)
+         VALUES (?, \'deep\', ?, ?, ?)'
+    )->execute([$userId, $deepId, $objectName, $pointingKey]);
+    return true;
+}
@@ -8,6 +8,7 @@
 
 require_once __DIR__ . '/auth.php';
 require_once __DIR__ . '/db.php';
+require_once __DIR__ . '/job_signal.php';
 
 header('Content-Type: application/json');
 
@@ -73,17 +74,20 @@ if (empty($chunks)) {
 
 // Create stacking jobs
 $insertJob = $db->prepare(
-    'INSERT INTO stacking_jobs (user_id, upload_session_id, chunk_key, object_name, frame_count)
-     VALUES (?, ?, ?, ?, ?)'
+    'INSERT INTO stacking_jobs (user_id, upload_session_id, chunk_key, object_name, pointing_key, frame_count)
+     VALUES (?, ?, ?, ?, ?, ?)'
 );
 
 $jobIds = [];
 foreach ($chunks as $chunk) {
+    // RA/Dec part of the chunk key, shared by consecutive chunks of one pointing
+    $parts = explode('_', $chunk['chunk_key'], 2);
     $insertJob->execute([
         $userId,
         $sessionId,
         $chunk['chunk_key'],
         $chunk['object_name'],
+        $parts[1] ?? null,
         $chunk['cnt'],
     ]);
     $jobIds[] = (int)$db->lastInsertId();
@@ -94,6 +98,9 @@ $db->prepare(
     'UPDATE upload_sessions SET status = ?, completed_at = NOW() WHERE id = ?'
 )->execute(['complete', $sessionId]);
 
+// Wake long-polling workers
+signalJobsAvailable();
+
 echo json_encode([
     'ok'       => true,
     'jobs'     => count($jobIds),
@@ -0,0 +1,49 @@
+<?php
+/**
+ * Job leases: a claimed job stays 'processing' only while its worker renews
+ * the lease (api/heartbeat_job.php, see worker/leases.py).
+ *
+ * next_job.php gives each claimed job a lease of JOB_LEASE_SECONDS and first
+ * puts jobs whose lease ran out back in the queue, so a job of a worker that
+ * crashed is picked up again within one lease instead of staying
+ * 'processing' for good.
+ */
+
+require_once __DIR__ . '/config.php';
+
+/**
+ * Seconds a claim or heartbeat keeps a job leased to its worker.
+ */
+function jobLeaseSeconds(): int
+{
+    return defined('JOB_LEASE_SECONDS') ? JOB_LEASE_SECONDS : 180;
+}
+
+/**
+ * Return 'processing' jobs with an expired lease to the queue, counting the
+ * lost attempt like fail_job.php does. Returns the number of jobs reclaimed.
+ */
+function reclaimExpiredJobs(PDO $db): int
+{
+    $stmt = $db->prepare(
+        'UPDATE stacking_jobs
+         SET status = IF(retry_count < 3, \'retry\', \'failed\'),
+             error_message = CONCAT(\'Lease expired: worker \', COALESCE(worker_id, \'?\'),
+                                    \' stopped sending heartbeats\'),
+             retry_count = retry_count + 1,
+             completed_at = NOW(),
+             lease_expires_at = NULL
+         WHERE status = \'processing\' AND lease_expires_at < NOW()'
+    );
+    $stmt->execute();
+    return $stmt->rowCount();
+}
+
+/**
+ * Whether a worker request may act on a job: it must come from the worker
+ * holding the job. Requests without worker_id (older workers) are trusted.
+ */
+function leaseHeldBy(array $job, array $input): bool
+{
+    return !isset($input['worker_id']) || (string)$input['worker_id'] === (string)$job['worker_id'];
+}
@@ -0,0 +1,32 @@
+<?php
+/**
+ * Lightweight "new jobs available" signal for long-polling workers.
+ *
+ * finalize.php (and fail_job.php on retry) bump a counter file in UPLOAD_DIR;
+ * api/next_job.php watches it while holding a long-poll request open, so it
+ * only re-queries the database when something actually changed.
+ */
+
+require_once __DIR__ . '/config.php';
+
+function jobSignalPath(): string
+{
+    return UPLOAD_DIR . '/.jobs_signal';
+}
+
+/**
+ * Wake any long-polling workers.
+ */
+function signalJobsAvailable(): void
+{
+    @file_put_contents(jobSignalPath(), sprintf('%.6f', microtime(true)), LOCK_EX);
+}
+
+/**
+ * Current signal value (changes whenever signalJobsAvailable() is called).
+ */
+function jobSignalValue(): string
+{
+    $value = @file_get_contents(jobSignalPath());
+    return $value === false ? '' : $value;
+}
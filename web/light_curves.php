@@ -0,0 +1,68 @@
+<?php
+/**
+ * Light curves: one store per user and pointing, built by the worker from
+ * the source catalogs of the pointing's stacks (see worker/lightcurves.py).
+ *
+ * Light-curve jobs are stacking_jobs rows with job_type 'lightcurve'.
+ * complete_job.php queues one whenever a chunk of a TIER_LIGHTCURVES user
+ * completes; the job matches in the catalogs of every cadence's stacks that
+ * are not yet members of the store.
+ */
+
+require_once __DIR__ . '/config.php';
+
+/**
+ * Stacks of a light-curve store's pointing with a catalog that are not in it
+ * yet, oldest first.
+ */
+function lightCurveNewCatalogs(PDO $db, array $lc, int $limit): array
+{
+    $stmt = $db->prepare(
+        'SELECT sf.id, sf.catalog_path, sf.cadence_min, sf.slot_index, sf.total_exptime,
+                sf.date_obs_start, sf.date_obs_end
+         FROM stacked_frames sf
+         JOIN stacking_jobs sj ON sj.id = sf.stacking_job_id
+         LEFT JOIN light_curve_members m
+                ON m.light_curve_id = ? AND m.stacked_frame_id = sf.id
+         WHERE sf.user_id = ? AND sj.pointing_key = ? AND sf.catalog_path IS NOT NULL
+               AND m.stacked_frame_id IS NULL
+         ORDER BY sf.date_obs_start ASC, sf.id ASC
+         LIMIT ?'
+    );
+    $stmt->bindValue(1, (int)$lc['id'], PDO::PARAM_INT);
+    $stmt->bindValue(2, (int)$lc['user_id'], PDO::PARAM_INT);
+    $stmt->bindValue(3, $lc['pointing_key']);
+    $stmt->bindValue(4, $limit, PDO::PARAM_INT);
+    $stmt->execute();
+    return $stmt->fetchAll();
+}
+
+/**
+ * Create the light-curve store of a user's pointing if needed and queue a
+ * light-curve job for it, unless one is already waiting. Returns true if a
+ * job was queued.
+ */
+function queueLightCurveJob(PDO $db, int $userId, ?string $objectName, string $pointingKey): bool
+{
+    $db->prepare(
+        'INSERT INTO light_curves (user_id, object_name, pointing_key) VALUES (?, ?, ?)
+         ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)'
+    )->execute([$userId, $objectName, $pointingKey]);
+    $lcId = (int)$db->lastInsertId();
+
+    $waiting = $db->prepare(
+        'SELECT COUNT(*) FROM stacking_jobs
+         WHERE light_curve_id = ?
+               AND (status = \'pending\' OR (status = \'retry\' AND retry_count < 3))'
+    );
+    $waiting->execute([$lcId]);
+    if ((int)$waiting->fetchColumn() > 0) {
+        return false;
+    }
+
+    $db->prepare(
+        'INSERT INTO stacking_jobs (user_id, job_type, light_curve_id, object_name, pointing_key)
+         VALUES (?, \'lightcurve\', ?, ?, ?)'
+    )->execute([$userId, $lcId, $objectName, $pointingKey]);
+    return true;
+}
@@ -73,7 +73,7 @@ if ($objectFilter) {
     $sql .= ' AND sf.object_name = ?';
     $params[] = $objectFilter;
 }
-$sql .= ' ORDER BY sf.date_obs_start DESC LIMIT 100';
+$sql .= ' ORDER BY sf.date_obs_start DESC, sf.cadence_min DESC, sf.slot_index LIMIT 100';
 
 $stmt = $db->prepare($sql);
 $stmt->execute($params);
@@ -89,8 +89,10 @@ $stacks = $stmt->fetchAll();
         <table>
             <thead>
                 <tr>
+                    <th></th>
                     <th>Object</th>
                     <th>Chunk</th>
+                    <th>Cadence</th>
                     <th>Frames</th>
                     <th>Aligned</th>
                     <th>Exp. Time</th>
@@ -103,8 +105,17 @@ $stacks = $stmt->fetchAll();
             <tbody>
             <?php foreach ($stacks as $s): ?>
                 <tr>
+                    <td>
+                    <?php if (!empty($s['thumbnail_path'])): ?>
+                        <a href="thumbnail.php?id=<?= (int)$s['id'] ?>&amp;size=1024" target="_blank">
+                            <img class="stack-preview" loading="lazy" alt=""
+                                 src="thumbnail.php?id=<?= (int)$s['id'] ?>&amp;size=256">
+                        </a>
+                    <?php endif; ?>
+                    </td>
                     <td><?= htmlspecialchars($s['object_name'] ?? '-') ?></td>
                     <td><?= htmlspecialchars($s['chunk_key']) ?></td>
+                    <td><?= (int)$s['cadence_min'] ?> min<?= (int)$s['cadence_min'] < 15 ? ' #' . ((int)$s['slot_index'] + 1) : '' ?></td>
                     <td><?= (int)$s['n_frames_input'] ?></td>
                     <td><?= (int)$s['n_frames_aligned'] ?></td>
                     <td><?= $s['total_exptime'] ? number_format($s['total_exptime'], 1) . 's' : '-' ?></td>
@@ -141,7 +152,7 @@ $stacks = $stmt->fetchAll();
     const objectFilter = <?= json_encode($objectFilter) ?>;
 
     // --- Load data ---
-    fetch('api/stacks_data.php')
+    fetch('api/stacks_data.php' + (objectFilter ? '?object=' + encodeURIComponent(objectFilter) : ''))
         .then(r => r.json())
         .then(data => {
             if (data.error) {
@@ -149,10 +160,7 @@ $stacks = $stmt->fetchAll();
                     '<p style="padding:2rem;color:var(--text-muted)">Could not load stack data.</p>';
                 return;
             }
-            allStacks = data.filter(d => d.ra_deg !== null && d.dec_deg !== null);
-            if (objectFilter) {
-                allStacks = allStacks.filter(d => d.object_name === objectFilter);
-            }
+            allStacks = data;
             if (allStacks.length === 0) {
                 document.getElementById('skymap').innerHTML =
                     '<p style="padding:2rem;color:var(--text-muted)">No stacks with coordinates yet.</p>';
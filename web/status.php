@@ -74,6 +74,14 @@ include __DIR__ . '/templates/header.php';
                             <span class="badge badge-<?= htmlspecialchars($job['status']) ?>">
                                 <?= htmlspecialchars($job['status']) ?>
                             </span>
+                            <?php if ($job['status'] === 'processing' && $job['progress_stage'] !== null): ?>
+                                <small>
+                                    <?= htmlspecialchars($job['progress_stage']) ?>
+                                    <?php if ($job['progress_total']): ?>
+                                        <?= (int)$job['progress_done'] ?>/<?= (int)$job['progress_total'] ?>
+                                    <?php endif; ?>
+                                </small>
+                            <?php endif; ?>
                         </td>
                         <td><?= htmlspecialchars($job['created_at']) ?></td>
                         <td>
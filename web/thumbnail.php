@@ -0,0 +1,73 @@
+<?php
+/**
+ * Proxy a stack's PNG preview from u:cloud.
+ *
+ * GET ?id=<stack id>&size=256|512|1024 (default 512). The worker uploads the
+ * 512 px preview as thumbnail_path and the other sizes next to it as
+ * *_thumb_<size>.png. Stacks from before multi-size previews only have the
+ * 512 px one, which is served for any size.
+ */
+
+require_once __DIR__ . '/auth.php';
+require_once __DIR__ . '/db.php';
+require_once __DIR__ . '/config.php';
+
+const PREVIEW_SIZES = [256, 512, 1024];
+const THUMB_SIZE = 512;
+
+$userId = requireLogin();
+
+$stackId = (int)($_GET['id'] ?? 0);
+$size = (int)($_GET['size'] ?? THUMB_SIZE);
+if ($stackId <= 0 || !in_array($size, PREVIEW_SIZES, true)) {
+    http_response_code(400);
+    echo 'Missing stack ID or invalid size.';
+    exit;
+}
+
+$db = getDb();
+$stmt = $db->prepare(
+    'SELECT thumbnail_path FROM stacked_frames WHERE id = ? AND user_id = ?'
+);
+$stmt->execute([$stackId, $userId]);
+$thumbPath = $stmt->fetchColumn();
+
+if (!$thumbPath) {
+    http_response_code(404);
+    echo 'Preview not found.';
+    exit;
+}
+
+function fetchFromUcloud(string $remotePath): ?string
+{
+    $ch = curl_init(UCLOUD_WEBDAV_URL . '/' . ltrim($remotePath, '/'));
+    curl_setopt_array($ch, [
+        CURLOPT_USERPWD        => UCLOUD_SHARE_TOKEN . ':',
+        CURLOPT_RETURNTRANSFER => true,
+        CURLOPT_TIMEOUT        => 30,
+    ]);
+    $body = curl_exec($ch);
+    $httpCode = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+    curl_close($ch);
+
+    return ($httpCode === 200 && is_string($body)) ? $body : null;
+}
+
+$png = null;
+if ($size !== THUMB_SIZE) {
+    $png = fetchFromUcloud(preg_replace('/_thumb\.png$/', "_thumb_{$size}.png", $thumbPath));
+}
+if ($png === null) {
+    $png = fetchFromUcloud($thumbPath);
+}
+
+if ($png === null) {
+    http_response_code(502);
+    echo 'Could not fetch preview.';
+    exit;
+}
+
+header('Content-Type: image/png');
+header('Content-Length: ' . strlen($png));
+header('Cache-Control: private, max-age=86400');
+echo $png;
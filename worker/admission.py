@@ -0,0 +1,210 @@
+"""
+Memory- and disk-aware admission of claimed jobs (daemon mode).
+
+MAX_WORKERS bounds how many jobs run, but not what they cost: a 300-frame
+chunk stacked by seestarpy holds every frame in memory, a 10-frame chunk
+almost nothing. Each claimed job's footprint is estimated from its frame
+count and raw size (``raw_bytes`` from next_job.php; the frame size follows
+from it, raws being 16-bit Bayer mosaics) and the stacking engine it will
+use. Queued jobs start only while the footprints of running jobs plus theirs
+fit in ``MEMORY_BUDGET_MB`` and ``DISK_BUDGET_MB``; the first queued job that
+fits goes first, so small jobs fill the room a large one leaves.
+
+A job that does not fit is not starved: once it has waited ``MAX_BYPASS_S``,
+nothing else is started until it fits. A job larger than the whole budget
+runs alone.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+from . import config
+from .streaming_stack import CHUNK_MINUTES, WARMUP_FRAMES
+
+logger = logging.getLogger(__name__)
+
+# Seestar S50 frame (1080 x 1920, 16-bit) when a job has no raw_bytes
+DEFAULT_FRAME_BYTES = 1080 * 1920 * 2
+# Memory of a job besides its frames (threads, HTTP buffers, headers)
+JOB_OVERHEAD_BYTES = 64 << 20
+# Float32 RGB copies of each frame seestarpy keeps (loaded + aligned)
+SEESTARPY_FRAME_COPIES = 2
+# Float32 RGB frames in flight in the streaming / tiled engines (decoded,
+# aligned, accumulator mean / M2 / output), besides the warm-up buffer
+STREAMING_FRAMES = 6
+# Fraction of RAM / free WORK_DIR space used with MEMORY_BUDGET_MB /
+# DISK_BUDGET_MB = auto
+AUTO_FRACTION = 0.8
+# Longest a queued job is passed over by smaller ones
+MAX_BYPASS_S = 600
+
+
+@dataclass(frozen=True)
+class Footprint:
+    memory: int = 0
+    disk: int = 0
+
+    def __add__(self, other: "Footprint") -> "Footprint":
+        return Footprint(self.memory + other.memory, self.disk + other.disk)
+
+    def __sub__(self, other: "Footprint") -> "Footprint":
+        return Footprint(self.memory - other.memory, self.disk - other.disk)
+
+    def within(self, budget: "Footprint") -> bool:
+        return self.memory <= budget.memory and self.disk <= budget.disk
+
+    def __str__(self) -> str:
+        return f"{self.memory / 1e9:.1f} GB RAM, {self.disk / 1e9:.1f} GB disk"
+
+
+# Full-resolution float64 RGB-sized planes a deep co-add holds (running
+# sum, weights and footprint) besides the stack being folded in
+DEEP_STATE_FRAMES = 3
+# Light-curve stores: bytes per point in memory (the columns, the merged copy
+# and the match arrays) and per point on disk (previous and new store), and
+# the sources assumed per new catalog
+LIGHTCURVE_POINT_BYTES = 64
+LIGHTCURVE_POINT_DISK_BYTES = 32
+LIGHTCURVE_CATALOG_SOURCES = 5000
+
+
+def estimate(job: dict) -> Footprint:
+    """Peak memory and WORK_DIR bytes of a job, from its frame count and raw size."""
+    if job.get("type") == "deep":
+        return _estimate_deep(job)
+    if job.get("type") == "lightcurve":
+        return _estimate_lightcurve(job)
+    n = max(1, int(job.get("frame_count") or 1))
+    raw_bytes = int(job.get("raw_bytes") or 0) or n * DEFAULT_FRAME_BYTES
+    raw_frame = raw_bytes / n
+    # Debayered float32 RGB frame: 3 channels x 4 bytes per 2-byte raw pixel
+    frame = int(raw_frame / 2 * 3 * 4)
+
+    cadences = {int(c) for c in job.get("cadences") or [CHUNK_MINUTES]}
+    products = sum(CHUNK_MINUTES // c for c in cadences)
+    # Stacks (float32 RGB, uncompressed until uploaded) with footprints
+    disk = products * frame * 4 // 3
+
+    streaming = cadences != {CHUNK_MINUTES} or config.STACK_MODE == "streaming"
+    if streaming:
+        in_flight = min(n, 2 * config.DOWNLOAD_CONCURRENCY)
+        memory = (
+            (STREAMING_FRAMES + min(n, WARMUP_FRAMES) + len(cadences)) * frame
+            + int(in_flight * raw_frame)
+        )
+    else:
+        disk += raw_bytes
+        if config.STACK_COMBINE == "tiled":
+            memory = STREAMING_FRAMES * frame + config.COMBINE_MEMORY_MB * (1 << 20)
+            disk += n * frame
+        else:
+            memory = (SEESTARPY_FRAME_COPIES * n + STREAMING_FRAMES) * frame
+    return Footprint(memory + JOB_OVERHEAD_BYTES, disk)
+
+
+def _estimate_deep(job: dict) -> Footprint:
+    """Deep co-adds: the state and a few warped stacks in memory, stacks held in flight."""
+    stacks = job.get("stacks") or []
+    # Debayered float32 RGB frame of the default sensor
+    frame = DEFAULT_FRAME_BYTES // 2 * 3 * 4
+    in_flight = min(len(stacks), 2 * config.DOWNLOAD_CONCURRENCY)
+    stack_bytes = max([int(s.get("file_size_bytes") or 0) for s in stacks] or [0]) or frame
+    memory = (2 * DEEP_STATE_FRAMES + STREAMING_FRAMES) * frame + in_flight * stack_bytes
+    # Previous and new state (float32) plus the deep image, with footprints
+    disk = 2 * DEEP_STATE_FRAMES * frame + 2 * frame
+    return Footprint(memory + JOB_OVERHEAD_BYTES, disk)
+
+
+def _estimate_lightcurve(job: dict) -> Footprint:
+    """Light-curve jobs: the store (``n_points`` from next_job.php) plus the new catalogs' points."""
+    points = int(job.get("n_points") or 0) + LIGHTCURVE_CATALOG_SOURCES * len(job.get("catalogs") or [])
+    return Footprint(points * LIGHTCURVE_POINT_BYTES + JOB_OVERHEAD_BYTES, points * LIGHTCURVE_POINT_DISK_BYTES)
+
+
+def _available_memory() -> int:
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def budget() -> Footprint:
+    """``MEMORY_BUDGET_MB`` / ``DISK_BUDGET_MB``, resolving ``auto`` from the host now."""
+    if config.MEMORY_BUDGET_MB == "auto":
+        memory = int(AUTO_FRACTION * _available_memory())
+    else:
+        memory = int(config.MEMORY_BUDGET_MB) << 20
+    if config.DISK_BUDGET_MB == "auto":
+        config.WORK_DIR.mkdir(parents=True, exist_ok=True)
+        free = shutil.disk_usage(config.WORK_DIR).free
+        # The cache in WORK_DIR may still grow up to its quota
+        disk = int(AUTO_FRACTION * max(0, free - (config.CACHE_MAX_MB << 20)))
+    else:
+        disk = int(config.DISK_BUDGET_MB) << 20
+    return Footprint(memory, disk)
+
+
+class Admission:
+    """Budget shared by running jobs; ``take`` starts jobs, ``release`` ends them."""
+
+    def __init__(self, limit: Footprint):
+        self.limit = limit
+        self.used = Footprint()
+        self.running = 0
+        self.held_back = 0
+        self._lock = threading.Lock()
+
+    def take(self, queue: Deque[dict]) -> Optional[dict]:
+        """
+        Remove and return the first queued job that fits the remaining budget,
+        reserving its footprint (``job["footprint"]``), or None.
+        """
+        with self._lock:
+            for i, job in enumerate(queue):
+                footprint = job.get("footprint")
+                if footprint is None:
+                    footprint = job["footprint"] = estimate(job)
+                if self.running == 0 or (self.used + footprint).within(self.limit):
+                    del queue[i]
+                    self.used += footprint
+                    self.running += 1
+                    return job
+                if not job.get("held_back"):
+                    job["held_back"] = time.monotonic()
+                    self.held_back += 1
+                    logger.info(
+                        f"Job {job['job_id']} ({footprint}) waits for room "
+                        f"({self.used} of {self.limit} in use)"
+                    )
+                if time.monotonic() - job["held_back"] >= MAX_BYPASS_S:
+                    # Let it through next: start nothing else meanwhile
+                    return None
+            return None
+
+    def release(self, job: dict) -> None:
+        with self._lock:
+            self.used -= job["footprint"]
+            self.running -= 1
+
+    def collect(self) -> list:
+        """Budget use for the metrics endpoint."""
+        with self._lock:
+            used, limit, held_back = self.used, self.limit, self.held_back
+        return [
+            ("crowdsky_admission_memory_bytes", "gauge", "Estimated memory of running jobs.",
+             {(): used.memory}),
+            ("crowdsky_admission_memory_budget_bytes", "gauge", "MEMORY_BUDGET_MB.",
+             {(): limit.memory}),
+            ("crowdsky_admission_disk_bytes", "gauge", "Estimated WORK_DIR use of running jobs.",
+             {(): used.disk}),
+            ("crowdsky_admission_disk_budget_bytes", "gauge", "DISK_BUDGET_MB.",
+             {(): limit.disk}),
+            ("crowdsky_admission_held_back_total", "counter", "Jobs that had to wait for budget.",
+             {(): held_back}),
+        ]
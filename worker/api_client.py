@@ -1,83 +1,193 @@
 """
 HTTP client for the CrowdSky PHP worker API.
+
+All calls are coroutines sharing one pooled keep-alive client (see
+``sessions.py``), except ``get_next_job_blocking`` for ``--once``. aiohttp
+is imported on first use, so that claim stays cheap.
 """
 
-from typing import Optional
-import requests
+import json
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
 from . import config
 
+# Bytes read from a download stream at a time
+CHUNK_SIZE = 65536
+
+
+def _session():
+    from .sessions import api_session
+    return api_session()
 
-def _headers() -> dict:
-    return {"Authorization": f"Bearer {config.WORKER_API_KEY}"}
+
+async def _json(method: str, endpoint: str, timeout: float = 30, retry: bool = True, **kwargs):
+    """
+    Call an endpoint and return its JSON body, or None for 204. Pass
+    ``retry=False`` for calls that must not be re-sent (job claims).
+    """
+    resp = await _session().request(
+        method, f"{config.API_BASE_URL}/{endpoint}", timeout=timeout, retry=retry, **kwargs,
+    )
+    async with resp:
+        if resp.status == 204:
+            return None
+        resp.raise_for_status()
+        return await resp.json(content_type=None)
 
 
-def get_next_job() -> Optional[dict]:
+async def get_next_job() -> Optional[dict]:
     """Claim the next pending stacking job. Returns job dict or None."""
-    resp = requests.get(
-        f"{config.API_BASE_URL}/next_job.php",
-        headers=_headers(),
-        params={"worker_id": config.WORKER_ID},
-        timeout=30,
+    # A claim the server made before a timeout or 5xx must not be made again
+    return await _json("GET", "next_job.php", params={"worker_id": config.WORKER_ID}, retry=False)
+
+
+def get_next_job_blocking() -> Optional[dict]:
+    """``get_next_job`` as one blocking standard-library request (no event loop)."""
+    query = urllib.parse.urlencode({"worker_id": config.WORKER_ID})
+    request = urllib.request.Request(
+        f"{config.API_BASE_URL}/next_job.php?{query}",
+        headers={"Authorization": f"Bearer {config.WORKER_API_KEY}"},
     )
-    if resp.status_code == 204:
-        return None
-    resp.raise_for_status()
-    return resp.json()
+    with urllib.request.urlopen(request, timeout=30) as resp:
+        if resp.status == 204:
+            return None
+        return json.load(resp)
+
+
+async def get_next_jobs(n: int, wait: int = 0) -> List[dict]:
+    """
+    Claim up to ``n`` pending stacking jobs in one call.
 
+    With ``wait`` > 0 the server holds the request open (long poll) for up to
+    that many seconds until a job can be claimed.
 
-def get_job_files(job_id: int) -> dict:
+    Returns:
+        A (possibly empty) list of job dicts.
+    """
+    params = {"worker_id": config.WORKER_ID, "limit": n}
+    if wait > 0:
+        params["wait"] = wait
+    body = await _json("GET", "next_job.php", params=params, timeout=30 + wait, retry=False)
+    return body["jobs"] if body else []
+
+
+async def get_job_files(job_id: int) -> dict:
     """Get list of raw file paths for a stacking job."""
-    resp = requests.get(
-        f"{config.API_BASE_URL}/job_files.php",
-        headers=_headers(),
-        params={"job_id": job_id},
-        timeout=30,
-    )
-    resp.raise_for_status()
-    return resp.json()
+    return await _json("GET", "job_files.php", params={"job_id": job_id})
 
 
-def complete_job(job_id: int, metadata: dict) -> dict:
+async def complete_job(job_id: int, metadata: dict) -> dict:
     """Mark a job as completed with stack metadata."""
-    payload = {"job_id": job_id, **metadata}
-    resp = requests.post(
-        f"{config.API_BASE_URL}/complete_job.php",
-        headers=_headers(),
-        json=payload,
-        timeout=30,
+    return await _json(
+        "POST", "complete_job.php",
+        json={"job_id": job_id, "worker_id": config.WORKER_ID, **metadata},
     )
-    resp.raise_for_status()
-    return resp.json()
 
 
-def fail_job(job_id: int, error_message: str) -> dict:
+async def fail_job(job_id: int, error_message: str) -> dict:
     """Mark a job as failed."""
-    resp = requests.post(
-        f"{config.API_BASE_URL}/fail_job.php",
-        headers=_headers(),
-        json={"job_id": job_id, "error_message": error_message},
-        timeout=30,
+    return await _json(
+        "POST", "fail_job.php",
+        json={"job_id": job_id, "worker_id": config.WORKER_ID, "error_message": error_message},
     )
-    resp.raise_for_status()
-    return resp.json()
 
 
-def download_raw_file(file_id: int, local_path: "Path") -> None:
-    """Download a raw FITS file from the PHP webspace via API."""
-    from pathlib import Path
+async def release_job(job_id: int) -> dict:
+    """Hand a claimed job that was never started back to the queue (no attempt counted)."""
+    return await _json(
+        "POST", "fail_job.php",
+        json={"job_id": job_id, "worker_id": config.WORKER_ID, "release": True,
+              "error_message": "Released unstarted at worker shutdown"},
+    )
+
+
+async def heartbeat(progress: Dict[int, dict]) -> List[int]:
+    """
+    Renew the leases of this worker's jobs and report their progress
+    (``{job_id: {"stage", "done", "total"}}``).
+
+    Returns:
+        Ids of jobs that are no longer leased to this worker.
+    """
+    body = await _json("POST", "heartbeat_job.php", json={
+        "worker_id": config.WORKER_ID,
+        "jobs": [{"job_id": job_id, **p} for job_id, p in progress.items()],
+    })
+    return [int(job_id) for job_id in body.get("lost", [])]
 
-    local_path = Path(local_path)
-    local_path.parent.mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(
-        f"{config.API_BASE_URL}/download_raw.php",
-        headers=_headers(),
-        params={"file_id": file_id},
-        stream=True,
-        timeout=300,
+async def get_stack_index(after_id: int, limit: int) -> dict:
+    """
+    Stacked frames with an id above ``after_id`` (at most ``limit``, by id),
+    for the sky index.
+
+    Returns:
+        ``{"stacks": [...], "n_upto": rows with an id up to after_id}``.
+    """
+    return await _json("GET", "stack_index.php", params={"after_id": after_id, "limit": limit})
+
+
+async def _stream_raw_file(file_id: int, write: Callable[[bytes], None]) -> int:
+    resp = await _session().request(
+        "GET", f"{config.API_BASE_URL}/download_raw.php",
+        params={"file_id": file_id}, timeout=300,
     )
-    resp.raise_for_status()
+    n_bytes = 0
+    async with resp:
+        resp.raise_for_status()
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            write(chunk)
+            n_bytes += len(chunk)
+    return n_bytes
+
+
+async def fetch_raw_file(
+    file_id: int,
+    progress: Optional[Callable[[int], None]] = None,
+) -> bytes:
+    """Download a raw FITS file from the PHP webspace into memory."""
+    buf = bytearray()
+
+    def write(chunk: bytes) -> None:
+        buf.extend(chunk)
+        if progress is not None:
+            progress(len(chunk))
+
+    await _stream_raw_file(file_id, write)
+    return bytes(buf)
+
+
+async def download_raw_file(
+    file_id: int,
+    local_path: Path,
+    progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """
+    Download a raw FITS file from the PHP webspace via API.
+
+    The file is written to a ``.part`` sibling and renamed on success, so an
+    interrupted download never leaves a truncated frame at ``local_path``.
+
+    Args:
+        file_id: The ``raw_files.id`` to fetch.
+        local_path: Destination path.
+        progress: Optional callback, called with the size of each chunk written.
+
+    Returns:
+        Number of bytes written.
+    """
+    local_path = Path(local_path)
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = local_path.with_name(local_path.name + ".part")
 
-    with open(local_path, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=65536):
+    with open(part_path, "wb") as f:
+        def write(chunk: bytes) -> None:
             f.write(chunk)
+            if progress is not None:
+                progress(len(chunk))
+
+        n_bytes = await _stream_raw_file(file_id, write)
+    part_path.replace(local_path)
+    return n_bytes
@@ -0,0 +1,630 @@
+"""
+Offline end-to-end benchmark of the worker.
+
+Generates synthetic Seestar-like raw chunks (Bayer mosaics of a star field with
+per-frame drift and field rotation, sky gradient, noise and cosmic-ray hits),
+serves them through local stand-ins for the PHP API (``fakeapi.py``) and
+u:cloud (``localdav.py``), and runs the real worker against them:
+
+    python -m worker.benchmark --jobs 8 --frames 30 --max-workers 2 --output bench.json
+    python -m worker.benchmark ... --compare baseline.json
+
+``--driver daemon`` runs ``daemon.run_daemon()`` until every job has finished;
+``--driver jobs`` awaits ``process_job()`` directly from ``--max-workers``
+tasks. The report (JSON) has jobs/hour, per-stage latency percentiles, peak
+RSS (worker process plus stack pool children) and peak ``WORK_DIR`` usage.
+
+Stages are measured from the outside, from the requests each job makes:
+
+- ``queue``: claim until ``job_files.php`` (includes waiting for a free task)
+- ``download``: first until last raw served
+- ``process``: last raw served until the first u:cloud write for the job
+  (stacking tail and previews; in streaming mode most stacking overlaps the
+  download stage)
+- ``upload``: first u:cloud write until ``complete_job.php``
+- ``total``: claim until ``complete_job.php``
+
+The worker reads its configuration from the environment at import time, so
+this module sets it before importing anything that imports ``config``; run it
+in a fresh process.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+from . import fakeapi, localdav
+
+logger = logging.getLogger("crowdsky.benchmark")
+
+# Seestar S50 frame size (portrait) and defaults for a synthetic chunk
+FRAME_SHAPE = (1920, 1080)
+EXPTIME = 10.0
+N_STARS = 400
+SKY_LEVEL = 1200.0
+READ_NOISE = 8.0
+# Star PSF sigma in pixels and stamp half-width
+PSF_SIGMA = 1.6
+_STAMP = 4
+# Bayer channel (0=R, 1=G, 2=B) of each pixel in a GRBG 2x2 cell
+_GRBG = np.array([[1, 0], [2, 1]])
+
+STAGES = ("queue", "download", "process", "upload", "total")
+# Report fields compared by --compare, and whether higher is better
+COMPARED = {
+    "jobs_per_hour": True,
+    "peak_rss_mb": False,
+    "peak_work_dir_mb": False,
+    "once_p50_ms": False,
+    "once_cpu_p50_ms": False,
+}
+# Packages an empty --once poll must not import
+HEAVY_IMPORTS = ("numpy", "astropy", "seestarpy", "cv2", "PIL", "aiohttp")
+
+
+# -- synthetic data ------------------------------------------------------
+
+def chunk_key(t: datetime, ra: float, dec: float) -> str:
+    """Same format as computeChunkKey() in web/fits_utils.php."""
+    index = (t.hour * 3600 + t.minute * 60 + t.second) // 900
+    sign = "+" if dec >= 0 else "-"
+    return f"{t:%Y%m%d}.{index:02d}_{round(ra, 1):.1f}_{sign}{abs(round(dec, 1)):.1f}"
+
+
+def render_frame(
+    rng: np.random.Generator,
+    shape: Tuple[int, int],
+    stars: np.ndarray,
+    angle: float,
+    shift: Tuple[float, float],
+) -> np.ndarray:
+    """
+    Render one GRBG Bayer mosaic (uint16) of ``stars`` rotated by ``angle``
+    (radians) about the frame centre and shifted by ``shift`` (dx, dy) pixels.
+
+    ``stars`` has columns x, y, flux, r, g, b (colour weights).
+    """
+    h, w = shape
+    cy, cx = (h - 1) / 2, (w - 1) / 2
+    cos, sin = np.cos(angle), np.sin(angle)
+    x = cx + cos * (stars[:, 0] - cx) - sin * (stars[:, 1] - cy) + shift[0]
+    y = cy + sin * (stars[:, 0] - cx) + cos * (stars[:, 1] - cy) + shift[1]
+
+    yy, xx = np.mgrid[-h // 2:h - h // 2, -w // 2:w - w // 2].astype(np.float32)
+    image = SKY_LEVEL * (1 + 0.15 * (yy / h) + 0.05 * (xx / w))
+
+    offsets = np.arange(-_STAMP, _STAMP + 1)
+    px = np.round(x).astype(int)[:, None, None] + offsets[None, None, :]
+    py = np.round(y).astype(int)[:, None, None] + offsets[None, :, None]
+    px, py = np.broadcast_arrays(px, py)
+    r2 = (px - x[:, None, None]) ** 2 + (py - y[:, None, None]) ** 2
+    values = stars[:, 2, None, None] / (2 * np.pi * PSF_SIGMA ** 2) * np.exp(-r2 / (2 * PSF_SIGMA ** 2))
+    inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+    px, py, values = px[inside], py[inside], values[inside]
+    star_index = np.nonzero(inside)[0]
+    values = values * stars[star_index, 3 + _GRBG[py % 2, px % 2]]
+    np.add.at(image, (py, px), values)
+
+    image += rng.normal(0, 1, image.shape).astype(np.float32) * np.sqrt(image + READ_NOISE ** 2)
+
+    # A few cosmic-ray hits for the outlier rejection to remove
+    n_hits = rng.integers(5, 20)
+    image[rng.integers(0, h, n_hits), rng.integers(0, w, n_hits)] += rng.uniform(5e3, 3e4, n_hits)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def synth_chunk(
+    out_dir: Path,
+    rng: np.random.Generator,
+    first_file_id: int,
+    n_frames: int,
+    start: datetime,
+    ra: float,
+    dec: float,
+    object_name: str,
+    shape: Tuple[int, int] = FRAME_SHAPE,
+    drift: Tuple[float, float] = (0.4, -0.25),
+    rotation_deg: float = 0.01,
+) -> List[fakeapi.FakeFile]:
+    """
+    Write ``n_frames`` raw FITS frames of one pointing, ``EXPTIME`` apart.
+
+    ``drift`` (pixels) and ``rotation_deg`` accumulate per frame, like an
+    alt-az mount tracking with field rotation.
+    """
+    h, w = shape
+    stars = np.column_stack([
+        rng.uniform(0, w, N_STARS),
+        rng.uniform(0, h, N_STARS),
+        2e3 * rng.pareto(1.5, N_STARS) + 500,
+        rng.uniform(0.6, 1.0, N_STARS),
+        np.ones(N_STARS),
+        rng.uniform(0.5, 1.0, N_STARS),
+    ])
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(n_frames):
+        t = start + timedelta(seconds=i * EXPTIME)
+        data = render_frame(
+            rng, shape, stars, np.radians(rotation_deg * i), (drift[0] * i, drift[1] * i)
+        )
+        header = fits.Header()
+        header["DATE-OBS"] = t.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        header["EXPTIME"] = EXPTIME
+        header["RA"] = ra
+        header["DEC"] = dec
+        header["OBJECT"] = object_name
+        header["BAYERPAT"] = "GRBG"
+        header["INSTRUME"] = "Seestar S50"
+        path = out_dir / f"Light_{object_name}_{EXPTIME:g}s_IRCUT_{t:%Y%m%d-%H%M%S}.fit"
+        fits.PrimaryHDU(data, header=header).writeto(path, overwrite=True)
+        files.append(fakeapi.FakeFile(
+            id=first_file_id + i,
+            path=path,
+            date_obs=t.strftime("%Y-%m-%d %H:%M:%S"),
+            exptime=EXPTIME,
+            ra=ra,
+            dec=dec,
+        ))
+    return files
+
+
+def make_jobs(
+    data_dir: Path,
+    n_jobs: int,
+    n_frames: int,
+    shape: Tuple[int, int],
+    cadences: Sequence[int],
+    seed: int,
+) -> List[fakeapi.FakeJob]:
+    """One job per synthetic 15-minute chunk, each on its own pointing."""
+    rng = np.random.default_rng(seed)
+    start = datetime(2025, 1, 15, 19, 30, tzinfo=timezone.utc)
+    jobs = []
+    for j in range(n_jobs):
+        t = start + timedelta(minutes=15 * j)
+        ra, dec = float(rng.uniform(0, 360)), float(rng.uniform(-30, 80))
+        name = f"BENCH{j + 1:03d}"
+        files = synth_chunk(
+            data_dir / name, rng, 1000 * (j + 1), n_frames, t, ra, dec, name, shape
+        )
+        jobs.append(fakeapi.FakeJob(
+            job_id=j + 1,
+            chunk_key=chunk_key(t, ra, dec),
+            object_name=name,
+            files=files,
+            cadences=list(cadences),
+        ))
+    return jobs
+
+
+# -- measurement ---------------------------------------------------------
+
+class _Sampler:
+    """Samples RSS (worker + pool children) and WORK_DIR usage in the background."""
+
+    def __init__(self, work_dir: Path, interval: float = 0.25):
+        self.work_dir = work_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        try:
+            import psutil
+            self._process = psutil.Process()
+        except ImportError:
+            self._process = None
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def _rss(self) -> int:
+        if self._process is None:
+            return 0
+        total = 0
+        for p in [self._process] + self._process.children(recursive=True):
+            try:
+                total += p.memory_info().rss
+            except Exception:
+                pass
+        return total
+
+    def _disk(self) -> int:
+        total = 0
+        for root, _, names in os.walk(self.work_dir):
+            for name in names:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._rss())
+            self.peak_disk = max(self.peak_disk, self._disk())
+
+    def __enter__(self) -> "_Sampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def rss_source(self) -> str:
+        return "psutil" if self._process is not None else "getrusage"
+
+    def peak_rss_mb(self) -> float:
+        if self._process is not None:
+            return self.peak_rss / 1e6
+        # ru_maxrss is in KiB on Linux; children only count once they have exited
+        self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return (self_kb + children_kb) * 1024 / 1e6
+
+
+def _percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    a = np.asarray(values)
+    p50, p90, p99 = np.percentile(a, [50, 90, 99])
+    return {
+        "n": len(values),
+        "mean": float(a.mean()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(a.max()),
+    }
+
+
+def _stack_prefix(job: fakeapi.FakeJob) -> str:
+    return f"stack_{job.chunk_key}_{job.job_id}"
+
+
+def job_stages(job: fakeapi.FakeJob, writes: List[Tuple[float, str, str, Optional[str]]]) -> dict:
+    """Stage durations (seconds) of a job's last attempt, from API and DAV events."""
+    prefix = _stack_prefix(job)
+    upload_start = None
+    for t, _, path, destination in writes:
+        name = (destination or path).rsplit("/", 1)[-1]
+        if (
+            name.startswith(prefix) and name[len(prefix):len(prefix) + 1] in ("", ".", "_")
+            and t >= (job.last_download_at or job.claimed_at)
+        ):
+            upload_start = t if upload_start is None else min(upload_start, t)
+
+    def span(a, b):
+        return b - a if a is not None and b is not None else None
+
+    return {
+        "queue": span(job.claimed_at, job.files_at),
+        "download": span(job.first_download_at, job.last_download_at),
+        "process": span(job.last_download_at, upload_start),
+        "upload": span(upload_start, job.finished_at),
+        "total": span(job.claimed_at, job.finished_at),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, timeout=10,
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# -- driving the worker --------------------------------------------------
+
+def _configure(args, api: fakeapi.FakeAPIServer, dav: localdav.LocalDAVServer, tmp: Path) -> None:
+    """Point the worker config at the local stand-ins (before ``config`` is imported)."""
+    if f"{__package__}.config" in sys.modules:
+        raise RuntimeError("worker.config was imported before the benchmark configured it")
+    (dav.root / "share").mkdir(parents=True, exist_ok=True)
+    (dav.root / "uploads" / "bench").mkdir(parents=True, exist_ok=True)
+    os.environ.update({
+        "API_BASE_URL": api.url,
+        "WORKER_API_KEY": "bench",
+        "UCLOUD_WEBDAV_URL": f"{dav.url}/share",
+        "UCLOUD_SHARE_TOKEN": "bench",
+        "UCLOUD_BASE_PATH": "/crowdsky",
+        "UCLOUD_UPLOADS_URL": f"{dav.url}/uploads/bench" if args.chunked else "",
+        "UCLOUD_FILES_URL": f"{dav.url}/share" if args.chunked else "",
+        "WORKER_ID": "bench",
+        "WORK_DIR": str(tmp / "work"),
+        "CACHE_DIR": str(tmp / "cache"),
+        "CACHE_MAX_MB": str(args.cache_mb),
+        "MAX_WORKERS": str(args.max_workers),
+        "PREFETCH_JOBS": str(args.prefetch),
+        "STACK_PROCESSES": str(args.stack_processes),
+        "STACK_MODE": args.mode,
+        "DOWNLOAD_CONCURRENCY": str(args.download_concurrency),
+        "POLL_INTERVAL": "1",
+        "POLL_INTERVAL_MIN": "0.2",
+        "LONG_POLL": "1",
+        "METRICS_PORT": "0",
+        "TRACE_DIR": str(tmp / "traces"),
+    })
+
+
+def _drive_daemon(api: fakeapi.FakeAPIServer) -> None:
+    from .daemon import run_daemon
+
+    stop = threading.Event()
+    threading.Thread(target=lambda: (api.wait_done(), stop.set()), daemon=True).start()
+    run_daemon(stop)
+
+
+def _drive_jobs(api: fakeapi.FakeAPIServer, n_tasks: int, n_procs: int) -> None:
+    import asyncio
+    import contextlib
+    from . import sessions
+    from .api_client import get_next_job
+    from .executor import StackPool
+    from .job_processor import process_job
+
+    async def loop(stack_pool):
+        while True:
+            job = await get_next_job()
+            if job is None:
+                if await asyncio.to_thread(api.wait_done, timeout=0.2):
+                    return
+                continue
+            await process_job(job, stack_pool)
+
+    async def drive(stack_pool):
+        try:
+            await asyncio.gather(*(loop(stack_pool) for _ in range(n_tasks)))
+        finally:
+            await sessions.close()
+
+    with (StackPool(n_procs) if n_procs > 0 else contextlib.nullcontext()) as stack_pool:
+        asyncio.run(drive(stack_pool))
+
+
+def _top_level_imports(importtime: str) -> List[Tuple[str, float]]:
+    """``(module, cumulative ms)`` of the imports a ``-X importtime`` log starts from the top."""
+    imports = []
+    for line in importtime.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if len(name) - len(name.lstrip()) == 1:
+            imports.append((name.strip(), int(parts[1]) / 1000))
+    return imports
+
+
+def run_startup(args) -> dict:
+    """
+    Cost of ``python -m worker --once`` when there is no job (the usual cron
+    run): wall and CPU time of ``args.startup`` fresh processes against a fake
+    API with an empty queue, and what they import.
+    """
+    tmp = Path(tempfile.mkdtemp(prefix="crowdsky-bench-"))
+    try:
+        api = fakeapi.serve([])
+        dav = localdav.serve(tmp / "dav")
+        _configure(args, api, dav, tmp)
+
+        walls, cpus = [], []
+        for _ in range(args.startup):
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            started = time.monotonic()
+            out = subprocess.run(
+                [sys.executable, "-X", "importtime", "-m", __package__, "--once"],
+                cwd=Path(__file__).resolve().parent.parent,
+                capture_output=True, text=True, timeout=120,
+            )
+            walls.append(time.monotonic() - started)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpus.append(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime)
+            if out.returncode != 1:
+                raise RuntimeError(f"--once exited with {out.returncode}: {out.stderr[-2000:]}")
+        api.shutdown()
+        dav.shutdown()
+
+        imported = {
+            line.split("|")[2].strip() for line in out.stderr.splitlines()
+            if line.startswith("import time:") and line.count("|") == 2
+        }
+        imports = sorted(_top_level_imports(out.stderr), key=lambda i: -i[1])
+        return {
+            "version": 1,
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "params": {"startup": args.startup, "python": sys.version.split()[0]},
+            "results": {
+                "once_p50_ms": float(np.median(walls)) * 1000,
+                "once_cpu_p50_ms": float(np.median(cpus)) * 1000,
+            },
+            "stages": {"once": _percentiles(walls), "once_cpu": _percentiles(cpus)},
+            "heavy_imports": sorted(h for h in HEAVY_IMPORTS if h in imported),
+            "slowest_imports_ms": dict(imports[:10]),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def run_benchmark(args) -> dict:
+    tmp = Path(tempfile.mkdtemp(prefix="crowdsky-bench-"))
+    try:
+        t0 = time.monotonic()
+        shape = tuple(args.shape)
+        jobs = make_jobs(tmp / "raws", args.jobs, args.frames, shape, args.cadences, args.seed)
+        generate_s = time.monotonic() - t0
+        logger.info(f"Generated {args.jobs} x {args.frames} frames in {generate_s:.1f}s")
+
+        api = fakeapi.serve(jobs)
+        dav = localdav.serve(tmp / "dav", fail_rate=args.fail_rate)
+        writes = []
+        dav.on_write = lambda method, path, dest: writes.append((time.monotonic(), method, path, dest))
+        _configure(args, api, dav, tmp)
+
+        from .executor import stack_processes
+        n_procs = stack_processes()
+        logging.getLogger().setLevel(args.log_level)
+
+        with _Sampler(tmp / "work") as sampler:
+            started = time.monotonic()
+            if args.driver == "daemon":
+                _drive_daemon(api)
+            else:
+                _drive_jobs(api, args.max_workers, n_procs)
+            wall = time.monotonic() - started
+
+        api.shutdown()
+        dav.shutdown()
+
+        per_job = []
+        for job in jobs:
+            per_job.append({
+                "job_id": job.job_id,
+                "status": job.status,
+                "attempts": job.attempts,
+                "error": job.error,
+                "bytes_in": job.bytes_served,
+                **job_stages(job, writes),
+            })
+        done = [j for j in per_job if j["status"] == "completed"]
+        uploaded = sum(p.stat().st_size for p in (dav.root / "share").rglob("*") if p.is_file())
+
+        return {
+            "version": 1,
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "params": {
+                "driver": args.driver,
+                "mode": args.mode,
+                "jobs": args.jobs,
+                "frames": args.frames,
+                "shape": list(shape),
+                "cadences": list(args.cadences),
+                "max_workers": args.max_workers,
+                "prefetch": args.prefetch,
+                "stack_processes": n_procs,
+                "download_concurrency": args.download_concurrency,
+                "chunked": args.chunked,
+                "cache_mb": args.cache_mb,
+                "fail_rate": args.fail_rate,
+                "seed": args.seed,
+                "cpus": os.cpu_count(),
+            },
+            "results": {
+                "wall_s": wall,
+                "generate_s": generate_s,
+                "n_completed": len(done),
+                "n_failed": sum(j["status"] == "failed" for j in per_job),
+                "jobs_per_hour": len(done) / wall * 3600 if wall > 0 else 0.0,
+                "frames_per_s": len(done) * args.frames / wall if wall > 0 else 0.0,
+                "bytes_in": sum(j["bytes_in"] for j in per_job),
+                "bytes_out": uploaded,
+                "peak_rss_mb": sampler.peak_rss_mb(),
+                "rss_source": sampler.rss_source,
+                "peak_work_dir_mb": sampler.peak_disk / 1e6,
+            },
+            "stages": {
+                stage: _percentiles([j[stage] for j in done if j[stage] is not None])
+                for stage in STAGES
+            },
+            "jobs": per_job,
+        }
+    finally:
+        if args.keep:
+            logger.info(f"Kept benchmark files in {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Compare ``report`` with ``baseline``; returns the regressions beyond
+    ``tolerance`` (a fraction) and prints every compared metric.
+    """
+    regressions = []
+    rows = [(name, report["results"][name], baseline["results"][name], higher)
+            for name, higher in COMPARED.items()
+            if name in report["results"] and name in baseline["results"]]
+    for stage in STAGES:
+        new, old = report["stages"].get(stage), baseline["stages"].get(stage)
+        if new and old:
+            rows.append((f"{stage}_p50_s", new["p50"], old["p50"], False))
+            rows.append((f"{stage}_p90_s", new["p90"], old["p90"], False))
+
+    print(f"{'metric':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, new, old, higher in rows:
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        print(f"{name:<20}{old:>12.2f}{new:>12.2f}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end worker benchmark")
+    parser.add_argument("--jobs", type=int, default=8, help="Number of chunks (jobs)")
+    parser.add_argument("--frames", type=int, default=30, help="Frames per chunk")
+    parser.add_argument("--shape", type=int, nargs=2, default=FRAME_SHAPE, metavar=("H", "W"),
+                        help="Frame size in pixels")
+    parser.add_argument("--cadences", type=int, nargs="+", default=[15],
+                        help="Cadences per job in minutes, e.g. 15 3 1")
+    parser.add_argument("--driver", choices=("daemon", "jobs"), default="daemon")
+    parser.add_argument("--mode", choices=("disk", "streaming"), default="streaming",
+                        help="STACK_MODE")
+    parser.add_argument("--max-workers", type=int, default=2)
+    parser.add_argument("--prefetch", type=int, default=1)
+    parser.add_argument("--stack-processes", default="auto")
+    parser.add_argument("--download-concurrency", type=int, default=8)
+    parser.add_argument("--chunked", action="store_true",
+                        help="Upload through Nextcloud chunked upload v2")
+    parser.add_argument("--cache-mb", type=int, default=0, help="CACHE_MAX_MB (0 = no cache)")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Fraction of WebDAV PUT/MOVE requests answered with 503")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", type=Path, help="Baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative change counted as a regression by --compare")
+    parser.add_argument("--keep", action="store_true", help="Keep generated and uploaded files")
+    parser.add_argument("--log-level", default="WARNING", help="Log level for the worker")
+    parser.add_argument("--startup", type=int, default=0, metavar="N",
+                        help="Instead of processing jobs, time N empty --once polls (startup cost)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    logger.setLevel(logging.INFO)
+    report = run_startup(args) if args.startup else run_benchmark(args)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        regressions = compare(report, json.loads(args.compare.read_text()), args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Size-bounded local cache for raws and per-frame intermediates.
+
+When a job is retried (or re-stacked), its raws and per-frame work are usually
+still here instead of being fetched and recomputed:
+
+- ``raw-{file_id}-{size}`` — downloaded raw FITS files, keyed by their
+  immutable webspace id and size
+- ``stars-{sha1}`` — alignment control points of a frame, keyed by the SHA1
+  of its raw bytes
+- ``xform-{sha1}-{ref_sha1}`` — affine transform of a frame onto a reference
+
+Entries are files under ``CACHE_DIR``, evicted least-recently-used first once
+the total exceeds ``CACHE_MAX_MB``. The index lives in memory (rebuilt from
+file mtimes at start-up), so a cache directory belongs to one worker process.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def raw_key(file_info: dict) -> str:
+    """Cache key for a raw file dict from ``get_job_files``."""
+    return f"raw-{int(file_info['id'])}-{int(file_info.get('file_size_bytes') or 0)}"
+
+
+def content_key(data: bytes) -> str:
+    """Content address of a raw frame, for its intermediates."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe file cache with LRU eviction and a byte quota."""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._scan()
+
+    def _scan(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        for path in self.root.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                path.unlink(missing_ok=True)
+                continue
+            st = path.stat()
+            found.append((st.st_mtime, path.name, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+        if found:
+            logger.info(f"Cache {self.root}: {len(self._entries)} entries, {self._size / 1e6:.0f} MB")
+
+    def _path(self, key: str) -> Path:
+        shard = hashlib.sha1(key.encode()).hexdigest()[:2]
+        return self.root / shard / key
+
+    def _touch(self, key: str) -> Optional[Path]:
+        """Mark ``key`` as used and return its path, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._drop(key)
+            return None
+        return path
+
+    def _drop(self, key: str) -> None:
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._size -= size
+
+    def _write(self, key: str, write) -> None:
+        """
+        Create ``key`` by calling ``write(tmp_path)``. The cache is best effort:
+        write errors (e.g. disk full) are logged, never raised.
+        """
+        tmp = None
+        try:
+            tmp = self._tmp(key)
+            write(tmp)
+            self._admit(key, tmp)
+        except OSError as e:
+            logger.warning(f"Cache: could not store {key}: {e}")
+            if tmp is not None:
+                tmp.unlink(missing_ok=True)
+
+    def _admit(self, key: str, tmp: Path) -> None:
+        """Move a fully written temp file into place and account for it."""
+        size = tmp.stat().st_size
+        if size > self.max_bytes:
+            tmp.unlink(missing_ok=True)
+            return
+        tmp.replace(self._path(key))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old
+            self._entries[key] = size
+            self._size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        # Caller holds the lock (or is the constructor)
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self._path(key).unlink(missing_ok=True)
+
+    def _tmp(self, key: str) -> Path:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.with_name(f"{key}.{uuid.uuid4().hex[:8]}.tmp")
+
+    # -- public API ------------------------------------------------------
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        path = self._touch(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            self._drop(key)
+            return None
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        self._write(key, lambda tmp: tmp.write_bytes(data))
+
+    def copy_to(self, key: str, dest: Path) -> bool:
+        """Hard-link (or copy) a cached file to ``dest``. Returns False on a miss."""
+        path = self._touch(key)
+        if path is None:
+            return False
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.unlink(missing_ok=True)
+        try:
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+        except FileNotFoundError:
+            self._drop(key)
+            return False
+        return True
+
+    def put_file(self, key: str, src: Path) -> None:
+        """Add a copy of ``src`` (hard-linked when possible)."""
+        def write(tmp: Path) -> None:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+
+        self._write(key, write)
+
+    def get_arrays(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        data = self.get_bytes(key)
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data)) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def put_arrays(self, key: str, **arrays: np.ndarray) -> None:
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        self.put_bytes(key, buf.getvalue())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_cache: Optional[LRUCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[LRUCache]:
+    """The process-wide cache, or None if ``CACHE_MAX_MB`` is 0."""
+    global _cache
+    if config.CACHE_MAX_MB <= 0:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(config.CACHE_DIR, config.CACHE_MAX_MB * 1024 * 1024)
+    return _cache
@@ -0,0 +1,288 @@
+"""
+Resumable, parallel uploads to Nextcloud (u:cloud) WebDAV.
+
+Large files use Nextcloud's chunked upload v2 protocol:
+
+1. ``MKCOL {uploads_url}/{transfer_id}`` with a ``Destination`` header
+2. ``PUT {uploads_url}/{transfer_id}/00001`` ... in parallel
+3. ``MOVE {uploads_url}/{transfer_id}/.file`` to the destination, which
+   assembles the chunks server-side
+
+The transfer id is derived from the destination, size and mtime of the file,
+so a retried upload finds its earlier chunks (via PROPFIND) and only sends the
+missing ones. After the final MOVE the remote size (and checksum, if the server
+reports one) is compared with the local file.
+
+This module takes explicit URLs and sessions and does not read the worker
+config, so ``upload.py`` can use it as well. Its uploads are blocking
+(``requests``); the worker's asyncio uploads in ``webdav.py`` share the
+protocol helpers (``chunk_layout``, ``transfer_id``, ``resumable_chunks``,
+``parse_propfind``, ``check_remote``).
+"""
+
+import hashlib
+import logging
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import unquote, urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Nextcloud rejects chunks below 5 MB (except the last) and more than 10000 chunks
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_CHUNKS = 10000
+# Seconds before the first retry; doubled on every further attempt
+RETRY_BACKOFF = 1.0
+
+PROPFIND_BODY = (
+    '<?xml version="1.0"?>'
+    '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">'
+    "<d:prop><d:getcontentlength/><oc:checksums/></d:prop>"
+    "</d:propfind>"
+)
+_NS = {"d": "DAV:", "oc": "http://owncloud.org/ns"}
+
+
+@dataclass
+class UploadReport:
+    n_bytes: int = 0
+    n_chunks: int = 0
+    n_chunks_resumed: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.n_bytes / 1e6 / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def _retrying(fn, retries: int, what: str):
+    """Call ``fn()``, retrying connection errors and 5xx/429 with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if getattr(e, "response", None) is not None else None
+            if attempt >= retries or (status is not None and status < 500 and status != 429):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            attempt += 1
+            logger.warning(f"{what} failed ({e}), retry {attempt}/{retries} in {delay:.0f}s")
+            time.sleep(delay)
+
+
+def sha1_file(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_propfind(content: bytes) -> Dict[str, dict]:
+    """``{path: {"size": int|None, "checksums": str}}`` from a PROPFIND response body."""
+    entries = {}
+    for response in ET.fromstring(content).findall("d:response", _NS):
+        href = unquote(urlparse(response.findtext("d:href", "", _NS)).path).rstrip("/")
+        length = response.findtext(".//d:getcontentlength", None, _NS)
+        checksums = response.findtext(".//oc:checksums/oc:checksum", "", _NS)
+        entries[href] = {
+            "size": int(length) if length else None,
+            "checksums": checksums or "",
+        }
+    return entries
+
+
+def propfind(session: requests.Session, url: str, depth: int = 0) -> Dict[str, dict]:
+    """
+    PROPFIND ``url`` and return ``{path: {"size": int|None, "checksums": str}}``.
+
+    Returns an empty dict if the resource does not exist.
+    """
+    resp = session.request(
+        "PROPFIND", url, data=PROPFIND_BODY,
+        headers={"Depth": str(depth), "Content-Type": "application/xml"}, timeout=30,
+    )
+    if resp.status_code == 404:
+        return {}
+    resp.raise_for_status()
+    return parse_propfind(resp.content)
+
+
+def check_remote(entries: Dict[str, dict], url: str, size: int, sha1: Optional[str] = None) -> None:
+    """
+    Check PROPFIND ``entries`` of an uploaded file against the expected size,
+    and the expected SHA1 if the server reports checksums. Raises
+    RuntimeError on mismatch.
+    """
+    if not entries:
+        raise RuntimeError(f"Upload verification failed: {url} does not exist")
+    remote = next(iter(entries.values()))
+    if remote["size"] is not None and remote["size"] != size:
+        raise RuntimeError(
+            f"Upload verification failed: {url} is {remote['size']} bytes, expected {size}"
+        )
+    if sha1:
+        for checksum in remote["checksums"].split():
+            algo, _, value = checksum.partition(":")
+            if algo.upper() == "SHA1" and value.lower() != sha1:
+                raise RuntimeError(f"Upload verification failed: SHA1 mismatch for {url}")
+
+
+def verify_remote(
+    session: requests.Session,
+    url: str,
+    size: int,
+    sha1: Optional[str] = None,
+) -> None:
+    """
+    Check that the remote file has the expected size, and the expected SHA1 if
+    the server reports checksums. Raises RuntimeError on mismatch.
+    """
+    check_remote(propfind(session, url), url, size, sha1)
+
+
+def put_file(
+    session: requests.Session,
+    url: str,
+    local_path: Path,
+    retries: int = 3,
+    verify: bool = True,
+) -> UploadReport:
+    """Upload a file in a single PUT, retrying transient failures."""
+    local_path = Path(local_path)
+    size = local_path.stat().st_size
+    start = time.monotonic()
+
+    def put():
+        with open(local_path, "rb") as f:
+            resp = session.put(url, data=f, timeout=300)
+        resp.raise_for_status()
+
+    _retrying(put, retries, f"PUT {local_path.name}")
+    if verify:
+        verify_remote(session, url, size)
+    return UploadReport(n_bytes=size, n_chunks=1, elapsed=time.monotonic() - start)
+
+
+def transfer_id(destination: str, local_path: Path) -> str:
+    """Stable id for one (destination, file version) pair, so retries can resume."""
+    st = Path(local_path).stat()
+    key = f"{destination}|{st.st_size}|{st.st_mtime_ns}"
+    return "crowdsky-" + hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def chunk_layout(size: int, chunk_size: int) -> Tuple[int, int]:
+    """Chunk size (within the protocol limits) and number of chunks for a file."""
+    chunk_size = max(chunk_size, MIN_CHUNK_SIZE, -(-size // MAX_CHUNKS))
+    return chunk_size, max(1, -(-size // chunk_size))
+
+
+def resumable_chunks(existing: Dict[str, dict], size: int, chunk_size: int, n_chunks: int) -> Set[str]:
+    """Names of chunks from ``propfind`` of a transfer that are complete and need not be sent again."""
+    done = set()
+    for path, entry in existing.items():
+        name = path.rsplit("/", 1)[-1]
+        if not name.isdigit() or not 1 <= int(name) <= n_chunks:
+            continue
+        expected = min(chunk_size, size - (int(name) - 1) * chunk_size)
+        if entry["size"] == expected:
+            done.add(name)
+    return done
+
+
+def upload_chunked(
+    session: requests.Session,
+    uploads_url: str,
+    destination_url: str,
+    local_path: Path,
+    chunk_size: int = 10 * 1024 * 1024,
+    parallel: int = 4,
+    retries: int = 3,
+    verify: bool = True,
+) -> UploadReport:
+    """
+    Upload a file with Nextcloud chunked upload v2, resuming earlier attempts.
+
+    Args:
+        session: Session authenticated for both ``uploads_url`` and
+            ``destination_url``.
+        uploads_url: The user's chunk upload collection, e.g.
+            ``https://host/remote.php/dav/uploads/USER``.
+        destination_url: Full URL of the target file under
+            ``https://host/remote.php/dav/files/USER/...``.
+        local_path: File to upload.
+        chunk_size: Bytes per chunk (raised to the protocol minimum if needed).
+        parallel: Chunk PUTs in flight at once.
+        retries: Retries per request for connection errors and 5xx.
+        verify: Check size/checksum of the assembled file afterwards.
+
+    Returns:
+        UploadReport (``n_chunks_resumed`` counts chunks found from a previous
+        attempt and not sent again).
+    """
+    local_path = Path(local_path)
+    size = local_path.stat().st_size
+    chunk_size, n_chunks = chunk_layout(size, chunk_size)
+    sha1 = sha1_file(local_path)
+    start = time.monotonic()
+
+    transfer_url = f"{uploads_url.rstrip('/')}/{transfer_id(destination_url, local_path)}"
+    headers = {"Destination": destination_url, "OC-Total-Length": str(size)}
+
+    # Find chunks left over from an earlier attempt
+    existing = propfind(session, transfer_url, depth=1)
+    if not existing:
+        def mkcol():
+            resp = session.request("MKCOL", transfer_url, headers=headers, timeout=30)
+            if resp.status_code not in (201, 405):
+                resp.raise_for_status()
+        _retrying(mkcol, retries, f"MKCOL {transfer_url}")
+    done = resumable_chunks(existing, size, chunk_size, n_chunks)
+
+    def put_chunk(index: int) -> None:
+        name = f"{index + 1:05d}"
+        if name in done:
+            return
+        with open(local_path, "rb") as f:
+            f.seek(index * chunk_size)
+            data = f.read(chunk_size)
+
+        def put():
+            resp = session.put(f"{transfer_url}/{name}", data=data, headers=headers, timeout=300)
+            resp.raise_for_status()
+
+        _retrying(put, retries, f"chunk {name} of {local_path.name}")
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="chunk") as pool:
+        list(pool.map(put_chunk, range(n_chunks)))
+
+    def assemble():
+        resp = session.request(
+            "MOVE", f"{transfer_url}/.file",
+            headers={
+                **headers,
+                "OC-Checksum": f"SHA1:{sha1}",
+                "X-OC-Mtime": str(int(local_path.stat().st_mtime)),
+                "Overwrite": "T",
+            },
+            timeout=600,
+        )
+        resp.raise_for_status()
+
+    _retrying(assemble, retries, f"MOVE {local_path.name}")
+    if verify:
+        verify_remote(session, destination_url, size, sha1)
+
+    return UploadReport(
+        n_bytes=size,
+        n_chunks=n_chunks,
+        n_chunks_resumed=len(done),
+        elapsed=time.monotonic() - start,
+    )
@@ -0,0 +1,137 @@
+"""
+Tile-compressed FITS output for stacks.
+
+Stacks are written as uncompressed float32 FITS; their size is what is
+uploaded to u:cloud and what counts against a user's ``storage_limit_mb``.
+``compress_stack`` rewrites a stack with its image and footprint as
+``CompImageHDU`` extensions (FITS tile compression, as made by ``fpack``),
+after an empty primary HDU since the primary HDU cannot be compressed.
+astropy, fitsio, DS9 and Siril read these files transparently;
+``image_hdu`` finds the image in either layout.
+
+Float images are either quantized (RICE_1, ``quantize_level`` steps per
+background sigma, subtractive dithering seeded from the data so reruns give
+identical files) or stored losslessly (GZIP_2 with ``quantize_level=0``).
+Tiles are 16 full rows of one colour channel. The footprint is integer and
+always lossless.
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from astropy.io import fits
+
+from . import config
+
+ALGORITHMS = ("RICE_1", "GZIP_1", "GZIP_2")
+# Rows per compression tile (each tile holds one colour channel)
+TILE_ROWS = 16
+
+
+@dataclass(frozen=True)
+class Compression:
+    # "none" or one of ALGORITHMS
+    algorithm: str = "none"
+    # Quantization steps per background sigma (cfitsio convention); larger is
+    # closer to lossless, 0 = lossless (GZIP only), negative = absolute step
+    quantize_level: float = 16.0
+
+    def __post_init__(self):
+        if self.algorithm != "none" and self.algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown compression {self.algorithm!r}")
+        if self.algorithm == "RICE_1" and self.quantize_level == 0:
+            raise ValueError("RICE_1 cannot store float images losslessly; use GZIP_2")
+
+    @property
+    def enabled(self) -> bool:
+        return self.algorithm != "none"
+
+    @property
+    def label(self) -> str:
+        """E.g. ``RICE_1/q16`` or ``GZIP_2/lossless``, as reported to the API."""
+        if not self.enabled:
+            return "none"
+        if self.quantize_level == 0:
+            return f"{self.algorithm}/lossless"
+        return f"{self.algorithm}/q{self.quantize_level:g}"
+
+
+def job_compression(job: dict) -> Compression:
+    """
+    Compression for a job: ``compression`` from the API (per user tier,
+    ``{"type": "RICE_1", "quantize": 16}``), else ``STACK_COMPRESSION``.
+    """
+    spec = job.get("compression")
+    if spec:
+        return Compression(
+            str(spec.get("type", "none")),
+            float(spec.get("quantize", config.COMPRESSION_QUANTIZE)),
+        )
+    return Compression(config.STACK_COMPRESSION, config.COMPRESSION_QUANTIZE)
+
+
+@dataclass
+class CompressionReport:
+    compression: str
+    bytes_before: int
+    bytes_after: int
+    elapsed: float
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_after / self.bytes_before if self.bytes_before else 1.0
+
+
+def image_hdu(hdul: fits.HDUList):
+    """The stack's image HDU: the primary HDU, or the first extension if compressed."""
+    if hdul[0].data is None and len(hdul) > 1:
+        return hdul[1]
+    return hdul[0]
+
+
+def _compressed(hdu, compression: Compression, name: Optional[str] = None) -> fits.CompImageHDU:
+    data = hdu.data
+    tile_shape = (min(TILE_ROWS, data.shape[0]),) + data.shape[1:]
+    if data.ndim == 3:
+        tile_shape = tile_shape[:2] + (1,)
+    kwargs = {}
+    if data.dtype.kind == "f":
+        kwargs = dict(
+            quantize_level=compression.quantize_level,
+            quantize_method=fits.hdu.compressed.SUBTRACTIVE_DITHER_2,
+            dither_seed=fits.hdu.compressed.DITHER_SEED_CHECKSUM,
+        )
+    return fits.CompImageHDU(
+        data, header=hdu.header, name=name, compression_type=compression.algorithm,
+        tile_shape=tile_shape, **kwargs,
+    )
+
+
+def compress_stack(path: Path, compression: Compression) -> CompressionReport:
+    """
+    Rewrite the stack at ``path`` tile-compressed (same file name). Table
+    extensions (the star catalog) are copied as they are.
+    """
+    bytes_before = path.stat().st_size
+    if not compression.enabled:
+        return CompressionReport(compression.label, bytes_before, bytes_before, 0.0)
+
+    start = time.perf_counter()
+    tmp = path.with_name(path.name + ".tmp")
+    with fits.open(path, memmap=False) as hdul:
+        if isinstance(image_hdu(hdul), fits.CompImageHDU):
+            return CompressionReport(compression.label, bytes_before, bytes_before, 0.0)
+        hdus = [fits.PrimaryHDU(), _compressed(hdul[0], compression)]
+        for hdu in hdul[1:]:
+            if isinstance(hdu, fits.ImageHDU) and hdu.data is not None:
+                hdus.append(_compressed(hdu, compression, name=hdu.name))
+            else:
+                hdus.append(hdu.copy())
+        fits.HDUList(hdus).writeto(tmp, overwrite=True)
+    os.replace(tmp, path)
+    return CompressionReport(
+        compression.label, bytes_before, path.stat().st_size, time.perf_counter() - start,
+    )
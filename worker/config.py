@@ -19,3 +19,81 @@ WORKER_ID = os.environ.get("WORKER_ID", "worker-01")
 POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "30"))
 WORK_DIR = Path(os.environ.get("WORK_DIR", "./tmp"))
 MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "4"))
+
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", "3"))
+
+# "disk": write raws to WORK_DIR and stack with seestarpy's FrameCollection
+# "streaming": decode frames in memory and fold them into a running accumulator
+STACK_MODE = os.environ.get("STACK_MODE", "disk")
+
+# Drop clouded, trailed and blurred frames on a cheap binned preview before alignment (0 = off)
+PRESCREEN = os.environ.get("PRESCREEN", "1") != "0"
+
+# Frame alignment: "stars" (asterism matching; warm-started in streaming mode)
+# or "phase" (phase correlation of binned frames, asterism matching as fallback)
+ALIGN_METHOD = os.environ.get("ALIGN_METHOD", "stars")
+
+# Disk-mode combine: "seestarpy" (frames combined in memory) or "tiled"
+# (aligned frames memory-mapped in WORK_DIR, combined in bands within
+# COMBINE_MEMORY_MB on COMBINE_THREADS threads; "auto" = cores per stack process)
+STACK_COMBINE = os.environ.get("STACK_COMBINE", "seestarpy")
+COMBINE_MEMORY_MB = int(os.environ.get("COMBINE_MEMORY_MB", "1024"))
+COMBINE_THREADS = os.environ.get("COMBINE_THREADS", "auto")
+
+# Stack output compression when the API does not set one for the owner's
+# tier: "none", "RICE_1", "GZIP_1" or "GZIP_2" (FITS tile compression), with
+# quantization steps per background sigma (0 = lossless, GZIP only)
+STACK_COMPRESSION = os.environ.get("STACK_COMPRESSION", "none")
+COMPRESSION_QUANTIZE = float(os.environ.get("COMPRESSION_QUANTIZE", "16"))
+
+# Processes for the CPU-bound stack stage: "auto" = physical cores, 0 = run on worker threads
+STACK_PROCESSES = os.environ.get("STACK_PROCESSES", "auto")
+
+# Budgets that queued jobs are admitted against, by their estimated peak
+# memory and WORK_DIR use ("auto" = 80% of available RAM / free disk)
+MEMORY_BUDGET_MB = os.environ.get("MEMORY_BUDGET_MB", "auto")
+DISK_BUDGET_MB = os.environ.get("DISK_BUDGET_MB", "auto")
+
+# Idle polling backs off exponentially (with jitter) from POLL_INTERVAL_MIN up to POLL_INTERVAL
+POLL_INTERVAL_MIN = float(os.environ.get("POLL_INTERVAL_MIN", "2"))
+# Jobs claimed ahead of free stacking slots, so their raws download while others stack
+PREFETCH_JOBS = int(os.environ.get("PREFETCH_JOBS", "1"))
+
+# Seconds next_job.php may hold a claim request open waiting for new jobs (0 = plain polling)
+LONG_POLL = int(os.environ.get("LONG_POLL", "25"))
+
+# Seconds between lease renewals of claimed jobs (heartbeat_job.php); must be
+# well below the API's JOB_LEASE_SECONDS
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "30"))
+
+# Uploads: files above UPLOAD_CHUNK_SIZE_MB use Nextcloud chunked upload v2
+# (parallel, resumable) when UCLOUD_UPLOADS_URL is set. Public shares cannot
+# chunk, so this needs a user account: UCLOUD_UPLOADS_URL is its
+# remote.php/dav/uploads/USER collection and UCLOUD_FILES_URL the
+# remote.php/dav/files/USER/... folder that the share (UCLOUD_WEBDAV_URL) points at.
+UPLOAD_CHUNK_SIZE_MB = int(os.environ.get("UPLOAD_CHUNK_SIZE_MB", "10"))
+UPLOAD_PARALLEL = int(os.environ.get("UPLOAD_PARALLEL", "4"))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "3"))
+UCLOUD_UPLOADS_URL = os.environ.get("UCLOUD_UPLOADS_URL", "").rstrip("/")
+UCLOUD_FILES_URL = os.environ.get("UCLOUD_FILES_URL", "").rstrip("/")
+UCLOUD_USER = os.environ.get("UCLOUD_USER", "")
+UCLOUD_APP_PASSWORD = os.environ.get("UCLOUD_APP_PASSWORD", "")
+
+# Local cache of raws and per-frame intermediates (star lists, transforms), so
+# retried jobs skip downloads and alignment work. LRU-evicted; 0 disables it.
+CACHE_DIR = Path(os.environ.get("CACHE_DIR", str(WORK_DIR / "cache")))
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", "10240"))
+
+# Prometheus text metrics at http://METRICS_HOST:METRICS_PORT/metrics (daemon mode; 0 = off)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+# Per-job JSON-lines traces (one job_{id}.jsonl per job); empty = off
+_trace_dir = os.environ.get("TRACE_DIR", str(WORK_DIR / "traces"))
+TRACE_DIR = Path(_trace_dir) if _trace_dir else None
+# Sky-position index of all stacked frames (python -m worker.sky_index --sync)
+SKY_INDEX_PATH = Path(os.environ.get("SKY_INDEX_PATH", str(WORK_DIR / "sky_index.npz")))
+
+# Unix socket of a warm worker (python -m worker --warm); --once runs hand the
+# job they claimed to it instead of importing the stacking stack themselves
+WARM_SOCKET = os.environ.get("WARM_SOCKET", "")
@@ -0,0 +1,442 @@
+"""
+Daemon and warm-worker modes of the worker.
+
+``run_daemon`` polls the API for jobs; ``run_warm`` claims nothing itself and
+processes jobs that ``python -m worker --once`` runs (from cron) hand it over a
+Unix socket (``WARM_SOCKET``). Both import the scientific stack and start the
+stack process pool once, when they start.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from . import config, metrics, sessions
+from .admission import Admission, budget
+from .api_client import get_next_jobs, release_job
+from .cache import get_cache
+from .executor import StackPool, stack_processes
+from .job_processor import process_job
+from .leases import get_leases, heartbeat_loop
+from .pointing import get_references
+from .sessions import stats as http_stats
+
+logger = logging.getLogger("crowdsky.worker")
+
+# Modules the warm worker imports in every stack process before the first job
+WARM_MODULES = ("stacking_adapter", "streaming_stack", "tiled_stack", "thumbnail", "compression")
+
+# Seconds to fall back to plain polling after a failed long-poll request
+LONG_POLL_RETRY = 600
+# Seconds between HTTP / cache metrics log lines in daemon mode
+HTTP_STATS_INTERVAL = 600
+
+
+def _log_http_stats() -> None:
+    for service, s in http_stats().items():
+        logger.info(
+            f"HTTP {service}: {s['requests']} requests ({s['errors']} errors) over "
+            f"{s['connections']} connections, latency avg {s['latency_avg'] * 1000:.0f} ms "
+            f"/ max {s['latency_max'] * 1000:.0f} ms"
+        )
+    cache = get_cache()
+    if cache is not None:
+        s = cache.stats()
+        logger.info(
+            f"Cache: {s['entries']} entries, {s['bytes'] / 1e6:.0f} MB, "
+            f"{s['hits']} hits / {s['misses']} misses"
+        )
+
+
+def _collect_http_and_cache() -> list:
+    """HTTP session and cache stats for the metrics endpoint."""
+    http = http_stats()
+    families = [
+        ("crowdsky_http_requests_total", "counter", "HTTP requests per service.",
+         {(("service", n),): s["requests"] for n, s in http.items()}),
+        ("crowdsky_http_errors_total", "counter", "HTTP responses >= 400 per service.",
+         {(("service", n),): s["errors"] for n, s in http.items()}),
+        ("crowdsky_http_latency_avg_seconds", "gauge", "Mean time to response headers.",
+         {(("service", n),): s["latency_avg"] for n, s in http.items()}),
+        ("crowdsky_http_connections", "gauge", "TCP connections opened per service.",
+         {(("service", n),): s["connections"] for n, s in http.items()}),
+    ]
+    cache = get_cache()
+    if cache is not None:
+        s = cache.stats()
+        families += [
+            ("crowdsky_cache_bytes", "gauge", "Bytes in the local cache.", {(): s["bytes"]}),
+            ("crowdsky_cache_hits_total", "counter", "Cache hits.", {(): s["hits"]}),
+            ("crowdsky_cache_misses_total", "counter", "Cache misses.", {(): s["misses"]}),
+        ]
+    s = get_references().stats()
+    families += [
+        ("crowdsky_pointing_references", "gauge", "Pointings with a cached alignment reference.",
+         {(): s["entries"]}),
+        ("crowdsky_pointing_reference_hits_total", "counter", "Chunks started from a cached reference.",
+         {(): s["hits"]}),
+    ]
+    return families
+
+
+def _install_signal_handlers(stop: threading.Event) -> None:
+    """First SIGINT/SIGTERM stops claiming jobs; a second one exits immediately."""
+
+    def handler(signum, frame):
+        if stop.is_set():
+            logger.warning("Second shutdown signal, exiting without waiting for jobs")
+            os._exit(1)
+        logger.info(f"Received {signal.Signals(signum).name}, finishing running jobs (signal again to force)")
+        stop.set()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+class _Backoff:
+    """Exponential idle-poll delay with jitter, reset whenever a job is found."""
+
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.delay = minimum
+
+    def reset(self) -> None:
+        self.delay = self.minimum
+
+    def next(self) -> float:
+        """Return the delay to wait now, and grow the delay for the next miss."""
+        delay = self.delay * random.uniform(0.5, 1.0)
+        self.delay = min(self.delay * 2, self.maximum)
+        return delay
+
+
+async def _wait(wake: asyncio.Event, timeout: float) -> None:
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(wake.wait(), timeout)
+
+
+def _start(stop: Optional[threading.Event], admission: Admission):
+    """Metrics endpoint and signal handlers; returns the stop event and metrics server."""
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics.registry.collectors.append(_collect_http_and_cache)
+        metrics.registry.collectors.append(admission.collect)
+        metrics_server = metrics.serve(config.METRICS_HOST, config.METRICS_PORT)
+        if metrics_server is not None:
+            logger.info(f"Metrics at http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
+
+    if stop is None:
+        stop = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        _install_signal_handlers(stop)
+    return stop, metrics_server
+
+
+def _prepare_loop(stop: threading.Event) -> asyncio.Event:
+    """
+    Size the running loop's thread pool and return an event that is set when
+    ``stop`` is (and whenever else the loop should wake up).
+    """
+    capacity = config.MAX_WORKERS + config.PREFETCH_JOBS
+    loop = asyncio.get_running_loop()
+    # Threads for stack_stream (one per stacking job) and cache / file I/O
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=capacity * (config.DOWNLOAD_CONCURRENCY + 1), thread_name_prefix="job",
+    ))
+    wake = asyncio.Event()
+
+    def on_stop():
+        stop.wait()
+        with contextlib.suppress(RuntimeError):  # loop already closed
+            loop.call_soon_threadsafe(wake.set)
+
+    threading.Thread(target=on_stop, daemon=True).start()
+    return wake
+
+
+def _reap(tasks: set, done) -> None:
+    for t in done:
+        if t.cancelled():
+            # Stopped after its lease was lost
+            continue
+        try:
+            t.result()
+        except Exception as e:
+            logger.error(f"Job task error: {e}", exc_info=True)
+    tasks.difference_update(done)
+
+
+def _stop_lost(queue: collections.deque, running: Dict[int, asyncio.Task]) -> Callable[[dict], None]:
+    """``on_lost`` for ``heartbeat_loop``: drop a lost job from the queue or cancel its task."""
+
+    def on_lost(job: dict) -> None:
+        if job in queue:
+            queue.remove(job)
+        task = running.get(job["job_id"])
+        if task is not None:
+            task.cancel()
+
+    return on_lost
+
+
+async def _release_queued(queue: collections.deque) -> None:
+    """Hand claimed jobs that never started back to the API and stop renewing their leases."""
+    logger.info(f"Shutting down, releasing {len(queue)} queued jobs")
+    leases = get_leases()
+    while queue:
+        job = queue.popleft()
+        leases.release(job["job_id"])
+        try:
+            await release_job(job["job_id"])
+        except Exception as e:
+            # The lease expires and next_job.php reclaims the job
+            logger.warning(f"Job {job['job_id']}: could not release it: {e}")
+
+
+def _start_job(job, running, stack_pool, stack_slots, on_done) -> asyncio.Task:
+    """Run ``process_job`` as a task; ``on_done(task)`` runs when it ends."""
+    task = asyncio.create_task(process_job(job, stack_pool, stack_slots))
+    running[job["job_id"]] = task
+
+    def done(t: asyncio.Task) -> None:
+        running.pop(job["job_id"], None)
+        get_leases().release(job["job_id"])
+        on_done(t)
+
+    task.add_done_callback(done)
+    return task
+
+
+def run_daemon(stop: Optional[threading.Event] = None) -> None:
+    """
+    Poll continuously for jobs.
+
+    Jobs run as tasks on one event loop, so their downloads, uploads and API
+    calls share a single connection pool per service; stacking and thumbnails
+    run in a process pool of STACK_PROCESSES (see ``executor``). At most
+    MAX_WORKERS jobs stack at once, and up to PREFETCH_JOBS more are claimed
+    ahead so their raws download in the meantime. Jobs are claimed in batches
+    into a local queue. Claims long-poll for up to LONG_POLL seconds, so new
+    jobs are picked up as soon as they are created; if long polling is disabled, unsupported or
+    failing, idle polling backs off exponentially from POLL_INTERVAL_MIN to
+    POLL_INTERVAL.
+
+    Queued jobs start only while their estimated memory and disk footprints
+    fit the budgets (``admission``); a job that fits may overtake one that
+    does not.
+
+    Claimed jobs hold a lease on the API that a heartbeat renews (see
+    ``leases``), from their claim until they finish; a job whose lease the API
+    took back is dropped from the queue or cancelled.
+
+    Returns once ``stop`` is set (SIGINT/SIGTERM) and running jobs have finished.
+    """
+    n_procs = stack_processes()
+    logger.info(
+        f"Worker {config.WORKER_ID} starting "
+        f"(poll interval: {config.POLL_INTERVAL_MIN:g}-{config.POLL_INTERVAL}s, "
+        f"max workers: {config.MAX_WORKERS} + {config.PREFETCH_JOBS} prefetch, "
+        f"stack processes: {n_procs or 'in-thread'})"
+    )
+    config.WORK_DIR.mkdir(parents=True, exist_ok=True)
+    admission = Admission(budget())
+    logger.info(f"Admission budget: {admission.limit}")
+    stop, metrics_server = _start(stop, admission)
+
+    asyncio.run(_daemon(stop, admission, n_procs))
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    _log_http_stats()
+    logger.info("Shutdown complete.")
+
+
+async def _daemon(stop: threading.Event, admission: Admission, n_procs: int) -> None:
+    capacity = config.MAX_WORKERS + config.PREFETCH_JOBS
+    # Set when a job finishes or shutdown is requested, to cut idle waits short
+    wake = _prepare_loop(stop)
+
+    backoff = _Backoff(config.POLL_INTERVAL_MIN, config.POLL_INTERVAL)
+    long_poll_paused_until = 0.0
+    queue = collections.deque()
+    stack_slots = asyncio.BoundedSemaphore(config.MAX_WORKERS)
+    stack_pool_cm = StackPool(n_procs) if n_procs > 0 else contextlib.nullcontext()
+
+    running: Dict[int, asyncio.Task] = {}
+    leases = get_leases()
+    beat = asyncio.create_task(heartbeat_loop(_stop_lost(queue, running)))
+
+    with stack_pool_cm as stack_pool:
+        tasks = set()
+        next_stats_log = time.monotonic() + HTTP_STATS_INTERVAL
+        while not stop.is_set():
+            wake.clear()
+            if time.monotonic() >= next_stats_log:
+                _log_http_stats()
+                next_stats_log = time.monotonic() + HTTP_STATS_INTERVAL
+
+            # Remove completed tasks
+            _reap(tasks, {t for t in tasks if t.done()})
+
+            # Refill the local queue in one batch call (long poll if enabled).
+            # Not while claimed jobs wait for budget: a finishing task must
+            # be able to start them at once, not after a long poll
+            free = capacity - len(tasks) - len(queue)
+            waited_out = False
+            if free > 0 and not queue:
+                wait_s = config.LONG_POLL if time.monotonic() >= long_poll_paused_until else 0
+                started = time.monotonic()
+                try:
+                    jobs = await get_next_jobs(free, wait=wait_s)
+                except Exception as e:
+                    logger.error(f"Could not claim jobs: {e}")
+                    jobs = []
+                    if wait_s:
+                        logger.warning(f"Long poll failed, plain polling for {LONG_POLL_RETRY}s")
+                        long_poll_paused_until = time.monotonic() + LONG_POLL_RETRY
+                # A server without long-poll support answers at once: back off then
+                waited_out = bool(wait_s) and time.monotonic() - started >= 0.8 * wait_s
+                for job in jobs:
+                    # Queue wait is measured from here (see process_job)
+                    job["claimed_at"] = time.monotonic()
+                    leases.hold(job)
+                queue.extend(jobs)
+                if jobs:
+                    backoff.reset()
+                    logger.info(f"Claimed {len(jobs)} job(s): {[j['job_id'] for j in jobs]}")
+
+            # Start queued jobs that fit the budget
+            while queue and len(tasks) < capacity:
+                job = admission.take(queue)
+                if job is None:
+                    break
+                task = _start_job(
+                    job, running, stack_pool, stack_slots,
+                    lambda _, job=job: (admission.release(job), wake.set()),
+                )
+                tasks.add(task)
+
+            if len(tasks) >= capacity or queue:
+                # Saturated, or queued jobs wait for budget: wait for a job to finish
+                await _wait(wake, config.POLL_INTERVAL)
+            elif waited_out:
+                # The long poll already waited; ask again straight away
+                continue
+            else:
+                delay = backoff.next()
+                if not tasks:
+                    logger.info(f"No pending jobs, next poll in {delay:.1f}s.")
+                await _wait(wake, delay)
+
+        if queue:
+            await _release_queued(queue)
+        if tasks:
+            logger.info(f"Shutting down, waiting for {len(tasks)} running jobs to finish...")
+            await asyncio.wait(tasks)
+        _reap(tasks, set(tasks))
+    beat.cancel()
+    await sessions.close()
+
+
+def run_warm(stop: Optional[threading.Event] = None) -> None:
+    """
+    Process jobs handed over on ``WARM_SOCKET`` by ``python -m worker --once``.
+
+    For cron setups: each cron run only claims a job, which takes milliseconds
+    (see ``main.run_once``), and passes it here, where the scientific stack is
+    already imported and the stack processes are running. Handed-over jobs go
+    through the same admission budget and stack slots as in daemon mode.
+
+    Returns once ``stop`` is set (SIGINT/SIGTERM) and every accepted job has
+    finished.
+    """
+    if not config.WARM_SOCKET:
+        raise RuntimeError("WARM_SOCKET is not set")
+    n_procs = stack_processes()
+    logger.info(
+        f"Warm worker {config.WORKER_ID} listening on {config.WARM_SOCKET} "
+        f"(max workers: {config.MAX_WORKERS}, stack processes: {n_procs or 'in-thread'})"
+    )
+    config.WORK_DIR.mkdir(parents=True, exist_ok=True)
+    admission = Admission(budget())
+    logger.info(f"Admission budget: {admission.limit}")
+    stop, metrics_server = _start(stop, admission)
+
+    asyncio.run(_warm(stop, admission, n_procs))
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    _log_http_stats()
+    logger.info("Shutdown complete.")
+
+
+async def _warm(stop: threading.Event, admission: Admission, n_procs: int) -> None:
+    wake = _prepare_loop(stop)
+    queue = collections.deque()
+    tasks = set()
+    running: Dict[int, asyncio.Task] = {}
+    beat = asyncio.create_task(heartbeat_loop(_stop_lost(queue, running)))
+    stack_slots = asyncio.BoundedSemaphore(config.MAX_WORKERS)
+    stack_pool_cm = StackPool(n_procs) if n_procs > 0 else contextlib.nullcontext()
+
+    with stack_pool_cm as stack_pool:
+        if stack_pool is not None:
+            await asyncio.to_thread(
+                stack_pool.warm_up, [f"{__package__}.{m}" for m in WARM_MODULES],
+            )
+
+        def start_queued() -> None:
+            while queue:
+                job = admission.take(queue)
+                if job is None:
+                    break
+                task = _start_job(
+                    job, running, stack_pool, stack_slots,
+                    lambda t, job=job: (admission.release(job), _reap(tasks, {t}), start_queued()),
+                )
+                tasks.add(task)
+
+        async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                job = json.loads(await reader.readline())
+                # Queue wait is measured from the handover (see process_job)
+                job["claimed_at"] = time.monotonic()
+                get_leases().hold(job)
+                queue.append(job)
+                logger.info(
+                    f"Handed job {job['job_id']}: {job.get('object_name', '?')} chunk={job.get('chunk_key') or job.get('type')}"
+                )
+                start_queued()
+                writer.write(b"accepted\n")
+                await writer.drain()
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring malformed handover: {e!r}")
+            finally:
+                writer.close()
+
+        # A socket left behind by an earlier run would make the bind fail
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(config.WARM_SOCKET)
+        server = await asyncio.start_unix_server(accept, path=config.WARM_SOCKET)
+        try:
+            await wake.wait()
+        finally:
+            server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(config.WARM_SOCKET)
+
+        # Accepted jobs are no longer claimable by anyone else: finish them all
+        if tasks or queue:
+            logger.info(f"Shutting down, waiting for {len(tasks) + len(queue)} jobs to finish...")
+        while tasks:
+            await asyncio.wait(set(tasks))
+    beat.cancel()
+    await sessions.close()
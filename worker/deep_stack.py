@@ -0,0 +1,259 @@
+"""
+Deep co-adds of one pointing from its 15-minute stacks.
+
+Once a chunk job completes, its raws are deleted, so a deep image of a target
+can only be built from the stacks on u:cloud. Each stack is weighted per pixel
+by the exposure behind it: its footprint (frames per pixel) times the mean
+frame exposure (``total_exptime / n_frames_input``); stacks without a
+footprint count ``n_frames_aligned`` frames everywhere.
+
+The co-add is kept as running sums in a state file next to the deep image:
+the weighted sum of the stacks (WSUM), the summed weights (WEIGHT) and frames
+per pixel (FOOTPRINT) on the grid of the first stack, that stack's control
+points (REFSTARS) and the ids of the stacks already folded in (MEMBERS).
+Adding a stack aligns its star table (the STARS extension ``write_stack``
+writes) to REFSTARS, warps it onto the grid and adds it to the sums, so a
+deep job costs O(new stacks), not O(all stacks). Stacks listed in MEMBERS
+are skipped, which makes a retried job (or one whose state was uploaded
+before ``complete_job`` failed) idempotent.
+"""
+
+import io
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import astroalign
+import cv2
+import numpy as np
+from astropy.io import fits
+
+from .compression import Compression, compress_stack, image_hdu
+from .stacking_adapter import StackResult
+from .streaming_stack import MAX_CONTROL_STARS, control_points, luminance, warp_frame, write_product
+
+logger = logging.getLogger(__name__)
+
+# The state holds running sums, so it is never quantized
+STATE_COMPRESSION = Compression("GZIP_2", 0)
+
+
+def _stack_points(hdul: fits.HDUList, image: np.ndarray) -> np.ndarray:
+    """(N, 2) positions of a stack's brightest stars, from its STARS table if it has one."""
+    if "STARS" in hdul and len(hdul["STARS"].data):
+        stars = hdul["STARS"].data
+        order = np.argsort(stars["flux"])[::-1][:MAX_CONTROL_STARS]
+        return np.column_stack([stars["x"][order], stars["y"][order]]).astype(np.float64)
+    return control_points(luminance(np.nan_to_num(image)))
+
+
+def _read_stack(data: bytes, n_frames: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Image, frames per pixel and control points of a stack FITS (compressed or not)."""
+    with fits.open(io.BytesIO(data), memmap=False) as hdul:
+        image = np.asarray(image_hdu(hdul).data, dtype=np.float32)
+        if image.ndim == 3 and image.shape[0] == 3:
+            # seestarpy writes channels first
+            image = np.moveaxis(image, 0, -1)
+        if "FOOTPRINT" in hdul:
+            count = np.asarray(hdul["FOOTPRINT"].data, dtype=np.float32)
+        else:
+            count = np.full(image.shape[:2], float(n_frames), np.float32)
+        points = _stack_points(hdul, image)
+    return np.ascontiguousarray(image), count, points
+
+
+def _frame_exptime(stack: dict) -> float:
+    """Mean exposure of one frame of a stack (1 s when the API has no exposure)."""
+    total = stack.get("total_exptime")
+    n = int(stack.get("n_frames_input") or stack.get("n_frames_aligned") or 0)
+    if total is None or n <= 0:
+        return 1.0
+    return float(total) / n
+
+
+@dataclass
+class DeepState:
+    wsum: np.ndarray
+    weight: np.ndarray
+    count: np.ndarray
+    ref_points: np.ndarray
+    members: List[int] = field(default_factory=list)
+    n_stacks: int = 0
+    n_frames: int = 0
+    total_exptime: float = 0.0
+    date_obs_start: Optional[str] = None
+    date_obs_end: Optional[str] = None
+    ra_deg: Optional[float] = None
+    dec_deg: Optional[float] = None
+
+    @classmethod
+    def start(cls, image: np.ndarray, ref_points: np.ndarray) -> "DeepState":
+        """Empty sums on the grid of ``image``, aligned to ``ref_points``."""
+        h, w = image.shape[:2]
+        return cls(
+            wsum=np.zeros((h, w, 3), np.float64),
+            weight=np.zeros((h, w), np.float64),
+            count=np.zeros((h, w), np.float64),
+            ref_points=ref_points,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "DeepState":
+        with fits.open(path, memmap=False) as hdul:
+            hdu = image_hdu(hdul)
+            header = hdu.header
+            return cls(
+                wsum=np.asarray(hdu.data, dtype=np.float64),
+                weight=np.asarray(hdul["WEIGHT"].data, dtype=np.float64),
+                count=np.asarray(hdul["FOOTPRINT"].data, dtype=np.float64),
+                ref_points=np.column_stack([hdul["REFSTARS"].data["x"], hdul["REFSTARS"].data["y"]]),
+                members=[int(i) for i in hdul["MEMBERS"].data["id"]],
+                n_stacks=int(header.get("NSTACKS", 0)),
+                n_frames=int(header.get("NFRAMES", 0)),
+                total_exptime=float(header.get("EXPTIME", 0.0)),
+                date_obs_start=header.get("DATE-OBS"),
+                date_obs_end=header.get("DATE-END"),
+                ra_deg=header.get("RA"),
+                dec_deg=header.get("DEC"),
+            )
+
+    def save(self, path: Path) -> None:
+        """Write the sums (float32, losslessly tile-compressed) and bookkeeping."""
+        header = fits.Header()
+        header["NSTACKS"] = (self.n_stacks, "15-min stacks in the co-add")
+        header["NFRAMES"] = (self.n_frames, "Aligned frames in the co-add")
+        header["EXPTIME"] = (self.total_exptime, "Total exposure time [s]")
+        for key, value in (("DATE-OBS", self.date_obs_start), ("DATE-END", self.date_obs_end),
+                           ("RA", self.ra_deg), ("DEC", self.dec_deg)):
+            if value is not None:
+                header[key] = value
+        hdus = [
+            fits.PrimaryHDU(self.wsum.astype(np.float32), header=header),
+            fits.ImageHDU(self.weight.astype(np.float32), name="WEIGHT"),
+            fits.ImageHDU(self.count.astype(np.float32), name="FOOTPRINT"),
+            fits.BinTableHDU.from_columns([
+                fits.Column("x", "D", array=self.ref_points[:, 0]),
+                fits.Column("y", "D", array=self.ref_points[:, 1]),
+            ], name="REFSTARS"),
+            fits.BinTableHDU.from_columns(
+                [fits.Column("id", "K", array=np.asarray(self.members, np.int64))], name="MEMBERS",
+            ),
+        ]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        fits.HDUList(hdus).writeto(tmp, overwrite=True)
+        compress_stack(tmp, STATE_COMPRESSION)
+        os.replace(tmp, path)
+
+    def add(self, stack: dict, image: np.ndarray, count: np.ndarray, matrix: Optional[np.ndarray]) -> None:
+        """Fold one stack in; ``matrix`` maps it onto the grid (None = already on it)."""
+        weight = count * _frame_exptime(stack)
+        if matrix is not None:
+            h, w = self.weight.shape
+            image = warp_frame(image, matrix, (h, w))
+            m = np.asarray(matrix, dtype=np.float32)
+            weight = cv2.warpAffine(weight.astype(np.float32), m, (w, h), flags=cv2.INTER_LINEAR)
+            count = cv2.warpAffine(count.astype(np.float32), m, (w, h), flags=cv2.INTER_LINEAR)
+        valid = np.isfinite(image).all(axis=2) & (weight > 0)
+        weight = np.where(valid, weight, 0.0)
+        self.wsum += np.where(valid[..., None], image, 0.0) * weight[..., None]
+        self.weight += weight
+        self.count += np.where(valid, count, 0.0)
+
+        self.n_stacks += 1
+        self.n_frames += int(stack.get("n_frames_aligned") or 0)
+        self.total_exptime += float(stack.get("total_exptime") or 0.0)
+        start, end = stack.get("date_obs_start"), stack.get("date_obs_end")
+        if start and (self.date_obs_start is None or start < self.date_obs_start):
+            self.date_obs_start = start
+        if end and (self.date_obs_end is None or end > self.date_obs_end):
+            self.date_obs_end = end
+        if self.ra_deg is None and stack.get("ra_deg") is not None:
+            self.ra_deg, self.dec_deg = float(stack["ra_deg"]), float(stack["dec_deg"])
+
+    def image(self) -> np.ndarray:
+        """The exposure-weighted mean (NaN where no stack covers a pixel)."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.wsum / self.weight[..., None]).astype(np.float32)
+
+
+@dataclass
+class DeepResult:
+    # None if the co-add has no stack yet and none of this job's could be added
+    product: Optional[StackResult]
+    state: Optional[DeepState]
+    state_path: Path
+    # Stacks of this job folded in, and those left out (by id, with the reason)
+    added: List[int] = field(default_factory=list)
+    rejected: Dict[int, str] = field(default_factory=dict)
+
+
+def stack_deep(
+    stacks: Iterable[Tuple[dict, bytes]],
+    output_path: Path,
+    state_path: Path,
+    previous_state: Optional[Path] = None,
+) -> DeepResult:
+    """
+    Fold 15-minute stacks into a deep co-add and write it with its state.
+
+    Args:
+        stacks: ``(stack, data)`` pairs: the stack's ``stacked_frames`` fields
+            from the API (``id``, ``total_exptime``, ``n_frames_input``,
+            ``n_frames_aligned``, dates, RA/Dec) and its FITS bytes.
+        output_path: Where to write the deep FITS (with previews alongside).
+        state_path: Where to write the updated running sums.
+        previous_state: The state of the co-add so far, if there is one; the
+            first stack folded in sets the grid otherwise.
+
+    Returns:
+        DeepResult. Stacks that cannot be read or aligned are left out (and
+        recorded as members, so they are not offered again). If the co-add
+        is new and none of them could be folded in, nothing is written and
+        ``product`` and ``state`` are None.
+    """
+    state = DeepState.load(previous_state) if previous_state is not None else None
+    done = set(state.members) if state is not None else set()
+    added: List[int] = []
+    rejected: Dict[int, str] = {}
+
+    for stack, data in stacks:
+        stack_id = int(stack["id"])
+        if stack_id in done:
+            continue
+        done.add(stack_id)
+        try:
+            image, count, points = _read_stack(data, int(stack.get("n_frames_aligned") or 1))
+            if state is None:
+                state = DeepState.start(image, points)
+                matrix = None
+            else:
+                transform, _ = astroalign.find_transform(points, state.ref_points)
+                matrix = transform.params[:2]
+            state.add(stack, image, count, matrix)
+        except Exception as e:
+            rejected[stack_id] = f"{type(e).__name__}: {e}"
+            logger.warning(f"Deep stack: leaving out stack {stack_id} ({e})")
+            continue
+        added.append(stack_id)
+
+    if state is None or state.n_stacks == 0:
+        return DeepResult(None, None, state_path, added, rejected)
+    state.members = sorted(set(state.members) | set(added) | set(rejected))
+    state.save(state_path)
+
+    product = write_product(
+        output_path, state.image(), np.minimum(state.count, np.iinfo(np.uint16).max), [],
+        metadata={
+            "total_exptime": state.total_exptime,
+            "date_obs_start": state.date_obs_start,
+            "date_obs_end": state.date_obs_end,
+            "ra_deg": state.ra_deg,
+            "dec_deg": state.dec_deg,
+        },
+        n_frames_input=state.n_frames,
+        n_aligned=state.n_frames,
+    )
+    return DeepResult(product, state, state_path, added, rejected)
@@ -0,0 +1,304 @@
+"""
+Concurrent download stage for raw frames.
+
+Raws are pulled from the PHP webspace over a bounded number of parallel streams
+(asyncio tasks) that share the API client's connection pool. Each file is
+retried with exponential backoff, and files are handed back as soon as they
+land so later stages do not have to wait for the slowest download. Raws
+already in the local cache (see ``cache.py``) are not fetched again, and fresh
+downloads are added; cache file I/O runs on a thread. Deep co-add jobs fetch
+their 15-minute stacks from u:cloud the same way.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+import aiohttp
+
+from . import config
+from .api_client import download_raw_file, fetch_raw_file
+from .cache import get_cache, raw_key
+from .webdav import fetch_file
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the first retry; doubled on every further attempt
+RETRY_BACKOFF = 1.0
+# Minimum seconds between two progress log lines for the same job
+PROGRESS_INTERVAL = 5.0
+
+
+@dataclass
+class DownloadReport:
+    n_files: int = 0
+    n_bytes: int = 0
+    n_retries: int = 0
+    n_cached: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.n_bytes / 1e6 / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class _Progress:
+    """Byte counter that logs throughput at a bounded rate (event loop only)."""
+
+    def __init__(self, label: str, n_files: int, report: DownloadReport):
+        self.label = label
+        self.n_files = n_files
+        self.report = report
+        self.start = time.monotonic()
+        self._last_log = self.start
+
+    def add_bytes(self, n: int) -> None:
+        self.report.n_bytes += n
+        now = time.monotonic()
+        self.report.elapsed = now - self.start
+        if now - self._last_log < PROGRESS_INTERVAL:
+            return
+        self._last_log = now
+        self._log()
+
+    def file_done(self) -> None:
+        self.report.n_files += 1
+        self.report.elapsed = time.monotonic() - self.start
+
+    def retried(self) -> None:
+        self.report.n_retries += 1
+
+    def cached(self) -> None:
+        self.report.n_cached += 1
+        self.report.n_files += 1
+
+    def _log(self) -> None:
+        r = self.report
+        logger.info(
+            f"{self.label}: {r.n_files}/{self.n_files} files, "
+            f"{r.n_bytes / 1e6:.1f} MB at {r.mb_per_s:.1f} MB/s"
+        )
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+async def _with_retry(fetch: Callable[..., Awaitable], file_id: int, progress: _Progress):
+    attempt = 0
+    while True:
+        written = 0
+
+        def on_chunk(n: int) -> None:
+            nonlocal written
+            written += n
+            progress.add_bytes(n)
+
+        try:
+            result = await fetch(file_id, on_chunk)
+            progress.file_done()
+            return result
+        except Exception as e:
+            # Bytes of a failed attempt do not count towards throughput
+            progress.add_bytes(-written)
+            if attempt >= config.DOWNLOAD_RETRIES or not _is_retryable(e):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            attempt += 1
+            progress.retried()
+            logger.warning(
+                f"{progress.label}: file {file_id} failed ({e}), "
+                f"retry {attempt}/{config.DOWNLOAD_RETRIES} in {delay:.0f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+async def _fetch(
+    fetch: Callable[..., Awaitable],
+    lookup: Optional[Callable],
+    f: dict,
+    progress: _Progress,
+    streams: asyncio.Semaphore,
+):
+    if lookup is not None:
+        hit = await asyncio.to_thread(lookup, f)
+        if hit is not None:
+            progress.cached()
+            return hit
+    async with streams:
+        return await _with_retry(fetch, int(f["id"]), progress)
+
+
+async def _iter_concurrent(
+    files: List[dict],
+    fetch: Callable[..., Awaitable],
+    label: str,
+    concurrency: Optional[int],
+    report: Optional[DownloadReport],
+    lookup: Optional[Callable] = None,
+) -> AsyncIterator[Tuple[int, object]]:
+    """
+    Run ``await fetch(file_id, on_chunk)`` for every file, at most
+    ``concurrency`` at once.
+
+    ``lookup(file)`` (blocking, run on a thread) is tried first; a non-None
+    result is used instead of fetching. At most two results per stream are
+    held ahead of the consumer, so a slow consumer applies backpressure
+    instead of letting finished downloads pile up.
+    """
+    if report is None:
+        report = DownloadReport()
+    progress = _Progress(label, len(files), report)
+    n_streams = max(1, min(concurrency or config.DOWNLOAD_CONCURRENCY, len(files) or 1))
+    window = 2 * n_streams
+    streams = asyncio.Semaphore(n_streams)
+
+    todo = iter(enumerate(files))
+    pending = {}
+
+    def start_next() -> None:
+        for i, f in todo:
+            pending[asyncio.create_task(_fetch(fetch, lookup, f, progress, streams))] = i
+            return
+
+    try:
+        for _ in range(window):
+            start_next()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = pending.pop(task)
+                yield i, task.result()
+                start_next()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def iter_download_raw_files(
+    files: List[dict],
+    dest_dir: Path,
+    label: str = "download",
+    concurrency: Optional[int] = None,
+    report: Optional[DownloadReport] = None,
+) -> AsyncIterator[Tuple[int, Path]]:
+    """
+    Download raw files concurrently, yielding each one as soon as it lands
+    (an async iterator).
+
+    Args:
+        files: File dicts from ``get_job_files`` (need ``id`` and ``filename``).
+        dest_dir: Local directory to download into.
+        label: Prefix for log lines, e.g. ``"Job 42"``.
+        concurrency: Parallel streams (default: ``config.DOWNLOAD_CONCURRENCY``).
+        report: Optional report object, filled in while downloading.
+
+    Yields:
+        ``(index, local_path)`` tuples in completion order, where ``index`` is
+        the position of the file in ``files``.
+
+    Raises:
+        The first download error that survives its retries. Downloads still in
+        flight are cancelled.
+    """
+    by_id = {int(f["id"]): f for f in files}
+    cache = get_cache()
+
+    def lookup(f: dict) -> Optional[Path]:
+        local_path = dest_dir / f["filename"]
+        return local_path if cache.copy_to(raw_key(f), local_path) else None
+
+    async def fetch(file_id: int, on_chunk: Callable[[int], None]) -> Path:
+        local_path = dest_dir / by_id[file_id]["filename"]
+        await download_raw_file(file_id, local_path, progress=on_chunk)
+        if cache is not None:
+            await asyncio.to_thread(cache.put_file, raw_key(by_id[file_id]), local_path)
+        return local_path
+
+    return _iter_concurrent(
+        files, fetch, label, concurrency, report, lookup if cache is not None else None
+    )
+
+
+def iter_fetch_raw_files(
+    files: List[dict],
+    label: str = "download",
+    concurrency: Optional[int] = None,
+    report: Optional[DownloadReport] = None,
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Like ``iter_download_raw_files``, but keeps each file in memory.
+
+    Yields:
+        ``(index, data)`` tuples in completion order.
+    """
+    by_id = {int(f["id"]): f for f in files}
+    cache = get_cache()
+
+    def lookup(f: dict) -> Optional[bytes]:
+        return cache.get_bytes(raw_key(f))
+
+    async def fetch(file_id: int, on_chunk: Callable[[int], None]) -> bytes:
+        data = await fetch_raw_file(file_id, progress=on_chunk)
+        if cache is not None:
+            await asyncio.to_thread(cache.put_bytes, raw_key(by_id[file_id]), data)
+        return data
+
+    return _iter_concurrent(
+        files, fetch, label, concurrency, report, lookup if cache is not None else None
+    )
+
+
+def iter_fetch_stacks(
+    stacks: List[dict],
+    label: str = "download",
+    concurrency: Optional[int] = None,
+    report: Optional[DownloadReport] = None,
+    key: str = "ucloud_path",
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Like ``iter_fetch_raw_files``, for stacks on u:cloud (deep co-adds) or
+    their catalogs (light-curve jobs, ``key="catalog_path"``).
+
+    Args:
+        stacks: Stack dicts from a deep or light-curve job (need ``id`` and
+            the remote path under ``key``).
+
+    Yields:
+        ``(index, data)`` tuples in completion order.
+    """
+    by_id = {int(s["id"]): s for s in stacks}
+
+    async def fetch(stack_id: int, on_chunk: Callable[[int], None]) -> bytes:
+        return await fetch_file(by_id[stack_id][key], progress=on_chunk)
+
+    return _iter_concurrent(stacks, fetch, label, concurrency, report)
+
+
+async def download_raw_files(
+    files: List[dict],
+    dest_dir: Path,
+    label: str = "download",
+    concurrency: Optional[int] = None,
+    report: Optional[DownloadReport] = None,
+) -> Tuple[List[Path], DownloadReport]:
+    """
+    Download all raw files for a job concurrently.
+
+    Returns:
+        Local paths in the same order as ``files``, and the download report
+        (``report`` if given, filled in while downloading).
+    """
+    if report is None:
+        report = DownloadReport()
+    paths: List[Optional[Path]] = [None] * len(files)
+    async for i, path in iter_download_raw_files(files, dest_dir, label, concurrency, report):
+        paths[i] = path
+    return paths, report
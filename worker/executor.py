@@ -0,0 +1,142 @@
+"""
+Process pool for the CPU-bound stack stage.
+
+I/O stages (API calls, downloads, WebDAV uploads) run as coroutines on the
+daemon's event loop. Stacking, thumbnails and compression are submitted here
+(``run_stage_async``), so astroalign, debayering and sigma clipping run on
+separate cores instead of serializing on the GIL or blocking the loop.
+"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+from . import config
+from .metrics import max_rss_bytes, record_child
+
+logger = logging.getLogger(__name__)
+
+
+def physical_cores() -> int:
+    """Number of physical CPU cores (falls back to logical cores)."""
+    try:
+        import psutil
+        n = psutil.cpu_count(logical=False)
+        if n:
+            return n
+    except ImportError:
+        pass
+    return os.cpu_count() or 1
+
+
+def stack_processes() -> int:
+    """Configured process pool size; 0 means stack on the job threads."""
+    if config.STACK_PROCESSES == "auto":
+        return physical_cores()
+    return int(config.STACK_PROCESSES)
+
+
+def _import(modules: Sequence[str]) -> None:
+    for name in modules:
+        importlib.import_module(name)
+
+
+def _ignore_signals() -> None:
+    # Shutdown is coordinated by the parent; children must finish their task
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class StackPool:
+    """
+    Process pool that replaces itself if a child dies (e.g. OOM-killed).
+
+    The job whose child died fails with ``BrokenProcessPool`` and is retried
+    through the API as usual; later submissions go to a fresh pool.
+    """
+
+    def __init__(self, n_procs: int):
+        self.n_procs = n_procs
+        self._lock = threading.Lock()
+        self._pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.n_procs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_ignore_signals,
+        )
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            try:
+                return self._pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                logger.warning("Stack process pool broken, starting a new one")
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._new_pool()
+                return self._pool.submit(fn, *args, **kwargs)
+
+    def warm_up(self, modules: Sequence[str]) -> None:
+        """Import ``modules`` in the pool processes ahead of their first task."""
+        for future in [self.submit(_import, modules) for _ in range(self.n_procs)]:
+            future.result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+
+    def __enter__(self) -> "StackPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+@dataclass(frozen=True)
+class Timed:
+    """Result of a pool task with the CPU time and peak memory of its process."""
+    value: Any
+    cpu_s: float
+    max_rss: int
+
+
+def _timed_call(fn, args, kwargs) -> Timed:
+    # Each pool process runs one task at a time, so process time is the task's
+    start = time.process_time()
+    value = fn(*args, **kwargs)
+    return Timed(value, time.process_time() - start, max_rss_bytes())
+
+
+def submit_timed(pool, fn, *args, **kwargs) -> Future:
+    """Like ``pool.submit``, but the result is a ``Timed``; pass it to ``unwrap()``."""
+    return pool.submit(_timed_call, fn, args, kwargs)
+
+
+def unwrap(timed: Timed):
+    """Charge a pool task's CPU time to the current metrics span and return its value."""
+    record_child(timed.cpu_s, timed.max_rss)
+    return timed.value
+
+
+def run_stage(pool, fn, *args, **kwargs):
+    """Run ``fn`` in ``pool`` if one is given, otherwise on the calling thread."""
+    if pool is None:
+        return fn(*args, **kwargs)
+    return unwrap(submit_timed(pool, fn, *args, **kwargs).result())
+
+
+async def run_stage_async(pool, fn, *args, **kwargs):
+    """Await ``fn`` in ``pool`` if one is given, otherwise in a thread."""
+    if pool is None:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return unwrap(await asyncio.wrap_future(submit_timed(pool, fn, *args, **kwargs)))
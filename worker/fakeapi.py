@@ -0,0 +1,295 @@
+"""
+Minimal local stand-in for the PHP worker API, for benchmarks and development.
+
+Serves ``next_job.php`` (single and batch claims, long poll), ``job_files.php``,
+``download_raw.php``, ``complete_job.php``, ``fail_job.php`` and
+``heartbeat_job.php`` (job leases of ``lease_s`` seconds) from an in-memory
+job table, and ``stack_index.php`` from the stacks completed jobs reported,
+with the same request and response shapes as ``web/api/``. Raws are served from local files. Every request is timestamped
+per job (see ``FakeJob``), so a benchmark can tell where a job spent its time
+without instrumenting the worker. Credentials are accepted but not checked.
+"""
+
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+# Longest long poll the server honours (LONG_POLL_MAX in config.php)
+LONG_POLL_MAX = 25
+# Seconds a claim or heartbeat leases a job (JOB_LEASE_SECONDS in config.php)
+LEASE_S = 180
+
+
+@dataclass
+class FakeFile:
+    id: int
+    path: Path
+    date_obs: str
+    exptime: float
+    ra: float
+    dec: float
+
+
+@dataclass
+class FakeJob:
+    job_id: int
+    chunk_key: str
+    object_name: str
+    files: List[FakeFile]
+    user_id: int = 1
+    cadences: List[int] = field(default_factory=lambda: [15])
+    status: str = "pending"
+    attempts: int = 0
+    error: Optional[str] = None
+    metadata: Optional[dict] = None
+    # Lease: holder, expiry (time.monotonic()) and the last progress reported
+    worker_id: Optional[str] = None
+    lease_expires: float = 0.0
+    progress: Optional[dict] = None
+    heartbeats: int = 0
+    # time.monotonic() of the job's API events
+    claimed_at: Optional[float] = None
+    files_at: Optional[float] = None
+    first_download_at: Optional[float] = None
+    last_download_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    bytes_served: int = 0
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs: List[FakeJob], max_attempts: int = 3,
+                 lease_s: float = LEASE_S):
+        super().__init__(address, _Handler)
+        self.jobs: Dict[int, FakeJob] = {j.job_id: j for j in jobs}
+        self.files: Dict[int, FakeJob] = {f.id: j for j in jobs for f in j.files}
+        self.max_attempts = max_attempts
+        self.lease_s = lease_s
+        self.cond = threading.Condition()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def claim(self, limit: int, worker_id: Optional[str] = None) -> List[FakeJob]:
+        """Claim up to ``limit`` pending jobs (caller holds ``cond``)."""
+        now = time.monotonic()
+        for job in self.jobs.values():
+            if job.status == "processing" and job.lease_expires < now:
+                job.error = f"Lease expired: worker {job.worker_id} stopped sending heartbeats"
+                job.status = "failed" if job.attempts >= self.max_attempts else "retry"
+        claimed = []
+        for job in self.jobs.values():
+            if len(claimed) >= limit:
+                break
+            if job.status in ("pending", "retry"):
+                job.status = "processing"
+                job.attempts += 1
+                job.claimed_at = now
+                job.worker_id = worker_id
+                job.lease_expires = now + self.lease_s
+                claimed.append(job)
+        return claimed
+
+    def finish(self, job: FakeJob, status: str) -> None:
+        with self.cond:
+            job.status = status
+            job.finished_at = time.monotonic()
+            self.cond.notify_all()
+
+    def all_done(self) -> bool:
+        """True once every job is completed or has failed for good (caller holds ``cond``)."""
+        return all(j.status in ("completed", "failed") for j in self.jobs.values())
+
+    def wait_done(self, timeout: Optional[float] = None) -> bool:
+        with self.cond:
+            return self.cond.wait_for(self.all_done, timeout)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeAPIServer
+
+    def log_message(self, fmt, *args):
+        logger.debug("%s " + fmt, self.address_string(), *args)
+
+    def _reply(self, status: int, payload=None, body: bytes = b"",
+               content_type: str = "application/json") -> None:
+        if payload is not None:
+            body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _json_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        endpoint = url.path.rsplit("/", 1)[-1]
+        if endpoint == "next_job.php":
+            return self._next_job(query)
+        if endpoint == "job_files.php":
+            return self._job_files(query)
+        if endpoint == "download_raw.php":
+            return self._download_raw(query)
+        if endpoint == "stack_index.php":
+            return self._stack_index(query)
+        self._reply(404, {"error": "Not found."})
+
+    def do_POST(self):
+        endpoint = urlparse(self.path).path.rsplit("/", 1)[-1]
+        try:
+            data = self._json_body()
+        except ValueError:
+            return self._reply(400, {"error": "Invalid JSON body."})
+        if endpoint == "heartbeat_job.php":
+            return self._heartbeat(data)
+        job = self.server.jobs.get(int(data.get("job_id") or 0))
+        if job is None or job.status != "processing":
+            return self._reply(404, {"error": "Job not found or not in processing state."})
+        if "worker_id" in data and data["worker_id"] != job.worker_id:
+            return self._reply(409, {"error": "Job is leased to another worker."})
+
+        if endpoint == "complete_job.php":
+            job.metadata = data
+            self.server.finish(job, "completed")
+            return self._reply(200, {"ok": True})
+        if endpoint == "fail_job.php" and data.get("release"):
+            with self.server.cond:
+                job.status, job.worker_id, job.lease_expires = "pending", None, 0.0
+                self.server.cond.notify_all()
+            return self._reply(200, {"ok": True, "status": "pending"})
+        if endpoint == "fail_job.php":
+            job.error = data.get("error_message")
+            status = "failed" if job.attempts >= self.server.max_attempts else "retry"
+            self.server.finish(job, status)
+            return self._reply(200, {"ok": True, "status": status})
+        self._reply(404, {"error": "Not found."})
+
+    # -- endpoints -------------------------------------------------------
+
+    def _next_job(self, query: dict) -> None:
+        batch = "limit" in query
+        limit = max(1, min(10, int(query.get("limit") or 1)))
+        wait = max(0, min(LONG_POLL_MAX, int(query.get("wait") or 0)))
+        deadline = time.monotonic() + wait
+
+        with self.server.cond:
+            while True:
+                claimed = self.server.claim(limit, query.get("worker_id"))
+                remaining = deadline - time.monotonic()
+                if claimed or remaining <= 0 or self.server.all_done():
+                    break
+                self.server.cond.wait(remaining)
+
+        if not claimed:
+            return self._reply(204)
+        payload = [
+            {
+                "job_id": j.job_id,
+                "type": "chunk",
+                "user_id": j.user_id,
+                "upload_session_id": 1,
+                "chunk_key": j.chunk_key,
+                "object_name": j.object_name,
+                "frame_count": len(j.files),
+                "raw_bytes": sum(f.path.stat().st_size for f in j.files),
+                "session_ucloud_path": None,
+                "cadences": j.cadences,
+            }
+            for j in claimed
+        ]
+        self._reply(200, {"jobs": payload} if batch else payload[0])
+
+    def _heartbeat(self, data: dict) -> None:
+        lost = []
+        with self.server.cond:
+            now = time.monotonic()
+            for entry in data.get("jobs", []):
+                job = self.server.jobs.get(int(entry.get("job_id") or 0))
+                if job is None or job.status != "processing" or job.worker_id != data.get("worker_id"):
+                    lost.append(int(entry.get("job_id") or 0))
+                    continue
+                job.lease_expires = now + self.server.lease_s
+                job.progress = {k: entry.get(k) for k in ("stage", "done", "total")}
+                job.heartbeats += 1
+        self._reply(200, {"ok": True, "lease_s": self.server.lease_s, "lost": lost})
+
+    def _stack_index(self, query: dict) -> None:
+        after = int(query.get("after_id") or 0)
+        limit = max(1, min(10000, int(query.get("limit") or 1000)))
+        with self.server.cond:
+            done = [j for j in self.server.jobs.values() if j.status == "completed" and j.metadata]
+        # One row per stack, numbered like stacked_frames ids in completion order
+        rows = []
+        for job in sorted(done, key=lambda j: j.finished_at):
+            for product in [job.metadata, *job.metadata.get("products", [])]:
+                rows.append({
+                    "id": len(rows) + 1,
+                    "user_id": job.user_id,
+                    "object_name": job.object_name,
+                    **{k: product.get(k) for k in (
+                        "ra_deg", "dec_deg", "date_obs_start", "date_obs_end", "cadence_min",
+                        "total_exptime", "n_frames_aligned",
+                    )},
+                })
+        self._reply(200, {"stacks": rows[after:after + limit], "n_upto": min(after, len(rows))})
+
+    def _job_files(self, query: dict) -> None:
+        job = self.server.jobs.get(int(query.get("job_id") or 0))
+        if job is None:
+            return self._reply(404, {"error": "Job not found."})
+        job.files_at = time.monotonic()
+        files = [
+            {
+                "id": f.id,
+                "filename": f.path.name,
+                "ucloud_path": None,
+                "file_size_bytes": f.path.stat().st_size,
+                "fits_date_obs": f.date_obs,
+                "fits_exptime": f.exptime,
+                "fits_ra": f.ra,
+                "fits_dec": f.dec,
+            }
+            for f in job.files
+        ]
+        self._reply(200, {"job_id": job.job_id, "chunk_key": job.chunk_key, "files": files})
+
+    def _download_raw(self, query: dict) -> None:
+        file_id = int(query.get("file_id") or 0)
+        job = self.server.files.get(file_id)
+        if job is None:
+            return self._reply(404, {"error": "File not found."})
+        path = next(f.path for f in job.files if f.id == file_id)
+        now = time.monotonic()
+        if job.first_download_at is None or job.first_download_at < (job.claimed_at or 0):
+            # First download of this attempt
+            job.first_download_at = now
+        body = path.read_bytes()
+        self._reply(200, body=body, content_type="application/octet-stream")
+        job.last_download_at = time.monotonic()
+        job.bytes_served += len(body)
+
+
+def serve(jobs: List[FakeJob], host: str = "127.0.0.1", port: int = 0,
+          max_attempts: int = 3, lease_s: float = LEASE_S) -> FakeAPIServer:
+    """Start a server on a background thread and return it (``port=0`` picks a free port)."""
+    server = FakeAPIServer((host, port), jobs, max_attempts, lease_s)
+    threading.Thread(target=server.serve_forever, name="fakeapi", daemon=True).start()
+    return server
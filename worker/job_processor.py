@@ -4,110 +4,672 @@ Main job processing logic: download raws from webspace, stack, upload result to
 Raws live on the PHP webspace (50 GB local disk). The worker downloads them via
 /api/download_raw.php, stacks, and uploads the result to u:cloud (250 GB permanent
 storage). The PHP side handles deleting local raws when complete_job is called.
+
+Jobs are coroutines on the daemon's event loop; CPU-bound stages run in the
+stack process pool or, without one, on threads. Deep co-add jobs combine
+a pointing's 15-minute stacks from u:cloud instead of raws (``deep_stack.py``);
+light-curve jobs match the source catalogs of a pointing's stacks into its
+light-curve store (``lightcurves.py``).
 """
 
+import asyncio
+import contextlib
 import logging
 import shutil
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import aiohttp
 
 from . import config
-from .api_client import get_job_files, complete_job, fail_job, download_raw_file
-from .webdav import upload_file, mkcol
-from .stacking_adapter import stack_files
-from .thumbnail import generate_thumbnail
+from .api_client import get_job_files, complete_job, fail_job
+from .downloader import DownloadReport, download_raw_files, iter_fetch_raw_files, iter_fetch_stacks
+from .cache import get_cache
+from .compression import compress_stack, job_compression
+from .deep_stack import DeepResult, stack_deep
+from .executor import run_stage_async
+from .leases import get_leases
+from .lightcurves import LightCurveResult, update_store
+from .metrics import JobTrace, Span
+from .photometry import catalog_stack
+from .pointing import get_references, pointing_key
+from .webdav import download_file, upload_file, mkcol
+from .stacking_adapter import StackResult, stack_files
+from .streaming_stack import CHUNK_MINUTES, stack_stream
+from .thumbnail import THUMB_SIZE, generate_previews
 
 logger = logging.getLogger(__name__)
 
 
-def process_job(job: dict) -> None:
+async def _previews(job_id: int, stack_pool, result: StackResult) -> Dict[int, Path]:
+    """
+    PNG previews of a stack; a failure here does not fail the job.
+
+    Previews the streaming stacker rendered from memory are used as they are;
+    otherwise they are rendered from the (memory-mapped) FITS file.
+    """
+    if result.previews:
+        return result.previews
+    try:
+        return await run_stage_async(stack_pool, generate_previews, result.output_path)
+    except Exception as e:
+        logger.warning(f"Job {job_id}: thumbnail generation failed: {e}")
+        return {}
+
+
+async def _catalog(job_id: int, stack_pool, result: StackResult) -> Optional[Path]:
+    """Source catalog of a stack (see ``photometry``); a failure here does not fail the job."""
+    try:
+        return await run_stage_async(stack_pool, catalog_stack, result.output_path)
+    except Exception as e:
+        logger.warning(f"Job {job_id}: source catalog of {result.output_path.name} failed: {e}")
+        return None
+
+
+@contextlib.asynccontextmanager
+async def _stack_slot(trace: JobTrace, stack_slots: Optional[asyncio.Semaphore]):
+    """Hold one of ``stack_slots`` (if given), recording the wait as a span."""
+    if stack_slots is None:
+        yield
+        return
+    with trace.span("slot_wait"):
+        await stack_slots.acquire()
+    try:
+        yield
+    finally:
+        stack_slots.release()
+
+
+def _blocking_iter(
+    items: AsyncIterator, loop: asyncio.AbstractEventLoop, stop: Optional[threading.Event] = None,
+) -> Iterator:
+    """
+    Iterate an async iterator from a worker thread, each step running on
+    ``loop``; the iterator is closed (cancelling its downloads) when the
+    consumer stops early. Once ``stop`` is set, the next step raises
+    ``CancelledError`` instead of yielding, so the consumer stops between items.
+    """
+    try:
+        while True:
+            if stop is not None and stop.is_set():
+                raise asyncio.CancelledError
+            try:
+                item = asyncio.run_coroutine_threadsafe(items.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+            if stop is not None and stop.is_set():
+                raise asyncio.CancelledError
+            yield item
+    finally:
+        asyncio.run_coroutine_threadsafe(items.aclose(), loop).result()
+
+
+async def _consume_in_thread(consume: Callable, stop: threading.Event):
+    """
+    Run ``consume`` (which reads downloads through ``_blocking_iter(..., stop)``)
+    on a thread. If the job is cancelled (e.g. its lease was lost), set
+    ``stop`` and wait for the thread to give up at its next item before
+    passing the cancellation on, so the stack slot, admission budget and work
+    directory are not released while the thread still writes there.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(consume))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        stop.set()
+        while not task.done():
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                pass
+        if not task.cancelled():
+            task.exception()
+        raise
+
+
+def _frame_offsets(files: List[dict], chunk_key: str) -> Dict[str, float]:
+    """
+    Seconds from the start of the chunk to each file's DATE-OBS.
+
+    The chunk key starts with ``YYYYMMDD.NN`` where NN counts 15-minute
+    windows since UTC midnight (see computeChunkKey() in web/fits_utils.php).
+    """
+    day, index = chunk_key.split("_")[0].split(".")
+    start = datetime.strptime(day, "%Y%m%d").replace(tzinfo=timezone.utc)
+    start += timedelta(minutes=CHUNK_MINUTES * int(index))
+
+    offsets = {}
+    for f in files:
+        if f.get("fits_date_obs"):
+            t = datetime.strptime(f["fits_date_obs"], "%Y-%m-%d %H:%M:%S")
+            offsets[f["filename"]] = (t.replace(tzinfo=timezone.utc) - start).total_seconds()
+    return offsets
+
+
+async def _upload_product(
+    job_id: int,
+    result: StackResult,
+    previews: Dict[int, Path],
+    remote_dir: str,
+) -> Tuple[str, Optional[str], Optional[str], float]:
+    """
+    Upload one stack with its previews and catalog; returns the stack,
+    thumbnail and catalog remote paths and the seconds the stack upload took.
+    """
+    stack_remote_path = f"{remote_dir}/{result.output_path.name}"
+    logger.info(f"Job {job_id}: uploading stack to u:cloud {stack_remote_path}")
+    upload = await upload_file(result.output_path, stack_remote_path)
+    logger.info(
+        f"Job {job_id}: uploaded {upload.n_bytes / 1e6:.1f} MB in {upload.elapsed:.1f}s "
+        f"({upload.mb_per_s:.1f} MB/s, {upload.n_chunks} chunks, "
+        f"{upload.n_chunks_resumed} resumed)"
+    )
+
+    previews = {size: p for size, p in sorted(previews.items()) if p.exists()}
+    extras = list(previews.values())
+    if result.catalog is not None and result.catalog.exists():
+        extras.append(result.catalog)
+    await asyncio.gather(*(upload_file(p, f"{remote_dir}/{p.name}") for p in extras))
+    thumb_remote_path = (
+        f"{remote_dir}/{previews[THUMB_SIZE].name}" if THUMB_SIZE in previews else None
+    )
+    catalog_remote_path = (
+        f"{remote_dir}/{result.catalog.name}" if result.catalog in extras else None
+    )
+    return stack_remote_path, thumb_remote_path, catalog_remote_path, upload.elapsed
+
+
+def _product_metadata(
+    result: StackResult,
+    stack_remote_path: str,
+    thumb_remote_path: Optional[str],
+    catalog_remote_path: Optional[str],
+    upload_s: float,
+) -> dict:
+    return {
+        "ucloud_path": stack_remote_path,
+        "thumbnail_path": thumb_remote_path,
+        "catalog_path": catalog_remote_path,
+        "cadence_min": result.cadence_min,
+        "slot_index": result.slot_index,
+        "n_frames_input": result.n_frames_input,
+        "n_frames_aligned": result.n_aligned,
+        "total_exptime": result.total_exptime,
+        "date_obs_start": result.date_obs_start,
+        "date_obs_end": result.date_obs_end,
+        "ra_deg": result.ra_deg,
+        "dec_deg": result.dec_deg,
+        "file_size_bytes": result.output_path.stat().st_size,
+        "n_stars_detected": result.n_stars_detected,
+        "compression": result.compression,
+        "uncompressed_bytes": result.uncompressed_bytes,
+        "upload_s": round(upload_s, 3),
+    }
+
+
+def _first_file_first(items, max_held: int):
+    """
+    Yield ``(index, data)`` with index 0 first if it arrives within ``max_held``
+    items, so every attempt of a job aligns to the same reference frame and
+    cached transforms stay valid.
+    """
+    held = []
+    for i, data in items:
+        if held is None:
+            yield i, data
+        elif i == 0 or len(held) >= max_held:
+            yield i, data
+            yield from held
+            held = None
+        else:
+            held.append((i, data))
+    if held:
+        yield from held
+
+
+def _stack_remote_dir(job: dict) -> str:
+    safe_object = (job.get("object_name") or "unknown").replace("/", "_").replace(" ", "_")
+    return f"{config.UCLOUD_BASE_PATH}/stacks/user_{job['user_id']}/{safe_object}"
+
+
+async def _fetch_state(job_id: int, remote_path: str, local_path: Path) -> Optional[Path]:
+    """Download a deep co-add's state or a light-curve store; None if it has none yet."""
+    try:
+        await download_file(remote_path, local_path)
+    except aiohttp.ClientResponseError as e:
+        if e.status != 404:
+            raise
+        logger.info(f"Job {job_id}: nothing at {remote_path} yet, starting from scratch")
+        return None
+    return local_path
+
+
+async def process_deep_job(job: dict, stack_pool=None, stack_slots=None) -> None:
+    """
+    Fold new 15-minute stacks of a pointing into its deep co-add (``job["type"]
+    == "deep"``, see ``deep_stack``).
+
+    1. Download the co-add's state (running sums) from u:cloud, if any
+    2. Stream the new stacks from u:cloud into ``stack_deep`` on a thread
+    3. Tile-compress the deep image (per the owner's tier)
+    4. Upload the deep FITS + previews, then the state, to u:cloud
+    5. Report the co-add and the stacks now in it to the API
+    """
+    job_id = job["job_id"]
+    stacks = job.get("stacks") or []
+    pointing = str(job.get("pointing_key") or f"id{job.get('deep_stack_id')}")
+    remote_dir = f"{_stack_remote_dir(job)}/deep"
+    name = f"deep_{pointing}"
+    state_remote_path = job.get("state_path") or f"{remote_dir}/{name}_state.fits"
+
+    work_dir = config.WORK_DIR / f"job_{job_id}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    leases = get_leases()
+    trace = JobTrace(job_id, config.TRACE_DIR, on_stage=lambda stage: leases.report(job_id, stage))
+    if job.get("claimed_at") is not None:
+        trace.add(Span("queue_wait", start=time.time(), wall_s=time.monotonic() - job["claimed_at"]))
+    status = "failed"
+
+    try:
+        if not stacks:
+            await fail_job(job_id, "No new stacks for this deep co-add.")
+            return
+
+        # 1. Running sums of the stacks already in the co-add
+        with trace.span("state"):
+            previous = await _fetch_state(job_id, state_remote_path, work_dir / "previous_state.fits")
+
+        # 2. Stream the new stacks in
+        logger.info(
+            f"Job {job_id}: adding {len(stacks)} stacks to deep co-add {pointing} "
+            f"({'new' if previous is None else 'incremental'})"
+        )
+        download = DownloadReport()
+        fetched = iter_fetch_stacks(stacks, label=f"Job {job_id}", report=download)
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+
+        def fold() -> DeepResult:
+            with trace.span("deep") as span:
+                leases.report(job_id, "deep", lambda: download.n_files, len(stacks))
+                result = stack_deep(
+                    ((stacks[i], data) for i, data in _blocking_iter(fetched, loop, stop)),
+                    work_dir / f"{name}.fits", work_dir / f"{name}_state.fits", previous,
+                )
+                span.bytes_in = download.n_bytes
+                span.frames = len(result.added)
+                span.fields.update(download_s=download.elapsed, n_rejected=len(result.rejected),
+                                   n_stacks=result.state.n_stacks if result.state else 0)
+            return result
+
+        async with _stack_slot(trace, stack_slots):
+            deep = await _consume_in_thread(fold, stop)
+        product = deep.product
+        for stack_id, reason in sorted(deep.rejected.items()):
+            logger.info(f"Job {job_id}: stack {stack_id} left out: {reason}")
+
+        if product is None:
+            # Nothing to co-add yet: record the stacks as members all the
+            # same, so later deep jobs of this pointing do not offer them again
+            with trace.span("complete"):
+                await complete_job(job_id, {"members": sorted(deep.rejected)})
+            status = "completed"
+            logger.warning(
+                f"Job {job_id}: none of {len(stacks)} stacks could start deep co-add {pointing}"
+            )
+            return
+
+        # 3. Compress the deep image (the state is compressed losslessly already)
+        compression = job_compression(job)
+        if compression.enabled:
+            with trace.span("compress") as span:
+                report = await run_stage_async(stack_pool, compress_stack, product.output_path, compression)
+                product.compression = report.compression
+                product.uncompressed_bytes = report.bytes_before
+                span.bytes_in, span.bytes_out = report.bytes_before, report.bytes_after
+
+        # 4. Upload; the state goes last, so a failed upload leaves the old
+        # state and the retry recomputes the same co-add
+        with trace.span("upload") as span:
+            await mkcol(remote_dir)
+            remote = await _upload_product(job_id, product, product.previews, remote_dir)
+            await upload_file(deep.state_path, state_remote_path)
+            span.bytes_out = product.output_path.stat().st_size + deep.state_path.stat().st_size
+
+        # 5. Report completion
+        metadata = _product_metadata(product, *remote)
+        metadata.update(
+            state_path=state_remote_path,
+            n_stacks=deep.state.n_stacks,
+            members=deep.added + sorted(deep.rejected),
+        )
+        with trace.span("complete"):
+            await complete_job(job_id, metadata)
+        status = "completed"
+        logger.info(
+            f"Job {job_id}: deep co-add {pointing} now has {deep.state.n_stacks} stacks, "
+            f"{deep.state.n_frames} frames, {deep.state.total_exptime:.0f}s "
+            f"({len(deep.added)} added)"
+        )
+
+    except Exception as e:
+        logger.error(f"Job {job_id}: failed — {e}", exc_info=True)
+        try:
+            await fail_job(job_id, str(e)[:500])
+        except Exception:
+            logger.error(f"Job {job_id}: could not report failure to API")
+
+    finally:
+        trace.finish(status, mode="deep")
+        if work_dir.exists():
+            await asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True)
+
+
+async def process_lightcurve_job(job: dict) -> None:
+    """
+    Match the source catalogs of a pointing's new stacks into its light-curve
+    store (``job["type"] == "lightcurve"``, see ``lightcurves``).
+
+    1. Download the store from u:cloud, if any
+    2. Stream the new catalogs from u:cloud into ``update_store`` on a thread
+    3. Upload the store
+    4. Report the store and the stacks now in it to the API
+    """
+    job_id = job["job_id"]
+    catalogs = job.get("catalogs") or []
+    pointing = str(job.get("pointing_key") or f"id{job.get('light_curve_id')}")
+    store_remote_path = (
+        job.get("store_path") or f"{_stack_remote_dir(job)}/lightcurves/lc_{pointing}.npz"
+    )
+
+    work_dir = config.WORK_DIR / f"job_{job_id}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    leases = get_leases()
+    trace = JobTrace(job_id, config.TRACE_DIR, on_stage=lambda stage: leases.report(job_id, stage))
+    if job.get("claimed_at") is not None:
+        trace.add(Span("queue_wait", start=time.time(), wall_s=time.monotonic() - job["claimed_at"]))
+    status = "failed"
+
+    try:
+        if not catalogs:
+            await fail_job(job_id, "No new catalogs for this light-curve store.")
+            return
+
+        # 1. The store so far
+        with trace.span("state"):
+            previous = await _fetch_state(job_id, store_remote_path, work_dir / "previous_store.npz")
+
+        # 2. Match the new catalogs in
+        logger.info(f"Job {job_id}: matching {len(catalogs)} catalogs into light curves of {pointing}")
+        download = DownloadReport()
+        fetched = iter_fetch_stacks(catalogs, label=f"Job {job_id}", report=download, key="catalog_path")
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+
+        def match() -> LightCurveResult:
+            with trace.span("match") as span:
+                leases.report(job_id, "match", lambda: download.n_files, len(catalogs))
+                result = update_store(
+                    ((catalogs[i], data) for i, data in _blocking_iter(fetched, loop, stop)),
+                    work_dir / f"lc_{pointing}.npz", previous,
+                )
+                span.bytes_in = download.n_bytes
+                span.frames = len(result.added)
+                span.fields.update(n_rejected=len(result.rejected), n_sources=result.store.n_sources)
+            return result
+
+        lc = await _consume_in_thread(match, stop)
+        for stack_id, reason in sorted(lc.rejected.items()):
+            logger.info(f"Job {job_id}: catalog of stack {stack_id} left out: {reason}")
+
+        # 3. Upload
+        with trace.span("upload") as span:
+            await mkcol(store_remote_path.rsplit("/", 1)[0])
+            await upload_file(lc.store_path, store_remote_path)
+            span.bytes_out = lc.store_path.stat().st_size
+
+        # 4. Report completion
+        store = lc.store
+        with trace.span("complete"):
+            await complete_job(job_id, {
+                "store_path": store_remote_path,
+                "file_size_bytes": lc.store_path.stat().st_size,
+                "n_sources": store.n_sources,
+                "n_epochs": store.n_epochs,
+                "n_points": store.n_points,
+                "members": lc.added + sorted(lc.rejected),
+            })
+        status = "completed"
+        logger.info(
+            f"Job {job_id}: light curves of {pointing} now have {store.n_sources} sources, "
+            f"{store.n_epochs} epochs, {store.n_points} points ({len(lc.added)} added)"
+        )
+
+    except Exception as e:
+        logger.error(f"Job {job_id}: failed — {e}", exc_info=True)
+        try:
+            await fail_job(job_id, str(e)[:500])
+        except Exception:
+            logger.error(f"Job {job_id}: could not report failure to API")
+
+    finally:
+        trace.finish(status, mode="lightcurve")
+        if work_dir.exists():
+            await asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True)
+
+
+async def process_job(job: dict, stack_pool=None, stack_slots=None) -> None:
     """
     Process a single stacking job end-to-end.
 
+    I/O runs on the event loop. If ``stack_pool`` (an ``executor.StackPool``)
+    is given, stacking and preview generation run in its worker processes,
+    otherwise on threads. ``stack_slots`` (an ``asyncio.Semaphore``) bounds how many jobs stack at once; in disk
+    mode raws are downloaded before a slot is taken, so prefetched jobs download
+    while others stack.
+
+    If the job asks for finer cadences than the chunk (``job["cadences"]``,
+    e.g. ``[15, 3, 1]`` for paid tiers), it is stacked with the streaming
+    engine, which produces all cadences in one pass; each product becomes its
+    own ``stacked_frames`` row. ``stack_stream`` is synchronous and runs on a
+    thread, pulling frames from the concurrent downloads on the event loop.
+
+    Each stage (and, while downloading, the files done) goes out with the
+    lease heartbeats of held jobs (see ``leases``).
+
     1. Fetch file list from API
-    2. Download raw FITS from PHP webspace via API
-    3. Stack with seestarpy
-    4. Upload stacked FITS + thumbnail to u:cloud
-    5. Report completion to API (PHP deletes local raws)
+    2. Download raw FITS from PHP webspace via API (parallel streams)
+    3. Stack with seestarpy, or stream frames through the in-memory stacker,
+       then measure each stack's sources (``photometry``)
+    4. Tile-compress the stacks (per the owner's tier, see ``compression``)
+    5. Upload stacked FITS + previews (256/512/1024 px) + catalogs to u:cloud
+    6. Report completion to API (PHP deletes local raws)
+
+    Deep co-add jobs (``job["type"] == "deep"``) go to ``process_deep_job``,
+    light-curve jobs (``"lightcurve"``) to ``process_lightcurve_job``.
     """
+    if job.get("type") == "deep":
+        await process_deep_job(job, stack_pool, stack_slots)
+        return
+    if job.get("type") == "lightcurve":
+        await process_lightcurve_job(job)
+        return
+
     job_id = job["job_id"]
-    user_id = job["user_id"]
     chunk_key = job["chunk_key"]
-    object_name = job.get("object_name") or "unknown"
+    cadences = sorted({int(c) for c in job.get("cadences") or [CHUNK_MINUTES]}, reverse=True)
+    tiered = cadences != [CHUNK_MINUTES]
 
     work_dir = config.WORK_DIR / f"job_{job_id}"
     raws_dir = work_dir / "raws"
-    raws_dir.mkdir(parents=True, exist_ok=True)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    leases = get_leases()
+    trace = JobTrace(job_id, config.TRACE_DIR, on_stage=lambda stage: leases.report(job_id, stage))
+    if job.get("claimed_at") is not None:
+        # Set by run_daemon when the job was claimed (time.monotonic())
+        trace.add(Span("queue_wait", start=time.time(), wall_s=time.monotonic() - job["claimed_at"]))
+    status = "failed"
 
     try:
         # 1. Get file list
         logger.info(f"Job {job_id}: fetching file list")
-        file_info = get_job_files(job_id)
+        with trace.span("files"):
+            file_info = await get_job_files(job_id)
         files = file_info["files"]
 
         if not files:
-            fail_job(job_id, "No raw files found for this job.")
+            await fail_job(job_id, "No raw files found for this job.")
             return
 
-        # 2. Download raws from PHP webspace
-        logger.info(f"Job {job_id}: downloading {len(files)} raw files from webspace")
-        local_paths = []
-        for f in files:
-            local_path = raws_dir / f["filename"]
-            download_raw_file(int(f["id"]), local_path)
-            local_paths.append(local_path)
-
-        # 3. Stack
-        logger.info(f"Job {job_id}: stacking {len(local_paths)} frames")
+        # 2-3. Download raws from PHP webspace, stack, generate previews
+        mode = "streaming" if tiered else config.STACK_MODE
+        logger.info(
+            f"Job {job_id}: downloading {len(files)} raw files from webspace "
+            f"({config.DOWNLOAD_CONCURRENCY} streams, {mode} stacking, "
+            f"cadences {'/'.join(map(str, cadences))} min)"
+        )
         stack_output = work_dir / f"stack_{chunk_key}_{job_id}.fits"
-        result = stack_files(local_paths, stack_output)
+        if mode == "streaming":
+            # Frames are decoded and folded in as they arrive; no raws on disk
+            download = DownloadReport()
+            fetched = iter_fetch_raw_files(files, label=f"Job {job_id}", report=download)
+            loop = asyncio.get_running_loop()
+            stop = threading.Event()
 
-        # 4. Generate thumbnail
-        thumb_output = work_dir / f"stack_{chunk_key}_{job_id}_thumb.png"
-        try:
-            generate_thumbnail(stack_output, thumb_output)
-        except Exception as e:
-            logger.warning(f"Job {job_id}: thumbnail generation failed: {e}")
-            thumb_output = None
+            def stream() -> StackResult:
+                # On a thread, so the span's CPU time is the stacker's
+                with trace.span("stream") as span:
+                    leases.report(job_id, "stream", lambda: download.n_files, len(files))
+                    frames = (
+                        (files[i]["filename"], data)
+                        for i, data in _first_file_first(
+                            _blocking_iter(fetched, loop, stop), 2 * config.DOWNLOAD_CONCURRENCY,
+                        )
+                    )
+                    result = stack_stream(
+                        frames, stack_output, pool=stack_pool, cache=get_cache(),
+                        cadences=cadences, frame_offsets=_frame_offsets(files, chunk_key),
+                        screen=config.PRESCREEN, references=get_references(),
+                        pointing=pointing_key(job), align=config.ALIGN_METHOD,
+                    )
+                    span.bytes_in = download.n_bytes
+                    span.frames = result.n_frames_input
+                    span.fields.update(download_s=download.elapsed, n_cached=download.n_cached,
+                                       n_rejected=len(result.rejected))
+                return result
+
+            async with _stack_slot(trace, stack_slots):
+                result = await _consume_in_thread(stream, stop)
+            products = [result] + result.products
+        else:
+            with trace.span("download") as span:
+                download = DownloadReport()
+                leases.report(job_id, "download", lambda: download.n_files, len(files))
+                local_paths, download = await download_raw_files(
+                    files, raws_dir, label=f"Job {job_id}", report=download,
+                )
+                span.bytes_in = download.n_bytes
+                span.frames = len(local_paths)
+                span.fields.update(n_retries=download.n_retries, n_cached=download.n_cached)
+            async with _stack_slot(trace, stack_slots):
+                with trace.span("stack") as span:
+                    logger.info(f"Job {job_id}: stacking {len(local_paths)} frames")
+                    result = await run_stage_async(
+                        stack_pool, stack_files, local_paths, stack_output,
+                        screen=config.PRESCREEN, align=config.ALIGN_METHOD,
+                        combine=config.STACK_COMBINE,
+                    )
+                    products = [result]
+                    span.frames = result.n_frames_input
+                    span.fields.update(n_rejected=len(result.rejected))
+        if result.rejected:
+            logger.info(
+                f"Job {job_id}: {len(result.rejected)} frames left out: "
+                + "; ".join(f"{name}: {reason}" for name, reason in sorted(result.rejected.items()))
+            )
+        with trace.span("previews") as span:
+            previews = await asyncio.gather(*(_previews(job_id, stack_pool, p) for p in products))
+            span.frames = len(products)
+        with trace.span("catalog") as span:
+            catalogs = await asyncio.gather(*(_catalog(job_id, stack_pool, p) for p in products))
+            for p, catalog in zip(products, catalogs):
+                p.catalog = catalog
+            span.frames = len(products)
+        logger.info(
+            f"Job {job_id}: downloaded {download.n_bytes / 1e6:.1f} MB in "
+            f"{download.elapsed:.1f}s ({download.mb_per_s:.1f} MB/s, {download.n_retries} retries, "
+            f"{download.n_cached} files from cache)"
+        )
+
+        # 4. Compress stacks in the stack processes (previews are done, so the
+        # files are no longer read back)
+        compression = job_compression(job)
+        if compression.enabled:
+            with trace.span("compress") as span:
+                reports = await asyncio.gather(*(
+                    run_stage_async(stack_pool, compress_stack, p.output_path, compression)
+                    for p in products
+                ))
+                for p, report in zip(products, reports):
+                    p.compression = report.compression
+                    p.uncompressed_bytes = report.bytes_before
+                before = sum(r.bytes_before for r in reports)
+                after = sum(r.bytes_after for r in reports)
+                span.bytes_in, span.bytes_out = before, after
+                span.fields.update(compression=compression.label)
+            logger.info(
+                f"Job {job_id}: compressed {len(products)} stacks ({compression.label}) "
+                f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+                f"in {sum(r.elapsed for r in reports):.1f}s"
+            )
 
-        # 5. Upload stacked result to u:cloud (permanent storage)
-        safe_object = object_name.replace("/", "_").replace(" ", "_")
-        stack_remote_dir = f"{config.UCLOUD_BASE_PATH}/stacks/user_{user_id}/{safe_object}"
-        mkcol(stack_remote_dir)
+        # 5. Upload stacked results to u:cloud (permanent storage)
+        stack_remote_dir = _stack_remote_dir(job)
+        with trace.span("upload") as span:
+            await mkcol(stack_remote_dir)
+            uploads = asyncio.Semaphore(max(1, config.UPLOAD_PARALLEL))
 
-        stack_remote_path = f"{stack_remote_dir}/stack_{chunk_key}_{job_id}.fits"
-        logger.info(f"Job {job_id}: uploading stack to u:cloud {stack_remote_path}")
-        upload_file(stack_output, stack_remote_path)
+            async def upload(product: StackResult, product_previews: Dict[int, Path]):
+                async with uploads:
+                    return await _upload_product(job_id, product, product_previews, stack_remote_dir)
 
-        thumb_remote_path = None
-        if thumb_output and thumb_output.exists():
-            thumb_remote_path = f"{stack_remote_dir}/stack_{chunk_key}_{job_id}_thumb.png"
-            upload_file(thumb_output, thumb_remote_path)
+            remote = await asyncio.gather(*(upload(p, pv) for p, pv in zip(products, previews)))
+            span.bytes_out = sum(
+                p.stat().st_size
+                for r, pv in zip(products, previews)
+                for p in [r.output_path, *pv.values(), r.catalog]
+                if p is not None and p.exists()
+            )
 
         # 6. Report completion (PHP will delete local raws from webspace)
-        metadata = {
-            "ucloud_path": stack_remote_path,
-            "thumbnail_path": thumb_remote_path,
-            "n_frames_input": result.n_frames_input,
-            "n_frames_aligned": result.n_aligned,
-            "total_exptime": result.total_exptime,
-            "date_obs_start": result.date_obs_start,
-            "date_obs_end": result.date_obs_end,
-            "ra_deg": result.ra_deg,
-            "dec_deg": result.dec_deg,
-            "file_size_bytes": stack_output.stat().st_size,
-            "n_stars_detected": result.n_stars_detected,
-        }
-        complete_job(job_id, metadata)
-        logger.info(f"Job {job_id}: completed ({result.n_aligned}/{result.n_frames_input} aligned)")
+        metadata = _product_metadata(result, *remote[0])
+        if tiered:
+            metadata["products"] = [
+                _product_metadata(p, *r) for p, r in zip(products[1:], remote[1:])
+            ]
+        with trace.span("complete"):
+            await complete_job(job_id, metadata)
+        status = "completed"
+        logger.info(
+            f"Job {job_id}: completed ({result.n_aligned}/{result.n_frames_input} aligned, "
+            f"{len(products)} products)"
+        )
 
     except Exception as e:
         logger.error(f"Job {job_id}: failed — {e}", exc_info=True)
         try:
-            fail_job(job_id, str(e)[:500])
+            await fail_job(job_id, str(e)[:500])
         except Exception:
             logger.error(f"Job {job_id}: could not report failure to API")
 
     finally:
+        trace.finish(status, mode="streaming" if tiered else config.STACK_MODE)
         # Clean up local work directory
         if work_dir.exists():
-            shutil.rmtree(work_dir, ignore_errors=True)
+            await asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True)
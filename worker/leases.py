@@ -0,0 +1,119 @@
+"""
+Job leases: a claimed job stays ``processing`` only while its worker renews it.
+
+``next_job.php`` gives every claimed job a lease of ``JOB_LEASE_SECONDS``
+(PHP config). While a job is held here (from its claim until it finishes,
+including time queued for admission), ``heartbeat_loop`` renews the leases of
+all held jobs in one ``heartbeat_job.php`` call every HEARTBEAT_INTERVAL
+seconds, together with each job's progress (stage, and items done / total
+where the stage counts them). A job whose worker dies stops being renewed and
+goes back to the queue once its lease expires.
+
+Jobs the API reports as no longer leased to this worker (reclaimed after a
+lost heartbeat, or deleted) are handed to ``on_lost``, which stops them.
+"""
+
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Union
+
+from . import config
+from .api_client import heartbeat
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Progress:
+    stage: str = "queued"
+    # Items done (or a callable returning them, read at heartbeat time) and the total
+    done: Union[int, Callable[[], int], None] = None
+    total: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        done = self.done() if callable(self.done) else self.done
+        return {"stage": self.stage, "done": done, "total": self.total}
+
+
+class Leases:
+    """Jobs held by this worker and their progress (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: Dict[int, dict] = {}
+        self._progress: Dict[int, Progress] = {}
+
+    def hold(self, job: dict) -> None:
+        """Start renewing a claimed job's lease."""
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            self._progress.setdefault(job["job_id"], Progress())
+
+    def release(self, job_id: int) -> None:
+        """Stop renewing (the job completed, failed or was lost)."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._progress.pop(job_id, None)
+
+    def report(
+        self,
+        job_id: int,
+        stage: str,
+        done: Union[int, Callable[[], int], None] = None,
+        total: Optional[int] = None,
+    ) -> None:
+        """Set a held job's progress for the next heartbeat (ignored for other jobs)."""
+        with self._lock:
+            if job_id in self._progress:
+                self._progress[job_id] = Progress(stage, done, total)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def snapshot(self) -> Dict[int, dict]:
+        """Progress of every held job, by job id."""
+        with self._lock:
+            progress = dict(self._progress)
+        return {job_id: p.to_dict() for job_id, p in progress.items()}
+
+    def job(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+_leases = Leases()
+
+
+def get_leases() -> Leases:
+    """The process-wide lease registry."""
+    return _leases
+
+
+async def renew(leases: Leases, on_lost: Callable[[dict], None]) -> None:
+    """Renew every held lease once; jobs the API no longer leases to us go to ``on_lost``."""
+    progress = leases.snapshot()
+    if not progress:
+        return
+    lost = await heartbeat(progress)
+    for job_id in lost:
+        job = leases.job(job_id)
+        if job is None:
+            continue
+        logger.warning(f"Job {job_id}: lease lost (reclaimed by the API), stopping it")
+        leases.release(job_id)
+        on_lost(job)
+
+
+async def heartbeat_loop(on_lost: Callable[[dict], None], leases: Optional[Leases] = None) -> None:
+    """Renew leases every HEARTBEAT_INTERVAL seconds until cancelled."""
+    if leases is None:
+        leases = get_leases()
+    while True:
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL)
+        try:
+            await renew(leases, on_lost)
+        except Exception as e:
+            # The lease outlasts a few missed beats; keep trying
+            logger.warning(f"Heartbeat for {len(leases)} jobs failed: {e}")
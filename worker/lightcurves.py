@@ -0,0 +1,390 @@
+"""
+Per-pointing light curves built from the source catalogs of its stacks.
+
+Stacks are not plate-solved (Seestar raws carry only the pointing centre), so
+a source is identified by its position on a reference grid: the pixel grid of
+the first catalog added. Each new catalog is aligned onto it by its brightest
+stars (``astroalign``, as in ``deep_stack``) and its sources are matched to
+the known ones through a KD-tree within MATCH_RADIUS pixels; unmatched
+sources with a signal-to-noise of at least MIN_NEW_SNR become new sources.
+Only the new catalog is matched, so adding a stack costs O(its sources), not
+O(history).
+
+Each catalog is an epoch. Its zero point is the median offset of its clean,
+bright matched sources from their mean magnitude so far (the first epoch
+sets the scale), so light curves are relative photometry against the
+ensemble of the field.
+
+The store is one ``.npz`` file, rewritten on each update:
+
+- sources: ``src_x``, ``src_y`` (reference grid), ``src_n`` (points with a
+  magnitude) and ``src_mag_sum`` (their calibrated magnitudes summed)
+- epochs: ``ep_stack_id`` (``stacked_frames.id``), ``ep_cadence``, ``ep_mjd``
+  (mid-exposure), ``ep_exptime``, ``ep_zp``, ``ep_n_matched``
+- points, grouped by source: ``offsets`` (n_sources + 1) and ``pt_epoch``,
+  ``pt_mag`` (instrumental), ``pt_mag_err``, ``pt_flux``, ``pt_flux_err``,
+  ``pt_flag``
+- ``ref_points``: the control stars of the reference grid
+
+The light curve of source ``i`` is the slice ``offsets[i]:offsets[i + 1]`` of
+the point columns, so reading one takes microseconds however long the
+history; new points are merged into their sources' slices in one pass over
+the points.
+"""
+
+import argparse
+import io
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import astroalign
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .photometry import read_catalog
+from .streaming_stack import MAX_CONTROL_STARS
+
+logger = logging.getLogger(__name__)
+
+# Largest distance [px on the reference grid] at which a detection is the
+# same source
+MATCH_RADIUS = 2.0
+# Signal-to-noise an unmatched detection needs to become a new source
+MIN_NEW_SNR = 10.0
+# Clean matched sources (no flags, at least ZP_MIN_SNR) an epoch's zero point
+# is taken from; with fewer it is taken from all matched sources
+ZP_MIN_SNR = 20.0
+ZP_MIN_STARS = 5
+
+POINT_COLUMNS = {
+    "epoch": np.int32,
+    "mag": np.float32,
+    "mag_err": np.float32,
+    "flux": np.float32,
+    "flux_err": np.float32,
+    "flag": np.uint16,
+}
+EPOCH_COLUMNS = {
+    "stack_id": np.int64,
+    "cadence": np.int16,
+    "mjd": np.float64,
+    "exptime": np.float32,
+    "zp": np.float32,
+    "n_matched": np.int32,
+}
+
+_MJD_EPOCH = datetime(1858, 11, 17)
+
+
+def _mjd(value: Optional[str]) -> float:
+    return (datetime.fromisoformat(value.replace(" ", "T")) - _MJD_EPOCH).total_seconds() / 86400
+
+
+def _mid_mjd(stack: dict) -> float:
+    """MJD of the middle of a stack's exposure (NaN without dates)."""
+    start, end = stack.get("date_obs_start"), stack.get("date_obs_end")
+    if not start:
+        return float("nan")
+    return (_mjd(start) + _mjd(end or start)) / 2
+
+
+def _control_points(catalog: Dict[str, np.ndarray]) -> np.ndarray:
+    """Positions of a catalog's brightest clean stars (catalogs are sorted by flux)."""
+    clean = catalog["flag"] == 0
+    x, y = catalog["x"][clean], catalog["y"][clean]
+    return np.column_stack([x, y])[:MAX_CONTROL_STARS].astype(np.float64)
+
+
+def _empty(columns: Dict[str, type]) -> Dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype) for name, dtype in columns.items()}
+
+
+@dataclass
+class LightCurveStore:
+    ref_points: np.ndarray = field(default_factory=lambda: np.empty((0, 2)))
+    src_x: np.ndarray = field(default_factory=lambda: np.empty(0, np.float32))
+    src_y: np.ndarray = field(default_factory=lambda: np.empty(0, np.float32))
+    src_n: np.ndarray = field(default_factory=lambda: np.empty(0, np.int32))
+    src_mag_sum: np.ndarray = field(default_factory=lambda: np.empty(0, np.float64))
+    epochs: Dict[str, np.ndarray] = field(default_factory=lambda: _empty(EPOCH_COLUMNS))
+    offsets: np.ndarray = field(default_factory=lambda: np.zeros(1, np.int64))
+    points: Dict[str, np.ndarray] = field(default_factory=lambda: _empty(POINT_COLUMNS))
+    _tree: Optional[cKDTree] = field(default=None, repr=False)
+
+    @property
+    def n_sources(self) -> int:
+        return len(self.src_x)
+
+    @property
+    def n_epochs(self) -> int:
+        return len(self.epochs["stack_id"])
+
+    @property
+    def n_points(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def members(self) -> List[int]:
+        return [int(i) for i in self.epochs["stack_id"]]
+
+    @classmethod
+    def load(cls, path) -> "LightCurveStore":
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(
+                ref_points=npz["ref_points"],
+                src_x=npz["src_x"],
+                src_y=npz["src_y"],
+                src_n=npz["src_n"],
+                src_mag_sum=npz["src_mag_sum"],
+                epochs={name: npz[f"ep_{name}"] for name in EPOCH_COLUMNS},
+                offsets=npz["offsets"],
+                points={name: npz[f"pt_{name}"] for name in POINT_COLUMNS},
+            )
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(
+                f,
+                ref_points=self.ref_points,
+                src_x=self.src_x,
+                src_y=self.src_y,
+                src_n=self.src_n,
+                src_mag_sum=self.src_mag_sum,
+                offsets=self.offsets,
+                **{f"ep_{name}": a for name, a in self.epochs.items()},
+                **{f"pt_{name}": a for name, a in self.points.items()},
+            )
+        os.replace(tmp, path)
+
+    # -- queries ----------------------------------------------------------
+
+    def _positions(self) -> cKDTree:
+        if self._tree is None or self._tree.n != self.n_sources:
+            self._tree = cKDTree(np.column_stack([self.src_x, self.src_y]))
+        return self._tree
+
+    def cone(self, x: float, y: float, radius: float) -> np.ndarray:
+        """Ids of the sources within ``radius`` pixels of a reference-grid position."""
+        if not self.n_sources:
+            return np.empty(0, np.int64)
+        return np.asarray(sorted(self._positions().query_ball_point((x, y), radius)), np.int64)
+
+    def find(self, x: float, y: float, radius: float = MATCH_RADIUS) -> Optional[int]:
+        """The source nearest a reference-grid position, if one is within ``radius``."""
+        if not self.n_sources:
+            return None
+        dist, i = self._positions().query((x, y), distance_upper_bound=radius)
+        return int(i) if np.isfinite(dist) else None
+
+    def mean_mag(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.src_mag_sum / self.src_n).astype(np.float32)
+
+    def light_curve(self, source: int) -> Dict[str, np.ndarray]:
+        """
+        Points of one source in time order: ``mjd``, calibrated ``mag`` and
+        ``mag_err``, ``flux``, ``flux_err``, ``flag``, ``stack_id`` and
+        ``cadence``.
+        """
+        lo, hi = self.offsets[source], self.offsets[source + 1]
+        epoch = self.points["epoch"][lo:hi]
+        curve = {
+            "mjd": self.epochs["mjd"][epoch],
+            "mag": self.points["mag"][lo:hi] - self.epochs["zp"][epoch],
+            "mag_err": self.points["mag_err"][lo:hi],
+            "flux": self.points["flux"][lo:hi],
+            "flux_err": self.points["flux_err"][lo:hi],
+            "flag": self.points["flag"][lo:hi],
+            "stack_id": self.epochs["stack_id"][epoch],
+            "cadence": self.epochs["cadence"][epoch],
+        }
+        order = np.argsort(curve["mjd"], kind="stable")
+        return {name: a[order] for name, a in curve.items()}
+
+    # -- updates ----------------------------------------------------------
+
+    def add(self, stack: dict, catalog: Dict[str, np.ndarray]) -> int:
+        """
+        Match one catalog into the store as a new epoch; returns the number of
+        its sources matched to known ones.
+
+        Raises:
+            ValueError: If the catalog has no stars, or they cannot be aligned
+                to the reference grid.
+        """
+        points = _control_points(catalog)
+        if not len(catalog["x"]) or not len(points):
+            raise ValueError("catalog has no clean stars")
+        xy = np.column_stack([catalog["x"], catalog["y"]]).astype(np.float64)
+        if len(self.ref_points):
+            transform, _ = astroalign.find_transform(points, self.ref_points)
+            xy = xy @ transform.params[:2, :2].T + transform.params[:2, 2]
+        else:
+            self.ref_points = points
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            snr = catalog["flux"] / catalog["flux_err"]
+        src = np.full(len(xy), -1, np.int64)
+        if self.n_sources:
+            dist, idx = self._positions().query(xy, distance_upper_bound=MATCH_RADIUS)
+            # Where two detections hit one source, the nearer one takes it
+            order = np.argsort(dist)
+            order = order[np.isfinite(dist[order])]
+            _, first = np.unique(idx[order], return_index=True)
+            src[order[first]] = idx[order[first]]
+        matched = src >= 0
+        new = ~matched & (snr >= MIN_NEW_SNR) & np.isfinite(catalog["mag"])
+        src[new] = self.n_sources + np.arange(new.sum())
+        self.src_x = np.concatenate([self.src_x, xy[new, 0].astype(np.float32)])
+        self.src_y = np.concatenate([self.src_y, xy[new, 1].astype(np.float32)])
+        self.src_n = np.concatenate([self.src_n, np.zeros(new.sum(), np.int32)])
+        self.src_mag_sum = np.concatenate([self.src_mag_sum, np.zeros(new.sum())])
+
+        mag = catalog["mag"].astype(np.float64)
+        zp = 0.0
+        if self.n_epochs and matched.any():
+            offset = mag[matched] - self.mean_mag()[src[matched]]
+            clean = (catalog["flag"][matched] == 0) & (snr[matched] >= ZP_MIN_SNR) & np.isfinite(offset)
+            use = offset[clean] if clean.sum() >= ZP_MIN_STARS else offset[np.isfinite(offset)]
+            if len(use):
+                zp = float(np.median(use))
+
+        epoch = self.n_epochs
+        row = {
+            "stack_id": int(stack["id"]),
+            "cadence": int(stack.get("cadence_min") or 15),
+            "mjd": _mid_mjd(stack),
+            "exptime": float(stack.get("total_exptime") or 0.0),
+            "zp": zp,
+            "n_matched": int(matched.sum()),
+        }
+        self.epochs = {
+            name: np.append(self.epochs[name], np.asarray(row[name], dtype))
+            for name, dtype in EPOCH_COLUMNS.items()
+        }
+
+        kept = src >= 0
+        calibrated = mag[kept] - zp
+        finite = np.isfinite(calibrated)
+        np.add.at(self.src_n, src[kept][finite], 1)
+        np.add.at(self.src_mag_sum, src[kept][finite], calibrated[finite])
+        self._merge(src[kept], {
+            "epoch": np.full(kept.sum(), epoch),
+            "mag": catalog["mag"][kept],
+            "mag_err": catalog["mag_err"][kept],
+            "flux": catalog["flux"][kept],
+            "flux_err": catalog["flux_err"][kept],
+            "flag": catalog["flag"][kept],
+        })
+        return row["n_matched"]
+
+    def _merge(self, src: np.ndarray, new: Dict[str, np.ndarray]) -> None:
+        """Insert points into their sources' slices (O(points), no sort of the old ones)."""
+        n = self.n_sources
+        old_counts = np.zeros(n, np.int64)
+        old_counts[: len(self.offsets) - 1] = np.diff(self.offsets)
+        new_counts = np.bincount(src, minlength=n)
+        offsets = np.zeros(n + 1, np.int64)
+        np.cumsum(old_counts + new_counts, out=offsets[1:])
+
+        old_src = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        old_pos = np.arange(len(old_src)) - self.offsets[old_src] + offsets[old_src]
+        order = np.argsort(src, kind="stable")
+        s = src[order]
+        new_pos = offsets[s] + old_counts[s] + np.arange(len(s)) - np.searchsorted(s, s)
+
+        points = {}
+        for name, dtype in POINT_COLUMNS.items():
+            column = np.empty(offsets[-1], dtype)
+            column[old_pos] = self.points[name]
+            column[new_pos] = np.asarray(new[name])[order].astype(dtype)
+            points[name] = column
+        self.points, self.offsets = points, offsets
+
+
+@dataclass
+class LightCurveResult:
+    store: LightCurveStore
+    store_path: Path
+    # Catalogs of this job matched in, and those left out (by id, with the reason)
+    added: List[int] = field(default_factory=list)
+    rejected: Dict[int, str] = field(default_factory=dict)
+
+
+def update_store(
+    catalogs: Iterable[Tuple[dict, bytes]],
+    store_path: Path,
+    previous_store: Optional[Path] = None,
+) -> LightCurveResult:
+    """
+    Match new catalogs into a pointing's light-curve store and write it.
+
+    Args:
+        catalogs: ``(stack, data)`` pairs: the stack's ``stacked_frames``
+            fields from the API (``id``, ``cadence_min``, dates,
+            ``total_exptime``) and its catalog ``.npz`` bytes.
+        store_path: Where to write the updated store.
+        previous_store: The store so far, if there is one.
+
+    Returns:
+        LightCurveResult. Catalogs that cannot be read or aligned are left
+        out (and recorded as members, so they are not offered again);
+        catalogs already in the store are skipped.
+    """
+    store = LightCurveStore.load(previous_store) if previous_store is not None else LightCurveStore()
+    done = set(store.members)
+    added: List[int] = []
+    rejected: Dict[int, str] = {}
+
+    for stack, data in catalogs:
+        stack_id = int(stack["id"])
+        if stack_id in done:
+            continue
+        done.add(stack_id)
+        try:
+            store.add(stack, read_catalog(io.BytesIO(data)))
+        except Exception as e:
+            rejected[stack_id] = f"{type(e).__name__}: {e}"
+            logger.warning(f"Light curves: leaving out stack {stack_id} ({e})")
+            continue
+        added.append(stack_id)
+
+    store.save(store_path)
+    return LightCurveResult(store, store_path, added, rejected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a pointing's light-curve store")
+    parser.add_argument("store", type=Path, help="Store .npz (lightcurves/ on u:cloud)")
+    parser.add_argument("--at", type=float, nargs=2, metavar=("X", "Y"),
+                        help="Light curve of the source nearest this reference-grid position")
+    parser.add_argument("--source", type=int, help="Light curve of this source id")
+    parser.add_argument("--radius", type=float, default=MATCH_RADIUS)
+    args = parser.parse_args()
+
+    store = LightCurveStore.load(args.store)
+    source = args.source
+    if args.at is not None:
+        source = store.find(*args.at, radius=args.radius)
+        if source is None:
+            sys.exit(f"No source within {args.radius} px of {args.at[0]}, {args.at[1]}")
+    if source is None:
+        print(f"{store.n_sources} sources, {store.n_epochs} epochs, {store.n_points} points")
+        return
+
+    curve = store.light_curve(source)
+    print(f"# source {source} at {store.src_x[source]:.2f}, {store.src_y[source]:.2f}")
+    print("mjd,mag,mag_err,flux,flux_err,flag,stack_id,cadence")
+    for row in zip(*curve.values()):
+        print(",".join(str(v) for v in row))
+
+
+if __name__ == "__main__":
+    main()
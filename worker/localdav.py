@@ -0,0 +1,252 @@
+"""
+Minimal local WebDAV server standing in for u:cloud during development.
+
+Serves a directory with GET, PUT, DELETE, MKCOL, PROPFIND and MOVE, including
+Nextcloud chunked upload v2 assembly (``MOVE .../.file``) and ``OC-Checksum``
+reporting, so uploads can be exercised without touching u:cloud. There is one
+namespace: URL paths map directly onto paths under ``--root``.
+
+    python -m worker.localdav --root ./dav --port 8081 [--fail-rate 0.1]
+
+Then point the worker at it, e.g.::
+
+    UCLOUD_WEBDAV_URL=http://localhost:8081/share
+    UCLOUD_UPLOADS_URL=http://localhost:8081/uploads/worker
+    UCLOUD_FILES_URL=http://localhost:8081/share
+
+Credentials are accepted but not checked.
+"""
+
+import argparse
+import logging
+import random
+import shutil
+import threading
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Optional
+from urllib.parse import quote, unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDAVServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root: Path, fail_rate: float = 0.0):
+        super().__init__(address, _Handler)
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fail_rate = fail_rate
+        self.checksums: Dict[Path, str] = {}
+        self.lock = threading.Lock()
+        # Called with (method, path, Destination header) for every PUT/MKCOL/MOVE
+        self.on_write: Optional[Callable[[str, str, Optional[str]], None]] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: LocalDAVServer
+
+    def log_message(self, fmt, *args):
+        logger.debug("%s " + fmt, self.address_string(), *args)
+
+    # -- helpers ---------------------------------------------------------
+
+    def _path(self, url: Optional[str] = None) -> Path:
+        path = unquote(urlparse(url or self.path).path)
+        local = (self.server.root / path.lstrip("/")).resolve()
+        if local != self.server.root and self.server.root not in local.parents:
+            raise PermissionError(path)
+        return local
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status: int, body: bytes = b"", content_type: str = "text/plain") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _record_write(self) -> None:
+        if self.server.on_write is not None:
+            self.server.on_write(
+                self.command, unquote(urlparse(self.path).path), self.headers.get("Destination")
+            )
+
+    def _inject_failure(self) -> bool:
+        if self.server.fail_rate and random.random() < self.server.fail_rate:
+            self._reply(503, b"injected failure")
+            return True
+        return False
+
+    # -- methods ---------------------------------------------------------
+
+    def do_GET(self):
+        self._read_body()
+        path = self._path()
+        if not path.is_file():
+            return self._reply(404)
+        self._reply(200, path.read_bytes(), "application/octet-stream")
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self._record_write()
+        body = self._read_body()
+        if self._inject_failure():
+            return
+        path = self._path()
+        if not path.parent.is_dir():
+            return self._reply(409, b"parent collection missing")
+        existed = path.exists()
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(body)
+        tmp.replace(path)
+        with self.server.lock:
+            self.server.checksums.pop(path, None)
+        self._reply(204 if existed else 201)
+
+    def do_MKCOL(self):
+        self._record_write()
+        self._read_body()
+        path = self._path()
+        if path.exists():
+            return self._reply(405, b"already exists")
+        if not path.parent.is_dir():
+            return self._reply(409, b"parent collection missing")
+        path.mkdir()
+        self._reply(201)
+
+    def do_DELETE(self):
+        self._read_body()
+        path = self._path()
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        else:
+            return self._reply(404)
+        self._reply(204)
+
+    def do_MOVE(self):
+        self._record_write()
+        self._read_body()
+        if self._inject_failure():
+            return
+        src = self._path()
+        dest = self._path(self.headers.get("Destination", ""))
+        if not dest.parent.is_dir():
+            return self._reply(409, b"destination parent missing")
+        existed = dest.exists()
+
+        if src.name == ".file":
+            # Chunked upload v2: concatenate the numbered chunks
+            transfer = src.parent
+            if not transfer.is_dir():
+                return self._reply(404)
+            chunks = sorted(
+                (p for p in transfer.iterdir() if p.name.isdigit()), key=lambda p: int(p.name)
+            )
+            tmp = dest.with_name(dest.name + ".tmp")
+            with open(tmp, "wb") as out:
+                for chunk in chunks:
+                    out.write(chunk.read_bytes())
+            total = self.headers.get("OC-Total-Length")
+            if total is not None and tmp.stat().st_size != int(total):
+                tmp.unlink()
+                return self._reply(400, b"assembled size does not match OC-Total-Length")
+            tmp.replace(dest)
+            shutil.rmtree(transfer)
+        else:
+            if not src.exists():
+                return self._reply(404)
+            src.replace(dest)
+
+        with self.server.lock:
+            checksum = self.headers.get("OC-Checksum")
+            if checksum:
+                self.server.checksums[dest] = checksum
+            else:
+                self.server.checksums.pop(dest, None)
+        self._reply(204 if existed else 201)
+
+    def do_PROPFIND(self):
+        self._read_body()
+        path = self._path()
+        if not path.exists():
+            return self._reply(404)
+        entries = [path]
+        if path.is_dir() and self.headers.get("Depth", "1") != "0":
+            entries += sorted(path.iterdir())
+
+        parts = [
+            '<?xml version="1.0"?>',
+            '<d:multistatus xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">',
+        ]
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                continue
+            href = "/" + quote(str(entry.relative_to(self.server.root)).replace("\\", "/"))
+            if entry.is_dir():
+                props = "<d:resourcetype><d:collection/></d:resourcetype>"
+            else:
+                props = f"<d:resourcetype/><d:getcontentlength>{entry.stat().st_size}</d:getcontentlength>"
+                checksum = self.server.checksums.get(entry)
+                if checksum:
+                    props += f"<oc:checksums><oc:checksum>{escape(checksum)}</oc:checksum></oc:checksums>"
+            parts.append(
+                f"<d:response><d:href>{escape(href)}</d:href>"
+                f"<d:propstat><d:prop>{props}</d:prop>"
+                f"<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+            )
+        parts.append("</d:multistatus>")
+        self._reply(207, "".join(parts).encode(), "application/xml; charset=utf-8")
+
+
+def serve(root: Path, host: str = "127.0.0.1", port: int = 0, fail_rate: float = 0.0) -> LocalDAVServer:
+    """Start a server on a background thread and return it (``port=0`` picks a free port)."""
+    server = LocalDAVServer((host, port), root, fail_rate)
+    threading.Thread(target=server.serve_forever, name="localdav", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local WebDAV stand-in for u:cloud")
+    parser.add_argument("--root", type=Path, default=Path("./dav"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Fraction of PUT/MOVE requests answered with 503")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    server = LocalDAVServer((args.host, args.port), args.root, args.fail_rate)
+    logger.info(f"Serving {server.root} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,24 @@ CrowdSky Worker entry point.
 Usage:
     python -m worker              # daemon mode (polls continuously)
     python -m worker --once       # process one job and exit (for cron)
+    python -m worker --warm       # process jobs handed over by --once runs
+
+``--once`` runs from cron and mostly finds nothing to do, so this module
+imports only the standard library and ``config``: the claim is a blocking
+standard-library request, and aiohttp, NumPy, astropy and seestarpy are
+imported only once a job has been claimed (or by the daemon and warm modes in
+``daemon.py``). If a warm worker listens on WARM_SOCKET, the claimed job is
+handed to it instead.
 """
 
 import argparse
+import json
 import logging
-import time
+import socket
 import sys
-from concurrent.futures import ThreadPoolExecutor
 
 from . import config
-from .api_client import get_next_job
-from .job_processor import process_job
+from .api_client import get_next_job_blocking
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,75 +29,89 @@ logging.basicConfig(
 )
 logger = logging.getLogger("crowdsky.worker")
 
+# Seconds to wait for a warm worker to accept a job
+HANDOVER_TIMEOUT = 10
+
+
+def _hand_over(job: dict) -> bool:
+    """Pass a claimed job to the warm worker on WARM_SOCKET; False if none accepts it."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(HANDOVER_TIMEOUT)
+            s.connect(config.WARM_SOCKET)
+            s.sendall(json.dumps(job).encode() + b"\n")
+            reply = s.makefile("rb").readline()
+    except OSError as e:
+        logger.info(f"No warm worker on {config.WARM_SOCKET} ({e}), processing here")
+        return False
+    if reply.strip() != b"accepted":
+        logger.warning(f"Warm worker did not accept job {job['job_id']}, processing here")
+        return False
+    logger.info(f"Job {job['job_id']} handed to the warm worker")
+    return True
+
+
+async def _process(job: dict) -> None:
+    import asyncio
+
+    from . import sessions
+    from .job_processor import process_job
+    from .leases import get_leases, heartbeat_loop
+
+    leases = get_leases()
+    leases.hold(job)
+    task = asyncio.create_task(process_job(job))
+    lost = []
+
+    def on_lost(job: dict) -> None:
+        lost.append(job)
+        task.cancel()
+
+    beat = asyncio.create_task(heartbeat_loop(on_lost))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not lost:
+            raise
+        logger.warning(f"Job {job['job_id']}: stopped, its lease was lost")
+    finally:
+        beat.cancel()
+        leases.release(job["job_id"])
+        await sessions.close()
+
 
 def run_once() -> bool:
-    """Poll for one job and process it. Returns True if a job was found."""
-    job = get_next_job()
+    """Claim one job and process it (or hand it over). Returns True if a job was found."""
+    job = get_next_job_blocking()
     if job is None:
         logger.info("No pending jobs.")
         return False
 
-    logger.info(f"Claimed job {job['job_id']}: {job.get('object_name', '?')} chunk={job['chunk_key']}")
-    process_job(job)
-    return True
-
+    logger.info(f"Claimed job {job['job_id']}: {job.get('object_name', '?')} chunk={job.get('chunk_key') or job.get('type')}")
+    if config.WARM_SOCKET and _hand_over(job):
+        return True
 
-def run_daemon() -> None:
-    """Poll continuously for jobs using a thread pool."""
-    logger.info(
-        f"Worker {config.WORKER_ID} starting "
-        f"(poll interval: {config.POLL_INTERVAL}s, max workers: {config.MAX_WORKERS})"
-    )
-    config.WORK_DIR.mkdir(parents=True, exist_ok=True)
-
-    with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as pool:
-        futures = set()
-        try:
-            while True:
-                # Remove completed futures
-                done = {f for f in futures if f.done()}
-                for f in done:
-                    try:
-                        f.result()
-                    except Exception as e:
-                        logger.error(f"Thread error: {e}", exc_info=True)
-                futures -= done
-
-                # If pool has capacity, try to claim a job
-                if len(futures) < config.MAX_WORKERS:
-                    job = get_next_job()
-                    if job:
-                        logger.info(f"Claimed job {job['job_id']}, submitting to thread pool")
-                        futures.add(pool.submit(process_job, job))
-                        continue  # immediately try to claim another
-                    else:
-                        logger.info("No pending jobs.")
-
-                # Sleep: briefly if threads are running, full interval if idle
-                time.sleep(config.POLL_INTERVAL if not futures else 2)
-        except KeyboardInterrupt:
-            logger.info("Shutting down, waiting for running jobs to finish...")
-            for f in futures:
-                f.cancel()
-            # Wait for running (non-cancelled) futures to complete
-            for f in futures:
-                if not f.cancelled():
-                    try:
-                        f.result(timeout=300)
-                    except Exception:
-                        pass
-            logger.info("Shutdown complete.")
+    import asyncio
+    asyncio.run(_process(job))
+    return True
 
 
 def main():
     parser = argparse.ArgumentParser(description="CrowdSky stacking worker")
-    parser.add_argument("--once", action="store_true", help="Process one job and exit")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--once", action="store_true", help="Process one job and exit")
+    mode.add_argument("--warm", action="store_true",
+                      help="Process jobs handed over by --once runs on WARM_SOCKET")
     args = parser.parse_args()
 
     if args.once:
         found = run_once()
         sys.exit(0 if found else 1)
+    elif args.warm:
+        from .daemon import run_warm
+        run_warm()
     else:
+        from .daemon import run_daemon
         run_daemon()
 
 
@@ -0,0 +1,283 @@
+"""
+Per-job stage spans, a JSON-lines trace per job, and a Prometheus endpoint.
+
+``process_job`` opens a ``JobTrace`` and wraps each stage in ``trace.span()``.
+A span records wall time, CPU time of the calling thread (for the
+asyncio core that is the event loop, shared by concurrent jobs) plus that of
+the pool tasks it ran (see ``executor.run_stage``), bytes in/out, frames and
+the process memory high-water mark. The open spans are tracked per asyncio
+task (a context variable), and follow work handed to threads with
+``asyncio.to_thread``. Finished spans are appended to
+``TRACE_DIR/job_{id}.jsonl`` (one line per span, then one per attempt) and
+folded into the process-wide counters that ``serve()`` exposes in Prometheus
+text format:
+
+    curl http://127.0.0.1:9464/metrics
+"""
+
+import contextvars
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Open spans of the current task / thread, innermost last
+_spans: contextvars.ContextVar[tuple] = contextvars.ContextVar("spans", default=())
+
+
+def max_rss_bytes() -> int:
+    """High-water mark of this process's resident memory."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+@dataclass
+class Span:
+    stage: str
+    start: float = 0.0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    # CPU time and memory high-water mark of pool processes used by this stage
+    child_cpu_s: float = 0.0
+    child_max_rss: int = 0
+    max_rss: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    frames: int = 0
+    error: Optional[str] = None
+    fields: dict = field(default_factory=dict)
+
+    @property
+    def frames_per_s(self) -> float:
+        return self.frames / self.wall_s if self.wall_s > 0 and self.frames else 0.0
+
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d.update(d.pop("fields"))
+        d["frames_per_s"] = self.frames_per_s
+        return d
+
+
+def current_span() -> Optional[Span]:
+    """The innermost open span of this task or thread, if any."""
+    stack = _spans.get()
+    return stack[-1] if stack else None
+
+
+def record_child(cpu_s: float, max_rss: int) -> None:
+    """Charge a pool task's CPU time and memory to the current span."""
+    span = current_span()
+    if span is not None:
+        span.child_cpu_s += cpu_s
+        span.child_max_rss = max(span.child_max_rss, max_rss)
+
+
+class JobTrace:
+    """Stage spans of one job attempt."""
+
+    def __init__(
+        self,
+        job_id: int,
+        trace_dir: Optional[Path] = None,
+        on_stage: Optional[Callable[[str], None]] = None,
+    ):
+        self.job_id = job_id
+        self.trace_dir = trace_dir
+        # Called with the stage name whenever a span opens (progress reports)
+        self.on_stage = on_stage
+        self.started = time.time()
+        self.spans: List[Span] = []
+        registry.job_started()
+
+    def add(self, span: Span) -> None:
+        """Record a finished span (also used for spans measured elsewhere)."""
+        self.spans.append(span)
+        registry.observe(span)
+        self._write({"job_id": self.job_id, "type": "span", **span.to_dict()})
+
+    @contextmanager
+    def span(self, stage: str, **fields) -> Iterator[Span]:
+        """Measure a stage; set ``bytes_in``/``frames``/... on the yielded span."""
+        s = Span(stage, start=time.time(), fields=fields)
+        if self.on_stage is not None:
+            self.on_stage(stage)
+        token = _spans.set(_spans.get() + (s,))
+        wall0, cpu0 = time.monotonic(), time.thread_time()
+        try:
+            yield s
+        except BaseException as e:
+            s.error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            _spans.reset(token)
+            s.wall_s = time.monotonic() - wall0
+            s.cpu_s = time.thread_time() - cpu0
+            s.max_rss = max_rss_bytes()
+            self.add(s)
+
+    def finish(self, status: str, **fields) -> dict:
+        """Write the attempt summary line and count the job; returns the summary."""
+        summary = {
+            "job_id": self.job_id,
+            "type": "job",
+            "status": status,
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+            "wall_s": time.time() - self.started,
+            "cpu_s": sum(s.cpu_s + s.child_cpu_s for s in self.spans),
+            "bytes_in": sum(s.bytes_in for s in self.spans),
+            "bytes_out": sum(s.bytes_out for s in self.spans),
+            "max_rss": max([s.max_rss for s in self.spans] + [0]),
+            "stages": {s.stage: round(s.wall_s, 3) for s in self.spans},
+            **fields,
+        }
+        registry.job_done(status)
+        self._write(summary)
+        return summary
+
+    def _write(self, record: dict) -> None:
+        if self.trace_dir is None:
+            return
+        try:
+            self.trace_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.trace_dir / f"job_{self.job_id}.jsonl", "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            logger.warning(f"Job {self.job_id}: could not write trace: {e}")
+
+
+class _Registry:
+    """Process-wide counters and stage histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, int] = {}
+        self.running = 0
+        # stage -> [bucket counts..., count, sum]
+        self.durations: Dict[str, List[float]] = {}
+        self.cpu: Dict[str, float] = {}
+        self.bytes_in: Dict[str, int] = {}
+        self.bytes_out: Dict[str, int] = {}
+        self.frames: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        # Extra sources, each returning [(name, type, help, {labels: value})]
+        # with labels as a tuple of (key, value) pairs
+        self.collectors: List[Callable[[], list]] = []
+
+    def observe(self, span: Span) -> None:
+        with self.lock:
+            hist = self.durations.setdefault(span.stage, [0.0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if span.wall_s <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += span.wall_s
+            self.cpu[span.stage] = self.cpu.get(span.stage, 0.0) + span.cpu_s + span.child_cpu_s
+            self.bytes_in[span.stage] = self.bytes_in.get(span.stage, 0) + span.bytes_in
+            self.bytes_out[span.stage] = self.bytes_out.get(span.stage, 0) + span.bytes_out
+            self.frames[span.stage] = self.frames.get(span.stage, 0) + span.frames
+            if span.error:
+                self.errors[span.stage] = self.errors.get(span.stage, 0) + 1
+
+    def job_started(self) -> None:
+        with self.lock:
+            self.running += 1
+
+    def job_done(self, status: str) -> None:
+        with self.lock:
+            self.running -= 1
+            self.jobs[status] = self.jobs.get(status, 0) + 1
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format."""
+        lines: List[str] = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+
+        with self.lock:
+            family("crowdsky_jobs_total", "counter", "Finished job attempts by status.",
+                   [((("status", s),), n) for s, n in sorted(self.jobs.items())])
+            family("crowdsky_jobs_running", "gauge", "Jobs being processed.", [((), self.running)])
+
+            lines.append("# HELP crowdsky_stage_duration_seconds Wall time per job stage.")
+            lines.append("# TYPE crowdsky_stage_duration_seconds histogram")
+            for stage, hist in sorted(self.durations.items()):
+                for bound, n in zip(BUCKETS, hist):
+                    lines.append(f'crowdsky_stage_duration_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {n:g}')
+                lines.append(f'crowdsky_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist[-2]:g}')
+                lines.append(f'crowdsky_stage_duration_seconds_count{{stage="{stage}"}} {hist[-2]:g}')
+                lines.append(f'crowdsky_stage_duration_seconds_sum{{stage="{stage}"}} {hist[-1]:g}')
+
+            for name, help_text, values in (
+                ("crowdsky_stage_cpu_seconds_total", "CPU time per stage, incl. pool processes.", self.cpu),
+                ("crowdsky_stage_bytes_in_total", "Bytes received per stage.", self.bytes_in),
+                ("crowdsky_stage_bytes_out_total", "Bytes sent per stage.", self.bytes_out),
+                ("crowdsky_stage_frames_total", "Frames processed per stage.", self.frames),
+                ("crowdsky_stage_errors_total", "Failed stage runs.", self.errors),
+            ):
+                family(name, "counter", help_text,
+                       [((("stage", s),), v) for s, v in sorted(values.items())])
+            collectors = list(self.collectors)
+
+        family("crowdsky_process_max_rss_bytes", "gauge",
+               "Resident memory high-water mark of the worker process.", [((), max_rss_bytes())])
+        family("crowdsky_process_cpu_seconds_total", "counter",
+               "CPU time of the worker process.", [((), time.process_time())])
+        for collect in collectors:
+            try:
+                for name, kind, help_text, samples in collect():
+                    family(name, kind, help_text, sorted(samples.items()))
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = _Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        logger.debug("%s " + fmt, self.address_string(), *args)
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    """Serve ``/metrics`` on a background thread; None if the port is taken."""
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint on {host}:{port} unavailable: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,116 @@
+"""
+Fast alignment for small-drift sequences by FFT phase correlation.
+
+Consecutive Seestar frames differ by a small drift and a slow field rotation,
+so general asterism matching is more than they need. Here a frame is warped
+by the transform predicted from its neighbours (the previously aligned
+frame), and what is left is measured by phase correlation
+(``cv2.phaseCorrelate``) of a 3x3 grid of tiles of 2x2-binned luminance
+images against the reference. A rigid fit to the tile offsets gives the
+correction; field rotation shows up as tiles moving in different directions.
+
+No stars are extracted. ``transform`` returns None when too few tiles
+correlate and agree on one rotation + shift, and the caller falls back to
+asterism matching.
+"""
+
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Binning of the luminance images that are correlated
+BIN = 2
+# Tiles per axis; each is correlated separately
+GRID = 3
+# Weakest correlation peak accepted for a tile (0..1)
+MIN_RESPONSE = 0.05
+# Tiles needed, and the largest residual (binned px) a tile may have in the
+# rigid fit; worse tiles (a bright star at the tile edge, a satellite)
+# are dropped one at a time
+MIN_TILES = 4
+MAX_RESIDUAL = 0.5
+
+# Centre of binned pixel 0 in full-resolution pixels
+_ORIGIN = (BIN - 1) / 2
+
+
+def binned(image: np.ndarray) -> np.ndarray:
+    """
+    Background-subtracted, ``BIN``x``BIN``-binned float32 luminance of an
+    (H, W) or (H, W, 3) image.
+    """
+    h, w = image.shape[0] // BIN, image.shape[1] // BIN
+    small = cv2.resize(image[:h * BIN, :w * BIN], (w, h), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = small.mean(axis=2, dtype=np.float32)
+    small = np.nan_to_num(small, nan=0.0).astype(np.float32, copy=False)
+    small -= np.median(small[::4, ::4])
+    # Compress bright stars so the faint ones count too
+    return np.sqrt(np.clip(small, 0, None, out=small), out=small)
+
+
+def _to_binned(matrix: np.ndarray) -> np.ndarray:
+    """Full-resolution 2x3 transform expressed in binned pixel coordinates."""
+    rot, t = matrix[:, :2], matrix[:, 2]
+    origin = np.full(2, _ORIGIN)
+    return np.column_stack([rot, (t + rot @ origin - origin) / BIN])
+
+
+def _to_full(matrix: np.ndarray) -> np.ndarray:
+    """Binned 2x3 transform expressed in full-resolution pixel coordinates."""
+    rot, t = matrix[:, :2], matrix[:, 2]
+    origin = np.full(2, _ORIGIN)
+    return np.column_stack([rot, BIN * t + origin - rot @ origin])
+
+
+def _compose(outer: np.ndarray, inner: np.ndarray) -> np.ndarray:
+    """2x3 transform applying ``inner``, then ``outer``."""
+    rot = outer[:, :2]
+    return np.column_stack([rot @ inner[:, :2], rot @ inner[:, 2] + outer[:, 2]])
+
+
+def _rigid(src: np.ndarray, dst: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Least-squares rotation + shift src -> dst and the residual per point."""
+    src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+    s, d = src - src_mean, dst - dst_mean
+    angle = np.arctan2(np.sum(s[:, 0] * d[:, 1] - s[:, 1] * d[:, 0]), np.sum(s * d))
+    cos, sin = np.cos(angle), np.sin(angle)
+    rot = np.array([[cos, -sin], [sin, cos]])
+    matrix = np.column_stack([rot, dst_mean - rot @ src_mean])
+    fitted = src @ rot.T + matrix[:, 2]
+    return matrix, np.hypot(*(fitted - dst).T)
+
+
+def transform(
+    small: np.ndarray, ref_small: np.ndarray, guess: Optional[np.ndarray],
+) -> Optional[np.ndarray]:
+    """
+    Full-resolution 2x3 transform of a frame onto the reference, from their
+    ``binned()`` luminance and a predicted transform ``guess`` (identity if
+    None), or None if the solution is not trustworthy.
+    """
+    guess = np.eye(2, 3) if guess is None else np.asarray(guess, dtype=np.float64)
+    h, w = ref_small.shape
+    warped = cv2.warpAffine(small, _to_binned(guess).astype(np.float32), (w, h), flags=cv2.INTER_LINEAR)
+
+    th, tw = h // GRID, w // GRID
+    window = cv2.createHanningWindow((tw, th), cv2.CV_32F)
+    centres, shifted = [], []
+    for i in range(GRID):
+        for j in range(GRID):
+            rows, cols = slice(i * th, (i + 1) * th), slice(j * tw, (j + 1) * tw)
+            (dx, dy), response = cv2.phaseCorrelate(ref_small[rows, cols], warped[rows, cols], window)
+            if response >= MIN_RESPONSE:
+                centre = np.array([j * tw + (tw - 1) / 2, i * th + (th - 1) / 2])
+                centres.append(centre)
+                # The tile's content sits at centre + (dx, dy) in the warped frame
+                shifted.append(centre + (dx, dy))
+    src, dst = np.array(shifted), np.array(centres)
+    while len(src) >= MIN_TILES:
+        correction, residuals = _rigid(src, dst)
+        worst = int(np.argmax(residuals))
+        if residuals[worst] <= MAX_RESIDUAL:
+            return _compose(_to_full(correction), guess)
+        src, dst = np.delete(src, worst, axis=0), np.delete(dst, worst, axis=0)
+    return None
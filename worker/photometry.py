@@ -0,0 +1,144 @@
+"""
+Source catalogs of stacks: position and aperture photometry of every star.
+
+Each stack product gets a catalog next to it (``{stem}_cat.npz``, see
+``catalog_path``), one array per column, so a reader loads only the columns
+it needs:
+
+- ``x``, ``y``: position on the stack's pixel grid
+- ``flux``, ``flux_err``: aperture sum of the background-subtracted luminance
+  (ADU per frame) and its error from the background noise (the gain of a
+  stack is not known, so there is no Poisson term)
+- ``mag``, ``mag_err``: instrumental magnitude ``-2.5 log10(flux)`` (NaN for
+  non-positive fluxes); ``lightcurves.py`` puts stacks on a common zero point
+- ``frames``: frames stacked at the source's centre (FOOTPRINT)
+- ``flag``: SEP extraction and aperture flags, plus FLAG_LOW_COVERAGE
+
+Apertures are APERTURE_FWHM times the median FWHM of the stack's stars.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import sep
+from astropy.io import fits
+
+from .compression import image_hdu
+from .streaming_stack import DETECT_SIGMA, luminance
+
+logger = logging.getLogger(__name__)
+
+# Aperture radius in units of the stack's median FWHM, and its minimum [px]
+APERTURE_FWHM = 1.5
+MIN_APERTURE = 2.0
+# Stars on fewer frames than this fraction of the stack's deepest coverage
+# (field edges, where drift or rotation left gaps) are flagged
+LOW_COVERAGE = 0.5
+FLAG_LOW_COVERAGE = 0x100
+
+COLUMNS = {
+    "x": np.float32,
+    "y": np.float32,
+    "flux": np.float32,
+    "flux_err": np.float32,
+    "mag": np.float32,
+    "mag_err": np.float32,
+    "frames": np.uint16,
+    "flag": np.uint16,
+}
+
+
+def catalog_path(stack_path: Path) -> Path:
+    """Where the catalog of ``stack_path`` goes."""
+    return stack_path.with_name(f"{stack_path.stem}_cat.npz")
+
+
+def measure(image: np.ndarray, frames: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    Detect the stars of a stacked image and measure them.
+
+    Args:
+        image: RGB stack ``(h, w, 3)`` or a single plane; NaN where no frame
+            covers a pixel.
+        frames: Frames per pixel (the stack's footprint), if known.
+
+    Returns:
+        The catalog columns (see module docstring), brightest star first.
+    """
+    lum = luminance(image) if image.ndim == 3 else np.ascontiguousarray(image, dtype=np.float32)
+    missing = ~np.isfinite(lum)
+    lum = np.where(missing, 0, lum).astype(np.float32)
+    bkg = sep.Background(lum, mask=missing)
+    data = lum - bkg.back()
+
+    objects = sep.extract(data, DETECT_SIGMA, err=bkg.globalrms, mask=missing, minarea=5)
+    if not len(objects):
+        return {name: np.empty(0, dtype) for name, dtype in COLUMNS.items()}
+    objects = objects[np.argsort(objects["flux"])[::-1]]
+
+    # FWHM of the Gaussian with the objects' second moments
+    fwhm = 2.0 * np.sqrt(np.log(2) * (objects["a"] ** 2 + objects["b"] ** 2))
+    radius = max(MIN_APERTURE, APERTURE_FWHM * float(np.median(fwhm)))
+    flux, flux_err, aper_flag = sep.sum_circle(
+        data, objects["x"], objects["y"], radius,
+        err=bkg.globalrms, mask=missing, subpix=5,
+    )
+    flag = objects["flag"].astype(np.uint16) | aper_flag.astype(np.uint16)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        positive = flux > 0
+        mag = np.where(positive, -2.5 * np.log10(flux), np.nan)
+        mag_err = np.where(positive, 2.5 / np.log(10) * flux_err / flux, np.nan)
+
+    if frames is not None:
+        h, w = frames.shape
+        row = np.clip(np.round(objects["y"]).astype(int), 0, h - 1)
+        col = np.clip(np.round(objects["x"]).astype(int), 0, w - 1)
+        depth = np.asarray(frames)[row, col]
+        flag[depth < LOW_COVERAGE * float(np.max(frames))] |= FLAG_LOW_COVERAGE
+    else:
+        depth = np.zeros(len(objects))
+
+    columns = {
+        "x": objects["x"], "y": objects["y"], "flux": flux, "flux_err": flux_err,
+        "mag": mag, "mag_err": mag_err, "frames": depth, "flag": flag,
+    }
+    return {name: np.asarray(columns[name]).astype(dtype) for name, dtype in COLUMNS.items()}
+
+
+def write_catalog(path: Path, catalog: Dict[str, np.ndarray], meta: Optional[dict] = None) -> Path:
+    """Save catalog columns (plus ``meta`` as JSON) as a compressed ``.npz``."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta or {})), **catalog)
+    return path
+
+
+def read_catalog(source) -> Dict[str, np.ndarray]:
+    """Catalog columns from a path or file object (``meta`` decoded to a dict)."""
+    with np.load(source, allow_pickle=False) as npz:
+        catalog = {name: npz[name] for name in npz.files if name != "meta"}
+        catalog["meta"] = json.loads(str(npz["meta"])) if "meta" in npz.files else {}
+    return catalog
+
+
+def catalog_stack(stack_path: Path, output_path: Optional[Path] = None) -> Path:
+    """
+    Measure the stars of a stacked FITS file and write its catalog
+    (``output_path`` defaults to ``catalog_path(stack_path)``).
+    """
+    if output_path is None:
+        output_path = catalog_path(stack_path)
+    with fits.open(stack_path, memmap=False) as hdul:
+        image = np.asarray(image_hdu(hdul).data, dtype=np.float32)
+        if image.ndim == 3 and image.shape[0] == 3:
+            # seestarpy writes channels first
+            image = np.moveaxis(image, 0, -1)
+        frames = np.asarray(hdul["FOOTPRINT"].data) if "FOOTPRINT" in hdul else None
+    catalog = measure(image, frames)
+    n_good = int(np.sum((catalog["flag"] == 0) & np.isfinite(catalog["mag"])))
+    meta = {"stack": stack_path.name, "n_sources": len(catalog["x"]), "n_clean": n_good}
+    return write_catalog(output_path, catalog, meta)
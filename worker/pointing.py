@@ -0,0 +1,114 @@
+"""
+Alignment references shared by consecutive chunks of one pointing.
+
+A Seestar session on one target is split into many 15-minute jobs. Instead of
+picking a new reference frame and solving every frame's alignment from
+scratch, the streaming stacker starts each chunk from the previous chunk's
+reference star list and its last transform (a warm start that usually
+replaces triangle matching with a nearest-neighbour fit). Chunks of one
+pointing then also land on the same pixel grid.
+
+References are kept in memory per worker process, keyed by owner and
+pointing (RA/Dec part of the chunk key), and dropped when they stop matching
+(see ``streaming_stack.iter_prepared``), when the field has drifted too far
+from them, or after ``MAX_IDLE_S`` without a chunk of that pointing.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+# References not used for this long belong to an earlier session
+MAX_IDLE_S = 3600
+# Pointings remembered per worker
+MAX_ENTRIES = 64
+# A reference is not carried over once the last frame was shifted by more
+# than this fraction of the frame size (the overlap would keep shrinking)
+MAX_DRIFT_FRACTION = 0.2
+
+
+@dataclass
+class Reference:
+    """Alignment reference of a pointing, carried from one chunk to the next."""
+    # Control points of the reference frame, brightest first
+    points: Optional[np.ndarray] = None
+    shape: Optional[Tuple[int, int]] = None
+    # Content key of the reference frame (for cached transforms, see cache.py)
+    key: Optional[str] = None
+    # Transform of the most recent frame onto the reference, as a warm start
+    matrix: Optional[np.ndarray] = None
+    # Binned luminance of the reference frame (phase correlation only, ~2 MB)
+    small: Optional[np.ndarray] = None
+
+    def drifted(self) -> bool:
+        """True if the last frame moved too far from the reference to reuse it."""
+        if self.matrix is None or self.shape is None:
+            return False
+        shift = float(np.hypot(*self.matrix[:, 2]))
+        return shift > MAX_DRIFT_FRACTION * min(self.shape)
+
+
+def pointing_key(job: dict) -> Optional[str]:
+    """
+    Cache key of a job's pointing: the owner plus ``pointing_key`` from the
+    API, or the RA/Dec part of the chunk key (``YYYYMMDD.CC_RRR.R_sDD.D``).
+    """
+    pointing = job.get("pointing_key")
+    if not pointing:
+        _, _, pointing = str(job.get("chunk_key") or "").partition("_")
+    if not pointing:
+        return None
+    return f"{job.get('user_id')}/{pointing}"
+
+
+class ReferenceCache:
+    """Thread-safe in-memory map of pointing key -> ``Reference``."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_idle_s: float = MAX_IDLE_S):
+        self.max_entries = max_entries
+        self.max_idle_s = max_idle_s
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Reference]]" = OrderedDict()
+
+    def get(self, key: Optional[str]) -> Optional[Reference]:
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.max_idle_s:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Optional[str], reference: Reference) -> None:
+        if key is None:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), reference)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Optional[str]) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_references = ReferenceCache()
+
+
+def get_references() -> ReferenceCache:
+    """The process-wide reference cache."""
+    return _references
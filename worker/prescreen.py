@@ -0,0 +1,184 @@
+"""
+Cheap frame-quality prescreen, run before star detection and alignment.
+
+Each frame is reduced to a 2x2-binned luminance preview (for a Bayer mosaic
+that is one superpixel per colour cell), on which background, noise, star
+count, FWHM and elongation are estimated with plain NumPy: peaks are local
+maxima above the noise, and FWHM / elongation come from the second moments of
+the brightest unsaturated peaks.
+
+Frames are rejected for absolute reasons (too few stars, trailed) and for
+reasons relative to the rest of the chunk (clouds: far fewer stars or a much
+brighter sky than the median frame; seeing / focus: much larger FWHM).
+"""
+
+import math
+import warnings
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Preview binning factor (2 = one superpixel per Bayer cell)
+BIN = 2
+# Peak detection threshold in background sigmas
+PEAK_SIGMA = 5.0
+# Brightest peaks used for FWHM / elongation, and their stamp half-width
+N_MEASURE = 30
+_STAMP = 3
+# Peaks above this fraction of the brightest pixel count as saturated
+SATURATION_FRACTION = 0.9
+
+# Absolute limits
+MIN_STARS = 10
+MAX_ELONGATION = 1.8
+# Relative to the chunk's median frame
+MIN_STAR_FRACTION = 0.4
+MAX_FWHM_FACTOR = 1.6
+MAX_BACKGROUND_SIGMAS = 10.0
+# Frames measured before relative limits apply
+MIN_REFERENCE_FRAMES = 5
+
+
+@dataclass
+class FrameQuality:
+    background: float
+    noise: float
+    n_stars: int
+    # Full-resolution pixels; NaN if no star could be measured
+    fwhm: float
+    elongation: float
+
+
+@dataclass(frozen=True)
+class Limits:
+    min_stars: int = MIN_STARS
+    max_elongation: float = MAX_ELONGATION
+    max_fwhm: float = math.inf
+    max_background: float = math.inf
+
+
+def binned_luminance(data: np.ndarray) -> np.ndarray:
+    """2x2-binned float32 luminance of a Bayer mosaic or an RGB frame."""
+    if data.ndim == 3:
+        data = data.mean(axis=0 if data.shape[0] == 3 else 2, dtype=np.float32)
+    h, w = (data.shape[0] // BIN) * BIN, (data.shape[1] // BIN) * BIN
+    binned = data[:h, :w].reshape(h // BIN, BIN, w // BIN, BIN)
+    return binned.sum(axis=(1, 3), dtype=np.float32)
+
+
+def _local_maxima(img: np.ndarray, threshold: float) -> np.ndarray:
+    """(N, 2) row/col of pixels above ``threshold`` that are 3x3 maxima (border excluded)."""
+    core = img[1:-1, 1:-1]
+    mask = core > threshold
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                mask &= core >= img[1 + dy:img.shape[0] - 1 + dy, 1 + dx:img.shape[1] - 1 + dx]
+    return np.argwhere(mask) + 1
+
+
+def measure(data: np.ndarray) -> FrameQuality:
+    """Estimate the quality of one frame (Bayer mosaic, (H, W, 3) or (3, H, W))."""
+    img = binned_luminance(np.asarray(data))
+    sample = img[::4, ::4]
+    sample = sample[np.isfinite(sample)]
+    background = float(np.median(sample))
+    noise = float(1.4826 * np.median(np.abs(sample - background))) or 1.0
+
+    peaks = _local_maxima(np.nan_to_num(img, nan=background), background + PEAK_SIGMA * noise)
+    n_stars = len(peaks)
+
+    fwhm, elongation = math.nan, math.nan
+    h, w = img.shape
+    inside = (
+        (peaks[:, 0] >= _STAMP) & (peaks[:, 0] < h - _STAMP)
+        & (peaks[:, 1] >= _STAMP) & (peaks[:, 1] < w - _STAMP)
+    )
+    peaks = peaks[inside]
+    if len(peaks):
+        values = img[peaks[:, 0], peaks[:, 1]]
+        unsaturated = values < SATURATION_FRACTION * np.nanmax(img)
+        peaks, values = peaks[unsaturated], values[unsaturated]
+        peaks = peaks[np.argsort(values)[::-1][:N_MEASURE]]
+    if len(peaks):
+        offsets = np.arange(-_STAMP, _STAMP + 1)
+        rows = peaks[:, 0, None, None] + offsets[None, :, None]
+        cols = peaks[:, 1, None, None] + offsets[None, None, :]
+        stamps = np.clip(img[rows, cols] - background, 0, None)
+        total = stamps.sum(axis=(1, 2))
+        ok = total > 0
+        stamps, total = stamps[ok], total[ok]
+        if len(stamps):
+            dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+            my = (stamps * dy).sum(axis=(1, 2)) / total
+            mx = (stamps * dx).sum(axis=(1, 2)) / total
+            cyy = (stamps * dy ** 2).sum(axis=(1, 2)) / total - my ** 2
+            cxx = (stamps * dx ** 2).sum(axis=(1, 2)) / total - mx ** 2
+            cxy = (stamps * dx * dy).sum(axis=(1, 2)) / total - mx * my
+            half_trace = (cxx + cyy) / 2
+            root = np.sqrt(((cxx - cyy) / 2) ** 2 + cxy ** 2)
+            major = np.maximum(half_trace + root, 1e-6)
+            minor = np.maximum(half_trace - root, 1e-6)
+            fwhm = float(np.median(2.3548 * np.sqrt((major + minor) / 2))) * BIN
+            elongation = float(np.median(np.sqrt(major / minor)))
+
+    return FrameQuality(background, noise, n_stars, fwhm, elongation)
+
+
+def chunk_limits(qualities: Iterable[FrameQuality]) -> Limits:
+    """Absolute limits, tightened relative to the median of ``qualities``."""
+    qualities = list(qualities)
+    if len(qualities) < MIN_REFERENCE_FRAMES:
+        return Limits()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN FWHMs
+        stars = float(np.median([q.n_stars for q in qualities]))
+        fwhm = float(np.nanmedian([q.fwhm for q in qualities]))
+        background = float(np.median([q.background for q in qualities]))
+        noise = float(np.median([q.noise for q in qualities]))
+    return Limits(
+        min_stars=max(MIN_STARS, int(MIN_STAR_FRACTION * stars)),
+        max_fwhm=MAX_FWHM_FACTOR * fwhm if math.isfinite(fwhm) else math.inf,
+        max_background=background + MAX_BACKGROUND_SIGMAS * noise,
+    )
+
+
+def reject_reason(q: FrameQuality, limits: Limits) -> Optional[str]:
+    """Why a frame should be dropped, or None to keep it."""
+    if q.n_stars < limits.min_stars:
+        return f"clouds or no stars ({q.n_stars} stars, need {limits.min_stars})"
+    if q.background > limits.max_background:
+        return f"bright sky (background {q.background:.0f} > {limits.max_background:.0f})"
+    if q.elongation > limits.max_elongation:
+        return f"trailed (elongation {q.elongation:.2f})"
+    if q.fwhm > limits.max_fwhm:
+        return f"blurred (FWHM {q.fwhm:.1f} px > {limits.max_fwhm:.1f})"
+    return None
+
+
+def screen(qualities: Dict[str, FrameQuality]) -> Dict[str, str]:
+    """Rejection reason per frame name, judged against the whole chunk."""
+    limits = chunk_limits(qualities.values())
+    reasons = {name: reject_reason(q, limits) for name, q in qualities.items()}
+    return {name: reason for name, reason in reasons.items() if reason}
+
+
+class RunningLimits:
+    """
+    Limits for frames screened one at a time (streaming), relative to the
+    accepted frames seen so far; absolute limits only until
+    ``MIN_REFERENCE_FRAMES`` frames have been accepted.
+    """
+
+    def __init__(self):
+        self._accepted: List[FrameQuality] = []
+        self._limits = Limits()
+
+    def add(self, q: FrameQuality) -> None:
+        self._accepted.append(q)
+        self._limits = chunk_limits(self._accepted)
+
+    @property
+    def limits(self) -> Limits:
+        return self._limits
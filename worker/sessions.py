@@ -0,0 +1,193 @@
+"""
+Shared keep-alive HTTP clients for the PHP API and u:cloud WebDAV.
+
+One ``aiohttp`` client session per service, opened on first use in the
+running event loop and closed by ``close()``. Each has a connection pool
+sized for every job's transfers, and retries connection failures and
+transient 5xx responses of idempotent requests. Request latency and
+connection counts are collected per service and exposed through ``stats()``.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import aiohttp
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Methods that may be re-sent here. PUT bodies are file streams that cannot
+# be rewound and POSTs are not idempotent, so those are retried (if at all) by
+# the callers; so are next_job.php claims, which are GETs sent with
+# retry=False.
+_RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "DELETE", "MKCOL", "PROPFIND"})
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRIES = 3
+# Seconds before the first retry; doubled on every further attempt
+RETRY_BACKOFF = 0.5
+# Seconds to establish a connection
+CONNECT_TIMEOUT = 30
+
+
+class _ServiceStats:
+    """Thread-safe request counters for one service."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, status: int, latency: float) -> None:
+        with self.lock:
+            self.requests += 1
+            if status >= 400:
+                self.errors += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    async def _connection_created(self, session, context, params) -> None:
+        with self.lock:
+            self.connections += 1
+
+
+def _pool_size() -> int:
+    return (config.MAX_WORKERS + config.PREFETCH_JOBS) * (
+        config.DOWNLOAD_CONCURRENCY + config.UPLOAD_PARALLEL
+    )
+
+
+class Client:
+    """
+    One service's pooled ``aiohttp.ClientSession`` with retries and stats.
+
+    ``timeout`` is the longest wait for the next bytes of the response (like
+    ``requests``), not a limit on the whole transfer.
+    """
+
+    def __init__(self, name: str, auth: Optional[aiohttp.BasicAuth] = None, headers=None):
+        self.name = name
+        self.auth = auth
+        self.headers = headers or {}
+        self.stats = _ServiceStats()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self.stats._connection_created)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=_pool_size()),
+                auth=self.auth,
+                headers=self.headers,
+                trace_configs=[trace],
+            )
+            self._loop = loop
+        return self._session
+
+    async def request(
+        self, method: str, url: str, timeout: float = 30, retry: bool = True, **kwargs,
+    ) -> aiohttp.ClientResponse:
+        """
+        Send a request and return the response once its headers are in. The
+        body is not read yet: use ``async with response:`` to release it.
+
+        ``retry=False`` sends the request once even if its method is
+        idempotent, for requests with side effects on the server.
+        """
+        session = self._get_session()
+        retry = retry and method in _RETRY_METHODS
+        client_timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=timeout)
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                resp = await session.request(method, url, timeout=client_timeout, **kwargs)
+            except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
+                if not retry or attempt >= RETRIES:
+                    raise
+                logger.debug(f"{method} {url} failed ({e!r}), retrying")
+            else:
+                self.stats.record(resp.status, time.monotonic() - start)
+                if not retry or resp.status not in _RETRY_STATUSES or attempt >= RETRIES:
+                    return resp
+                resp.release()
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_clients: Dict[str, Client] = {}
+_lock = threading.Lock()
+
+
+def _get(name: str, factory) -> Client:
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def api_session() -> Client:
+    """Client for the PHP worker API (Bearer auth preset)."""
+    return _get("api", lambda: Client(
+        "api", headers={"Authorization": f"Bearer {config.WORKER_API_KEY}"},
+    ))
+
+
+def webdav_session() -> Client:
+    """Client for u:cloud WebDAV (share-token auth preset)."""
+    return _get("webdav", lambda: Client(
+        "webdav", auth=aiohttp.BasicAuth(config.UCLOUD_SHARE_TOKEN, ""),
+    ))
+
+
+def chunking_session() -> Client:
+    """Client for u:cloud chunked uploads (user / app-password auth)."""
+    return _get("chunking", lambda: Client(
+        "chunking", auth=aiohttp.BasicAuth(config.UCLOUD_USER, config.UCLOUD_APP_PASSWORD),
+    ))
+
+
+async def close() -> None:
+    """Close every client's connections (before the event loop ends)."""
+    for client in list(_clients.values()):
+        await client.close()
+
+
+def stats() -> Dict[str, dict]:
+    """
+    Snapshot of per-service HTTP metrics.
+
+    Returns:
+        ``{service: {requests, errors, latency_avg, latency_max, connections}}``
+        where latency is time to response headers in seconds and
+        ``connections`` counts TCP connections opened (lower = better reuse).
+    """
+    snapshot = {}
+    for name, client in list(_clients.items()):
+        s = client.stats
+        with s.lock:
+            snapshot[name] = {
+                "requests": s.requests,
+                "errors": s.errors,
+                "latency_avg": s.latency_total / s.requests if s.requests else 0.0,
+                "latency_max": s.latency_max,
+                "connections": s.connections,
+            }
+    return snapshot
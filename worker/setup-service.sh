@@ -50,6 +50,9 @@ WorkingDirectory=$REPO_DIR
 ExecStart=$VENV_PYTHON -m worker
 Restart=always
 RestartSec=10
+# SIGTERM only the main process; it stops claiming and waits for running jobs
+KillMode=mixed
+TimeoutStopSec=600
 EnvironmentFile=$WORKER_DIR/.env
 StandardOutput=journal
 StandardError=journal
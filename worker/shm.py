@@ -0,0 +1,46 @@
+"""
+Hand NumPy arrays between processes through shared memory instead of pickling.
+
+The producer copies the array into a new shared memory segment and returns a
+small picklable ``SharedArray`` handle. The consumer ``take()``s it exactly
+once, which copies the data out and unlinks the segment.
+"""
+
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Tuple
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+def share(array: np.ndarray) -> SharedArray:
+    """Copy ``array`` into a new shared memory segment."""
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return SharedArray(shm.name, tuple(array.shape), array.dtype.str)
+
+
+def take(ref: SharedArray) -> np.ndarray:
+    """Copy a shared array into private memory and release the segment."""
+    shm = SharedMemory(name=ref.name)
+    try:
+        view = np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf)
+        array = view.copy()
+        del view
+    finally:
+        shm.close()
+        shm.unlink()
+    return array
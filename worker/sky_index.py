@@ -0,0 +1,481 @@
+"""
+Sky-position and time index over the stacked frames of all users.
+
+``stacks_data.php`` serves one user's stacks to the sky map; this index
+answers the operator's questions across the archive: which stacks cover a
+position in a time window, how many there are per sky pixel, night, user or
+object. It is built from the ``ra_deg`` / ``dec_deg`` / ``date_obs_*`` the
+worker reports with each completed job, fetched from ``stack_index.php``.
+
+Rows are kept sorted by HEALPix pixel (nested scheme, NSIDE, about a Seestar
+field per pixel) and, within a pixel, by time. A cone search looks up the
+pixels whose centres lie within the radius plus a pixel's extent, takes
+each pixel's rows in the time window by binary search and keeps the rows
+within the radius, so it costs O(pixels log n + matches), not O(n). Queries
+over time alone use a second ordering by time. Stacks without coordinates
+are indexed for time queries only (pixel -1).
+
+``sync`` updates the index from the rows added since its highest id; if the
+server holds fewer rows up to that id than the index (stacks were deleted),
+it rebuilds from scratch. The index is one uncompressed ``.npz`` so it loads
+in milliseconds.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# HEALPix resolution of the index: 49152 pixels of 0.92 deg
+NSIDE = 64
+# Rows fetched per stack_index.php call
+SYNC_PAGE = 5000
+# Sort key: pixel * KEY_SPAN + days since MJD_ORIGIN (times must fall within
+# KEY_SPAN days of it)
+MJD_ORIGIN = 40000.0
+KEY_SPAN = 100000.0
+
+COLUMNS = {
+    "id": np.int64,
+    "user_id": np.int64,
+    "hpx": np.int64,
+    "ra": np.float64,
+    "dec": np.float64,
+    "mjd": np.float64,
+    "mjd_end": np.float64,
+    "cadence_min": np.int16,
+    "exptime": np.float32,
+    "n_frames": np.int32,
+    "object_name": np.str_,
+}
+AGGREGATES = ("hpx", "night", "user", "object", "cadence")
+
+_MJD_EPOCH = datetime(1858, 11, 17)
+
+# Nested-scheme face layout (HEALPix, Gorski et al. 2005)
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+# -- HEALPix -----------------------------------------------------------------
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """Interleave zeros between the bits of ``v`` (bit i -> bit 2i)."""
+    v = v.astype(np.int64) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+
+def _compress_bits(v: np.ndarray) -> np.ndarray:
+    """Inverse of ``_spread_bits``."""
+    v = v.astype(np.int64) & 0x55555555
+    v = (v | (v >> 1)) & 0x33333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF
+    return (v | (v >> 8)) & 0x0000FFFF
+
+
+def ang2pix(nside: int, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """Nested HEALPix pixel of each position (degrees)."""
+    z = np.sin(np.radians(np.asarray(dec, dtype=np.float64)))
+    tt = np.mod(np.radians(np.asarray(ra, dtype=np.float64)), 2 * np.pi) / (np.pi / 2)
+    z, tt = np.broadcast_arrays(z, tt)
+    za = np.abs(z)
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    eq = za <= 2 / 3
+    t1 = nside * (0.5 + tt[eq])
+    t2 = nside * z[eq] * 0.75
+    jp = (t1 - t2).astype(np.int64)
+    jm = (t1 + t2).astype(np.int64)
+    ifp, ifm = jp // nside, jm // nside
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    polar = ~eq
+    ntt = np.minimum(tt[polar].astype(np.int64), 3)
+    tp = tt[polar] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[polar]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[polar] >= 0
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return face * nside * nside + (_spread_bits(ix) | (_spread_bits(iy) << 1))
+
+
+def pix2ang(nside: int, pix: np.ndarray):
+    """Centre (ra, dec in degrees) of each nested HEALPix pixel."""
+    pix = np.asarray(pix, dtype=np.int64)
+    npface = nside * nside
+    face = pix // npface
+    sub = pix % npface
+    ix, iy = _compress_bits(sub), _compress_bits(sub >> 1)
+
+    jr = _JRLL[face] * nside - ix - iy - 1
+    fact2 = 4.0 / (12 * npface)
+    north, south = jr < nside, jr > 3 * nside
+    nr = np.where(north, jr, np.where(south, 4 * nside - jr, nside))
+    z = np.where(
+        north, 1 - nr * nr * fact2,
+        np.where(south, nr * nr * fact2 - 1, (2 * nside - jr) * 2 * nside * fact2),
+    )
+    kshift = np.where(north | south, 0, (jr - nside) & 1)
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, np.where(jp < 1, jp + 4 * nside, jp))
+    phi = (jp - (kshift + 1) * 0.5) * (np.pi / 2 / nr)
+    return np.degrees(phi), np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+
+def _unit(ra, dec) -> np.ndarray:
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+_centres: Dict[int, np.ndarray] = {}
+
+
+def _pixel_centres(nside: int) -> np.ndarray:
+    """Unit vectors of all pixel centres (cached)."""
+    if nside not in _centres:
+        _centres[nside] = _unit(*pix2ang(nside, np.arange(12 * nside * nside)))
+    return _centres[nside]
+
+
+def max_pixrad(nside: int) -> float:
+    """Upper bound [deg] on the distance from a pixel's centre to its edge."""
+    # No point of a pixel lies much more than one mean pixel size from its
+    # centre (0.94 deg at NSIDE 64); 1.5 leaves a margin
+    return 1.5 * math.degrees(math.sqrt(4 * math.pi / (12 * nside * nside)))
+
+
+def query_disc(nside: int, ra: float, dec: float, radius: float) -> np.ndarray:
+    """Pixels that may hold a position within ``radius`` deg of (ra, dec), sorted."""
+    reach = math.radians(min(180.0, radius + max_pixrad(nside)))
+    near = _pixel_centres(nside) @ _unit(ra, dec) >= math.cos(reach)
+    return np.flatnonzero(near)
+
+
+# -- index -------------------------------------------------------------------
+
+def _mjd(value: Optional[str]) -> float:
+    if not value:
+        return float("nan")
+    return (datetime.fromisoformat(str(value).replace(" ", "T")) - _MJD_EPOCH).total_seconds() / 86400
+
+
+def _night(mjd: float) -> str:
+    """Evening date of the night an MJD falls in (nights run noon to noon UTC)."""
+    return (_MJD_EPOCH + timedelta(days=math.floor(mjd - 0.5))).date().isoformat()
+
+
+def _float(value) -> float:
+    return float("nan") if value is None else float(value)
+
+
+@dataclass
+class SkyIndex:
+    nside: int = NSIDE
+    columns: Dict[str, np.ndarray] = field(
+        default_factory=lambda: {name: np.empty(0, dtype) for name, dtype in COLUMNS.items()}
+    )
+    # Row order by time (rows without a date last)
+    by_time: np.ndarray = field(default_factory=lambda: np.empty(0, np.int64))
+    _key: Optional[np.ndarray] = field(default=None, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+    @property
+    def max_id(self) -> int:
+        return int(self.columns["id"].max()) if len(self) else 0
+
+    @property
+    def key(self) -> np.ndarray:
+        """Sort key of each row: pixel, then time."""
+        if self._key is None or len(self._key) != len(self):
+            self._key = self._keys(self.columns["hpx"], self.columns["mjd"])
+        return self._key
+
+    @staticmethod
+    def _keys(hpx: np.ndarray, mjd: np.ndarray) -> np.ndarray:
+        days = np.where(np.isfinite(mjd), mjd - MJD_ORIGIN, 0.0)
+        return hpx * KEY_SPAN + np.clip(days, 0, KEY_SPAN - 1)
+
+    @classmethod
+    def load(cls, path) -> "SkyIndex":
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(
+                nside=int(npz["nside"]),
+                columns={name: npz[name] for name in COLUMNS},
+                by_time=npz["by_time"],
+            )
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, nside=np.array(self.nside), by_time=self.by_time, **self.columns)
+        os.replace(tmp, path)
+
+    # -- updates -------------------------------------------------------------
+
+    def add(self, stacks: Iterable[dict]) -> int:
+        """
+        Index ``stacked_frames`` rows (as returned by ``stack_index.php``).
+        Rows already indexed are skipped. Returns the number added.
+        """
+        stacks = list(stacks)
+        ids = np.array([int(s["id"]) for s in stacks], dtype=np.int64)
+        fresh = ~np.isin(ids, self.columns["id"])
+        stacks = [s for s, keep in zip(stacks, fresh) if keep]
+        if not stacks:
+            return 0
+
+        ra = np.array([_float(s.get("ra_deg")) for s in stacks])
+        dec = np.array([_float(s.get("dec_deg")) for s in stacks])
+        located = np.isfinite(ra) & np.isfinite(dec)
+        hpx = np.full(len(stacks), -1, dtype=np.int64)
+        hpx[located] = ang2pix(self.nside, ra[located], dec[located])
+        new = {
+            "id": ids[fresh],
+            "user_id": [int(s["user_id"]) for s in stacks],
+            "hpx": hpx,
+            "ra": ra,
+            "dec": dec,
+            "mjd": [_mjd(s.get("date_obs_start")) for s in stacks],
+            "mjd_end": [_mjd(s.get("date_obs_end") or s.get("date_obs_start")) for s in stacks],
+            "cadence_min": [int(s.get("cadence_min") or 15) for s in stacks],
+            "exptime": [_float(s.get("total_exptime")) for s in stacks],
+            "n_frames": [int(s.get("n_frames_aligned") or 0) for s in stacks],
+            "object_name": [s.get("object_name") or "" for s in stacks],
+        }
+        new = {name: np.asarray(new[name]).astype(dtype) for name, dtype in COLUMNS.items()}
+
+        # Merge the new rows into the sorted ones in one pass
+        new_key = self._keys(new["hpx"], new["mjd"])
+        order = np.argsort(new_key, kind="stable")
+        at = np.searchsorted(self.key, new_key[order], side="right")
+        self.columns = {
+            name: np.insert(
+                self.columns[name].astype(np.result_type(self.columns[name], new[name])),
+                at, new[name][order],
+            )
+            for name in COLUMNS
+        }
+        self._key = None
+        mjd = self.columns["mjd"]
+        self.by_time = np.argsort(np.where(np.isfinite(mjd), mjd, np.inf), kind="stable")
+        return len(stacks)
+
+    # -- queries -------------------------------------------------------------
+
+    def cone(
+        self,
+        ra: float,
+        dec: float,
+        radius: float,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> np.ndarray:
+        """
+        Rows within ``radius`` deg of (ra, dec) with a start time in
+        [``start``, ``end``] (MJD, either open), by time.
+        """
+        pix = query_disc(self.nside, ra, dec, radius)
+        # Offsets are clipped to [0, KEY_SPAN - 1], so half a day either side
+        # keeps a window inside its pixel
+        t0 = -0.5 if start is None else float(np.clip(start - MJD_ORIGIN, 0, KEY_SPAN - 1))
+        t1 = KEY_SPAN - 0.5 if end is None else float(np.clip(end - MJD_ORIGIN, -0.5, KEY_SPAN - 0.5))
+        lo = np.searchsorted(self.key, pix * KEY_SPAN + t0, side="left")
+        hi = np.searchsorted(self.key, pix * KEY_SPAN + t1, side="right")
+        counts = np.maximum(hi - lo, 0)
+        if not counts.sum():
+            return np.empty(0, np.int64)
+        # Concatenated aranges lo[i]:hi[i]
+        rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        c = self.columns
+        near = _unit(c["ra"][rows], c["dec"][rows]) @ _unit(ra, dec) >= math.cos(math.radians(radius))
+        rows = rows[near]
+        if start is not None or end is not None:
+            rows = rows[np.isfinite(c["mjd"][rows])]
+        return rows[np.lexsort((c["id"][rows], c["mjd"][rows]))]
+
+    def time_range(self, start: Optional[float] = None, end: Optional[float] = None) -> np.ndarray:
+        """Rows with a start time in [``start``, ``end``] (MJD, either open), by time."""
+        mjd = self.columns["mjd"][self.by_time]
+        lo = 0 if start is None else np.searchsorted(mjd, start, side="left")
+        hi = np.searchsorted(mjd, np.inf if end is None else end, side="right")
+        return self.by_time[lo:hi]
+
+    def select(self, rows: np.ndarray, user_id: Optional[int] = None, cadence: Optional[int] = None) -> np.ndarray:
+        """Rows of one user and / or cadence."""
+        if user_id is not None:
+            rows = rows[self.columns["user_id"][rows] == user_id]
+        if cadence is not None:
+            rows = rows[self.columns["cadence_min"][rows] == cadence]
+        return rows
+
+    def page(self, rows: np.ndarray, page: int = 1, per_page: int = 100) -> dict:
+        """One page of rows as dicts, with the total count."""
+        page_rows = rows[(page - 1) * per_page:page * per_page]
+        out = []
+        for i in page_rows:
+            row = {name: self.columns[name][i].item() for name in COLUMNS}
+            for name in ("ra", "dec", "mjd", "mjd_end", "exptime"):
+                if not math.isfinite(row[name]):
+                    row[name] = None
+            out.append(row)
+        return {"total": len(rows), "page": page, "per_page": per_page, "rows": out}
+
+    def aggregate(self, rows: np.ndarray, by: str) -> List[dict]:
+        """
+        Counts of rows grouped by sky pixel (with its centre), night, user,
+        object or cadence, each with its exposure time and time span.
+        """
+        c = self.columns
+        mjd = c["mjd"][rows]
+        if by == "hpx":
+            values = c["hpx"][rows]
+        elif by == "night":
+            values = np.where(np.isfinite(mjd), np.floor(mjd - 0.5), -1).astype(np.int64)
+        elif by == "user":
+            values = c["user_id"][rows]
+        elif by == "object":
+            values = c["object_name"][rows]
+        elif by == "cadence":
+            values = c["cadence_min"][rows]
+        else:
+            raise ValueError(f"Unknown aggregate {by!r} (one of {', '.join(AGGREGATES)})")
+
+        keys, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+        exptime = np.bincount(inverse, weights=np.nan_to_num(c["exptime"][rows]), minlength=len(keys))
+        first = np.full(len(keys), np.inf)
+        last = np.full(len(keys), -np.inf)
+        np.minimum.at(first, inverse, np.where(np.isfinite(mjd), mjd, np.inf))
+        np.maximum.at(last, inverse, np.where(np.isfinite(mjd), mjd, -np.inf))
+
+        if by == "hpx":
+            centre_ra, centre_dec = pix2ang(self.nside, np.maximum(keys, 0))
+
+        groups = []
+        for i, (k, n, t, t0, t1) in enumerate(zip(keys, counts, exptime, first, last)):
+            group = {by: k.item(), "n_stacks": int(n), "total_exptime": float(t),
+                     "mjd_start": float(t0) if np.isfinite(t0) else None,
+                     "mjd_end": float(t1) if np.isfinite(t1) else None}
+            if by == "night":
+                group["night"] = _night(k + 0.5) if k >= 0 else None
+            elif by == "hpx" and k >= 0:
+                group["ra"], group["dec"] = float(centre_ra[i]), float(centre_dec[i])
+            groups.append(group)
+        return groups
+
+
+# -- sync --------------------------------------------------------------------
+
+async def sync(index: SkyIndex, page_size: int = SYNC_PAGE) -> SkyIndex:
+    """Add the stacks completed since the index was last synced (see module docstring)."""
+    from .api_client import get_stack_index
+
+    after = index.max_id
+    body = await get_stack_index(after, page_size)
+    if int(body["n_upto"]) != len(index):
+        logger.info(f"Sky index: {len(index) - int(body['n_upto'])} stacks deleted, rebuilding")
+        index = SkyIndex(nside=index.nside)
+        after = 0
+        body = await get_stack_index(after, page_size)
+
+    added = 0
+    while body["stacks"]:
+        added += index.add(body["stacks"])
+        after = max(int(s["id"]) for s in body["stacks"])
+        if len(body["stacks"]) < page_size:
+            break
+        body = await get_stack_index(after, page_size)
+    logger.info(f"Sky index: {added} stacks added, {len(index)} indexed")
+    return index
+
+
+async def _sync_file(path: Path) -> SkyIndex:
+    from . import sessions
+
+    index = SkyIndex.load(path) if path.exists() else SkyIndex()
+    try:
+        index = await sync(index)
+    finally:
+        await sessions.close()
+    index.save(path)
+    return index
+
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    """MJD from a number or an ISO date / datetime."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return _mjd(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the sky-position index of stacked frames")
+    parser.add_argument("--index", type=Path, default=config.SKY_INDEX_PATH)
+    parser.add_argument("--sync", action="store_true", help="Update the index from the API first")
+    parser.add_argument("--cone", type=float, nargs=3, metavar=("RA", "DEC", "RADIUS"),
+                        help="Stacks within RADIUS deg of RA, DEC")
+    parser.add_argument("--start", help="From this time (MJD or ISO date)")
+    parser.add_argument("--end", help="Until this time (MJD or ISO date)")
+    parser.add_argument("--user", type=int)
+    parser.add_argument("--cadence", type=int)
+    parser.add_argument("--by", choices=AGGREGATES, help="Aggregate instead of listing")
+    parser.add_argument("--page", type=int, default=1)
+    parser.add_argument("--per-page", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.sync:
+        index = asyncio.run(_sync_file(args.index))
+    elif args.index.exists():
+        index = SkyIndex.load(args.index)
+    else:
+        sys.exit(f"No index at {args.index} (run with --sync)")
+
+    start, end = _parse_time(args.start), _parse_time(args.end)
+    if args.cone:
+        rows = index.cone(*args.cone, start=start, end=end)
+    else:
+        rows = index.time_range(start, end)
+    rows = index.select(rows, user_id=args.user, cadence=args.cadence)
+
+    if args.by:
+        result = {"total": len(rows), "groups": index.aggregate(rows, args.by)}
+    else:
+        result = index.page(rows, args.page, args.per_page)
+    json.dump(result, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,18 @@
 Adapter wrapping seestarpy's FrameCollection for CrowdSky worker.
 """
 
+import logging
 from pathlib import Path
-from typing import List, Optional
-from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from dataclasses import dataclass, field
 
+from astropy.io import fits
 from seestarpy.stacking.stacking import FrameCollection
 
+from . import prescreen
+
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class StackResult:
@@ -20,6 +26,21 @@ class StackResult:
     date_obs_end: Optional[str]
     ra_deg: Optional[float]
     dec_deg: Optional[float]
+    # Cadence of this product in minutes and its slot within the 15-min chunk
+    cadence_min: int = 15
+    slot_index: int = 0
+    # Finer-cadence products made in the same pass (streaming tiers)
+    products: List["StackResult"] = field(default_factory=list)
+    # PNG previews already rendered from the in-memory stack, by size
+    previews: Dict[int, Path] = field(default_factory=dict)
+    # Source catalog written next to the stack (see photometry.py)
+    catalog: Optional[Path] = None
+    # Frames left out of the stack, by filename, with the reason
+    rejected: Dict[str, str] = field(default_factory=dict)
+    # Tile compression of the written file (see compression.py) and its
+    # size before compression
+    compression: str = "none"
+    uncompressed_bytes: Optional[int] = None
 
 
 def stack_files(
@@ -27,6 +48,9 @@ def stack_files(
     output_path: Path,
     method: str = "mean",
     sigma_clip: float = 3.0,
+    screen: bool = True,
+    align: str = "stars",
+    combine: str = "seestarpy",
 ) -> StackResult:
     """
     Stack a list of FITS files using seestarpy and save the result.
@@ -36,24 +60,108 @@ def stack_files(
         output_path: Where to write the stacked FITS output.
         method: Stacking method ('mean' or 'median').
         sigma_clip: Sigma for outlier rejection.
+        screen: Drop clouded, trailed and blurred frames (see ``prescreen``)
+            before seestarpy's star detection and alignment.
+        align: ``'stars'`` for seestarpy's asterism matching, or ``'phase'``
+            to align by phase correlation of binned frames (falling back to
+            asterism matching per frame) and stack with the streaming engine,
+            reading the frames from disk; ``'phase'`` supports ``'mean'`` only.
+        combine: ``'seestarpy'``, or ``'tiled'`` to align frames into a
+            memory-mapped cube and combine it in bands (see ``tiled_stack``),
+            so memory does not grow with the number of frames.
 
     Returns:
         StackResult with metadata about the stack.
     """
-    fc = FrameCollection(fits_paths)
+    rejected = prescreen_files(fits_paths) if screen else {}
+    kept = [p for p in fits_paths if p.name not in rejected]
+    if len(kept) < 2:
+        logger.warning(
+            f"Prescreen kept {len(kept)}/{len(fits_paths)} frames, stacking all of them"
+        )
+        kept, rejected = fits_paths, {}
+
+    # The engines below are imported here because they import this module
+    if combine == "tiled":
+        from .tiled_stack import stack_tiled
+        result = stack_tiled(kept, output_path, method, sigma_clip, align=align)
+        result.n_frames_input = len(fits_paths)
+        result.rejected.update(rejected)
+        return result
+
+    if align == "phase":
+        # seestarpy has no alternative aligner
+        from .streaming_stack import stack_stream
+        result = stack_stream(
+            ((p.name, p.read_bytes()) for p in kept), output_path,
+            method=method, sigma_clip=sigma_clip, screen=False, align="phase",
+        )
+        result.n_frames_input = len(fits_paths)
+        result.rejected.update(rejected)
+        return result
+
+    fc = FrameCollection(kept)
     fc.process(method=method, sigma_clip=sigma_clip, detect_stars=True)
     fc.save(output_path)
 
-    # Extract metadata from frames
+    headers = [
+        frame.hdu.header
+        for frame in fc.frames
+        if hasattr(frame, "hdu") and frame.hdu
+    ]
+
+    n_stars = None
+    if hasattr(fc, "_stars_table") and fc._stars_table is not None:
+        n_stars = len(fc._stars_table)
+
+    return StackResult(
+        output_path=output_path,
+        n_frames_input=len(fits_paths),
+        n_aligned=fc.n_aligned,
+        n_stars_detected=n_stars,
+        rejected=rejected,
+        **summarize_headers(headers),
+    )
+
+
+def prescreen_files(fits_paths: List[Path]) -> Dict[str, str]:
+    """
+    Measure every frame on a binned preview and judge it against the chunk.
+
+    Returns:
+        Rejection reason per filename (frames that cannot be read are rejected
+        too, since seestarpy would fail on them).
+    """
+    qualities = {}
+    rejected = {}
+    for path in fits_paths:
+        try:
+            # Not memory-mapped: raws are uint16 stored with BZERO, which astropy
+            # cannot map
+            with fits.open(path, memmap=False) as hdul:
+                qualities[path.name] = prescreen.measure(hdul[0].data)
+        except Exception as e:
+            rejected[path.name] = f"unreadable ({e})"
+    rejected.update(prescreen.screen(qualities))
+    for name, reason in rejected.items():
+        logger.info(f"Prescreen: dropping {name}: {reason}")
+    return rejected
+
+
+def summarize_headers(headers: Iterable) -> dict:
+    """
+    Collect stack metadata from the raw frame headers.
+
+    Returns:
+        Dict with ``total_exptime``, ``date_obs_start``, ``date_obs_end``,
+        ``ra_deg`` and ``dec_deg`` (each None if no frame has the keyword).
+    """
     exptimes = []
     date_obs_values = []
     ra_values = []
     dec_values = []
 
-    for frame in fc.frames:
-        hdr = frame.hdu.header if hasattr(frame, "hdu") and frame.hdu else None
-        if hdr is None:
-            continue
+    for hdr in headers:
         if "EXPTIME" in hdr:
             exptimes.append(float(hdr["EXPTIME"]))
         if "DATE-OBS" in hdr:
@@ -63,24 +171,10 @@ def stack_files(
         if "DEC" in hdr:
             dec_values.append(float(hdr["DEC"]))
 
-    total_exptime = sum(exptimes) if exptimes else None
-    date_obs_start = min(date_obs_values) if date_obs_values else None
-    date_obs_end = max(date_obs_values) if date_obs_values else None
-    ra_deg = sum(ra_values) / len(ra_values) if ra_values else None
-    dec_deg = sum(dec_values) / len(dec_values) if dec_values else None
-
-    n_stars = None
-    if hasattr(fc, "_stars_table") and fc._stars_table is not None:
-        n_stars = len(fc._stars_table)
-
-    return StackResult(
-        output_path=output_path,
-        n_frames_input=fc.n_frames,
-        n_aligned=fc.n_aligned,
-        n_stars_detected=n_stars,
-        total_exptime=total_exptime,
-        date_obs_start=date_obs_start,
-        date_obs_end=date_obs_end,
-        ra_deg=ra_deg,
-        dec_deg=dec_deg,
-    )
+    return {
+        "total_exptime": sum(exptimes) if exptimes else None,
+        "date_obs_start": min(date_obs_values) if date_obs_values else None,
+        "date_obs_end": max(date_obs_values) if date_obs_values else None,
+        "ra_deg": sum(ra_values) / len(ra_values) if ra_values else None,
+        "dec_deg": sum(dec_values) / len(dec_values) if dec_values else None,
+    }
@@ -0,0 +1,818 @@
+"""
+Streaming stacking engine: decode, align and accumulate one frame at a time.
+
+Frames arrive as raw FITS bytes straight from the download stage, are debayered
+into NumPy buffers, aligned to the reference frame's star list and folded into a
+running accumulator. Only the final stack is written to WORK_DIR, and peak
+memory is one frame plus the accumulator (and a few warm-up frames) instead of
+the whole chunk.
+
+Outlier rejection is a winsorized running sigma clip. The first frames seed
+robust per-pixel statistics (median / MAD); after that, every new frame is
+clipped to mean +/- sigma_clip * std of the running Welford statistics before
+it is folded in.
+
+Finer cadences (e.g. 3 and 1 minute within the 15-minute chunk) come out of
+the same pass: every clipped frame is also added to the partial sum of its
+finest time bin, and closed bins are summed into the next coarser one (see
+``TierSums``).
+
+With a cache (see ``cache.py``), each frame's control points and its
+transform onto the reference are stored under the SHA1 of its raw bytes, so a
+retried job only decodes and warps.
+
+Frames are first aligned by a warm start: the previous frame's transform
+predicts where the frame's stars fall on the reference, and a similarity fit
+on the nearest-neighbour pairs replaces triangle matching. With a
+``pointing.ReferenceCache``, a chunk starts from the reference and last
+transform of the previous chunk of the same pointing. With
+``align="phase"``, frames are aligned by phase correlation of binned frames
+instead (see ``phase_align.py``), and stars are only extracted when that
+fails.
+"""
+
+import io
+import logging
+import warnings
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import astroalign
+import cv2
+import numpy as np
+import sep
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+from . import phase_align, prescreen
+from .cache import LRUCache, content_key
+from .executor import run_stage, submit_timed, unwrap
+from .pointing import Reference, ReferenceCache
+from .shm import SharedArray, share, take
+from .stacking_adapter import StackResult, summarize_headers
+from .thumbnail import preview_paths, render_previews
+
+logger = logging.getLogger(__name__)
+
+# Frames buffered to seed the robust per-pixel statistics
+WARMUP_FRAMES = 5
+# Brightest stars used as alignment control points
+MAX_CONTROL_STARS = 50
+# Detection threshold (in background RMS) for star extraction
+DETECT_SIGMA = 5.0
+# Warm start: search radius (px) around predicted star positions, star pairs
+# needed, and the inlier tolerance (px) of the similarity fit
+WARM_RADIUS = 10.0
+WARM_MIN_MATCHES = 8
+WARM_TOLERANCE = 2.0
+# Seestar S50 sensors are GRBG; used when a frame has no BAYERPAT keyword
+DEFAULT_BAYERPAT = "GRBG"
+# Length of a job's chunk in minutes (see computeChunkKey() in web/fits_utils.php)
+CHUNK_MINUTES = 15
+
+# OpenCV names Bayer patterns after the second row, hence the shifted names
+_BAYER_CODES = {
+    "RGGB": cv2.COLOR_BayerBG2RGB,
+    "BGGR": cv2.COLOR_BayerRG2RGB,
+    "GRBG": cv2.COLOR_BayerGB2RGB,
+    "GBRG": cv2.COLOR_BayerGR2RGB,
+}
+
+sep.set_extract_pixstack(1_000_000)
+
+
+def decode_frame(data: bytes) -> Tuple[fits.Header, np.ndarray]:
+    """
+    Decode raw FITS bytes into a header and an (H, W, 3) float32 RGB array.
+
+    2D data is treated as a Bayer mosaic and debayered according to BAYERPAT.
+    """
+    with fits.open(io.BytesIO(data)) as hdul:
+        header = hdul[0].header.copy()
+        raw = hdul[0].data
+
+    if raw is None:
+        raise ValueError("No data in primary HDU")
+
+    if raw.ndim == 2:
+        pattern = str(header.get("BAYERPAT", DEFAULT_BAYERPAT)).strip().upper()
+        if pattern not in _BAYER_CODES:
+            raise ValueError(f"Unsupported Bayer pattern: {pattern}")
+        mosaic = np.clip(raw, 0, 65535).astype(np.uint16)
+        rgb = cv2.cvtColor(mosaic, _BAYER_CODES[pattern]).astype(np.float32)
+    elif raw.ndim == 3 and raw.shape[0] == 3:
+        rgb = np.ascontiguousarray(np.transpose(raw, (1, 2, 0)), dtype=np.float32)
+    elif raw.ndim == 3 and raw.shape[2] == 3:
+        rgb = np.ascontiguousarray(raw, dtype=np.float32)
+    else:
+        raise ValueError(f"Unexpected data shape: {raw.shape}")
+
+    return header, rgb
+
+
+def luminance(rgb: np.ndarray) -> np.ndarray:
+    """Mean of the three channels as a C-contiguous float32 image."""
+    return np.ascontiguousarray(rgb.mean(axis=2, dtype=np.float32))
+
+
+def extract_stars(lum: np.ndarray, thresh: float = DETECT_SIGMA) -> np.ndarray:
+    """Run SEP source extraction on a background-subtracted luminance image."""
+    bkg = sep.Background(lum)
+    return sep.extract(lum - bkg, thresh, err=bkg.globalrms, minarea=5)
+
+
+def control_points(lum: np.ndarray, max_stars: int = MAX_CONTROL_STARS) -> np.ndarray:
+    """(N, 2) pixel positions of the brightest stars, brightest first."""
+    objects = extract_stars(lum)
+    order = np.argsort(objects["flux"])[::-1][:max_stars]
+    return np.column_stack([objects["x"][order], objects["y"][order]])
+
+
+def warm_transform(
+    points: np.ndarray, ref_points: np.ndarray, guess: Optional[np.ndarray],
+) -> Optional[np.ndarray]:
+    """
+    2x3 transform of ``points`` onto ``ref_points`` starting from ``guess``
+    (e.g. the previous frame's transform), or None if too few stars match.
+    """
+    if guess is None or len(points) < WARM_MIN_MATCHES or len(ref_points) < WARM_MIN_MATCHES:
+        return None
+    predicted = points @ guess[:, :2].T + guess[:, 2]
+    dist, idx = cKDTree(ref_points).query(predicted, distance_upper_bound=WARM_RADIUS)
+    paired = np.isfinite(dist)
+    if paired.sum() < WARM_MIN_MATCHES:
+        return None
+    matrix, inliers = cv2.estimateAffinePartial2D(
+        points[paired].astype(np.float32), ref_points[idx[paired]].astype(np.float32),
+        method=cv2.RANSAC, ransacReprojThreshold=WARM_TOLERANCE,
+    )
+    if matrix is None or inliers is None or inliers.sum() < WARM_MIN_MATCHES:
+        return None
+    return matrix
+
+
+def warp_frame(rgb: np.ndarray, matrix: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Apply a 2x3 affine transform, marking pixels outside the footprint as NaN.
+    """
+    h, w = shape
+    matrix = np.asarray(matrix, dtype=np.float32)
+    aligned = cv2.warpAffine(rgb, matrix, (w, h), flags=cv2.INTER_LINEAR)
+    footprint = cv2.warpAffine(np.ones(rgb.shape[:2], np.float32), matrix, (w, h))
+    aligned[footprint < 0.999] = np.nan
+    return aligned
+
+
+class WinsorizedAccumulator:
+    """
+    Running per-pixel mean with winsorized sigma clipping in bounded memory.
+
+    Frames are (H, W, 3) float32 arrays with NaN outside their footprint. The
+    footprint is shared by all channels, so the per-pixel count is (H, W, 1).
+
+    If ``sink`` is given, it is called as ``sink(tag, clipped, valid)`` for
+    every frame once it has been clipped (for warm-up frames, only after the
+    warm-up), with the ``tag`` passed to ``add()``.
+    """
+
+    def __init__(
+        self,
+        sigma_clip: float = 3.0,
+        warmup: int = WARMUP_FRAMES,
+        sink: Optional[Callable[[Hashable, np.ndarray, np.ndarray], None]] = None,
+    ):
+        self.sigma_clip = sigma_clip
+        self.warmup = max(1, warmup)
+        self.sink = sink
+        self.count: Optional[np.ndarray] = None
+        self.mean: Optional[np.ndarray] = None
+        self.m2: Optional[np.ndarray] = None
+        self.n_frames = 0
+        self.n_clipped = 0
+        self._buffer: List[Tuple[np.ndarray, Hashable]] = []
+
+    def add(self, frame: np.ndarray, tag: Hashable = None) -> None:
+        self.n_frames += 1
+        if self.mean is None:
+            self._buffer.append((frame, tag))
+            if len(self._buffer) >= self.warmup:
+                self._seed()
+            return
+
+        with np.errstate(invalid="ignore"):
+            std = np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+            lo = self.mean - self.sigma_clip * std
+            hi = self.mean + self.sigma_clip * std
+        # Too few samples for a meaningful spread: do not clip
+        unknown = np.broadcast_to(self.count < 2, lo.shape)
+        lo[unknown] = np.nan
+        hi[unknown] = np.nan
+        self._fold(frame, lo, hi, tag)
+
+    def _seed(self) -> None:
+        """Fold the warm-up frames in, clipped against their median / MAD."""
+        cube = np.stack([frame for frame, _ in self._buffer])
+        tags = [tag for _, tag in self._buffer]
+        self._buffer = []
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            center = np.nanmedian(cube, axis=0)
+            spread = 1.4826 * np.nanmedian(np.abs(cube - center), axis=0)
+
+        self.count = np.zeros(center.shape[:2] + (1,), np.float32)
+        self.mean = np.zeros(center.shape, np.float32)
+        self.m2 = np.zeros(center.shape, np.float32)
+
+        lo = center - self.sigma_clip * spread
+        hi = center + self.sigma_clip * spread
+        for frame, tag in zip(cube, tags):
+            self._fold(frame, lo, hi, tag)
+
+    def _fold(self, frame: np.ndarray, lo: np.ndarray, hi: np.ndarray, tag: Hashable = None) -> None:
+        """Clip ``frame`` to [lo, hi] (NaN bounds = no limit) and update Welford."""
+        valid = ~np.isnan(frame[..., :1])
+        x = np.fmin(np.fmax(frame, lo), hi)
+        self.n_clipped += int(np.count_nonzero((x != frame) & valid))
+
+        x = np.where(valid, x, self.mean)
+        if self.sink is not None:
+            self.sink(tag, x, valid)
+        self.count += valid
+        delta = x - self.mean
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * (x - self.mean)
+
+    def finalize(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            The stacked (H, W, 3) image (0 where no frame contributed) and the
+            (H, W) per-pixel frame count.
+        """
+        if self.mean is None:
+            if not self._buffer:
+                raise ValueError("No frames were accumulated")
+            self._seed()
+        image = np.where(self.count > 0, self.mean, 0).astype(np.float32)
+        return image, self.count[..., 0]
+
+
+@dataclass
+class _Bin:
+    sum: Optional[np.ndarray] = None
+    count: Optional[np.ndarray] = None
+    headers: list = field(default_factory=list)
+    n_input: int = 0
+    n_aligned: int = 0
+
+
+class TierSums:
+    """
+    Hierarchical partial sums of clipped frames for several cadences.
+
+    ``cadences`` (minutes, e.g. ``[15, 3, 1]``) must each divide the next
+    coarser one and ``CHUNK_MINUTES``. Frames are scheduled up front from
+    their offsets (seconds since chunk start). Each clipped frame is added to
+    its finest bin; once all frames of a bin are done, the bin is emitted and
+    its sum added to the enclosing bin one level up. The coarsest level is a
+    single bin covering the whole chunk, so a 15-minute product is exactly the
+    sum of its 3-minute partials, and each of those of its 1-minute partials.
+
+    ``emit(cadence_min, index, image, count, bin)`` receives each closed bin,
+    finest first, with the mean image (0 where no data) and (H, W) counts.
+    Frames that were not scheduled only contribute to the chunk-level bin.
+    """
+
+    def __init__(
+        self,
+        cadences: Sequence[int],
+        frame_offsets: Dict[str, float],
+        emit: Callable[[int, int, np.ndarray, np.ndarray, _Bin], None],
+    ):
+        self.cadences = sorted(set(cadences) | {CHUNK_MINUTES})
+        for finer, coarser in zip(self.cadences, self.cadences[1:]):
+            if coarser % finer:
+                raise ValueError(f"Cadence {finer} min does not divide {coarser} min")
+        if self.cadences[-1] != CHUNK_MINUTES:
+            raise ValueError(f"Cadences must not exceed the {CHUNK_MINUTES}-min chunk")
+
+        self.emit = emit
+        self.top = len(self.cadences) - 1
+        self.bins: Dict[Tuple[int, int], _Bin] = {}
+        self.leaf_of = {name: self._index(0, offset) for name, offset in frame_offsets.items()}
+
+        # Work left before a bin can close: frames for the finest level,
+        # non-empty child bins above it
+        self.remaining: Counter = Counter((0, i) for i in self.leaf_of.values())
+        level_keys = set(self.remaining)
+        for level in range(1, len(self.cadences)):
+            level_keys = {(level, self._parent(key)) for key in level_keys}
+            for key in level_keys:
+                self.remaining[key] = 0
+        for key in list(self.remaining):
+            if key[0] < self.top:
+                self.remaining[(key[0] + 1, self._parent(key))] += 1
+        for leaf in self.leaf_of.values():
+            self._bin((0, leaf)).n_input += 1
+
+    def _index(self, level: int, offset: float) -> int:
+        width = self.cadences[level] * 60
+        n = CHUNK_MINUTES // self.cadences[level]
+        return min(max(int(offset // width), 0), n - 1)
+
+    def _parent(self, key: Tuple[int, int]) -> int:
+        level, index = key
+        return index * self.cadences[level] // self.cadences[level + 1]
+
+    def _bin(self, key: Tuple[int, int]) -> _Bin:
+        if key not in self.bins:
+            self.bins[key] = _Bin()
+        return self.bins[key]
+
+    @staticmethod
+    def _merge(target: _Bin, total: np.ndarray, count: np.ndarray) -> None:
+        if target.sum is None:
+            target.sum = total.copy()
+            target.count = count.copy()
+        else:
+            target.sum += total
+            target.count += count
+
+    def header(self, name: str, header) -> None:
+        """Record a frame's header for the metadata of its bins."""
+        if name in self.leaf_of:
+            self._bin((0, self.leaf_of[name])).headers.append(header)
+        else:
+            self._bin((self.top, 0)).headers.append(header)
+
+    def add(self, name: str, clipped: np.ndarray, valid: np.ndarray) -> None:
+        """Accumulator sink: add a clipped frame to its bin."""
+        if name not in self.leaf_of:
+            logger.warning(f"{name}: not scheduled, only counted in the {CHUNK_MINUTES}-min stack")
+            target = self._bin((self.top, 0))
+            target.n_input += 1
+            target.n_aligned += 1
+            self._merge(target, np.where(valid, clipped, 0), valid.astype(np.float32))
+            return
+        key = (0, self.leaf_of[name])
+        target = self._bin(key)
+        target.n_aligned += 1
+        self._merge(target, np.where(valid, clipped, 0), valid.astype(np.float32))
+        self._done(key)
+
+    def skip(self, name: str) -> None:
+        """A scheduled frame will not be added (decode / alignment failed)."""
+        if name in self.leaf_of:
+            self._done((0, self.leaf_of[name]))
+
+    def _done(self, key: Tuple[int, int]) -> None:
+        self.remaining[key] -= 1
+        if self.remaining[key] <= 0 and key[0] < self.top:
+            self._close(key)
+
+    def _close(self, key: Tuple[int, int]) -> None:
+        level, index = key
+        b = self.bins.pop(key, _Bin())
+        parent_key = (level + 1, self._parent(key))
+        parent = self._bin(parent_key)
+        parent.headers.extend(b.headers)
+        parent.n_input += b.n_input
+        parent.n_aligned += b.n_aligned
+        if b.sum is not None:
+            self._emit(level, index, b)
+            self._merge(parent, b.sum, b.count)
+        self._done(parent_key)
+
+    def _emit(self, level: int, index: int, b: _Bin) -> None:
+        count = b.count[..., 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            image = np.where(b.count > 0, b.sum / b.count, 0).astype(np.float32)
+        self.emit(self.cadences[level], index, image, count, b)
+
+    def finish(self) -> None:
+        """Close every bin still open (finest first) and emit the chunk level."""
+        for level in range(self.top):
+            for key in sorted(k for k in self.bins if k[0] == level):
+                if key in self.bins:
+                    self._close(key)
+        top = self.bins.pop((self.top, 0), None)
+        if top is None or top.sum is None:
+            raise ValueError("No frames were accumulated")
+        self._emit(self.top, 0, top)
+
+
+def write_stack(
+    output_path: Path,
+    image: np.ndarray,
+    count: np.ndarray,
+    stars: Optional[np.ndarray],
+    metadata: dict,
+) -> None:
+    """Write RGB data + footprint + optional star catalog, like FrameCollection.save()."""
+    header = fits.Header()
+    header["NCOMBINE"] = (int(count.max()) if count.size else 0, "Max frames per pixel")
+    if metadata.get("total_exptime") is not None:
+        header["EXPTIME"] = (metadata["total_exptime"], "Total exposure time [s]")
+    if metadata.get("date_obs_start"):
+        header["DATE-OBS"] = metadata["date_obs_start"]
+    if metadata.get("date_obs_end"):
+        header["DATE-END"] = metadata["date_obs_end"]
+    if metadata.get("ra_deg") is not None:
+        header["RA"] = metadata["ra_deg"]
+    if metadata.get("dec_deg") is not None:
+        header["DEC"] = metadata["dec_deg"]
+
+    hdus = [
+        fits.PrimaryHDU(image, header=header),
+        fits.ImageHDU(count.astype(np.uint16), name="FOOTPRINT"),
+    ]
+    if stars is not None:
+        hdus.append(fits.BinTableHDU(stars, name="STARS"))
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    fits.HDUList(hdus).writeto(output_path, overwrite=True)
+
+
+@dataclass
+class PreparedFrame:
+    header: fits.Header
+    points: np.ndarray
+    frame: Union[np.ndarray, SharedArray, None] = None
+    error: Optional[str] = None
+    matrix: Optional[np.ndarray] = None
+    quality: Optional[prescreen.FrameQuality] = None
+    # How the transform was found: "cache", "phase", "warm" or "triangles"
+    aligned_by: Optional[str] = None
+    # Binned luminance of a reference candidate, for phase correlation
+    small: Optional[np.ndarray] = None
+
+
+def prepare_frame(
+    data: bytes,
+    ref_points: Optional[np.ndarray] = None,
+    ref_shape: Optional[Tuple[int, int]] = None,
+    shared: bool = False,
+    points: Optional[np.ndarray] = None,
+    matrix: Optional[np.ndarray] = None,
+    limits: Optional[prescreen.Limits] = None,
+    guess: Optional[np.ndarray] = None,
+    phase: bool = False,
+    ref_small: Optional[np.ndarray] = None,
+) -> PreparedFrame:
+    """
+    Decode one frame and align it to the reference (the CPU-heavy part).
+
+    Without ``ref_points`` the frame is returned unwarped, to become the
+    reference (with ``phase``, also its binned luminance in ``small``). With
+    ``shared=True`` the frame is handed back through shared memory so this
+    can run in a process pool without pickling the array.
+
+    A previously computed (cached) ``matrix`` skips alignment, cached
+    ``points`` skip star extraction. Otherwise, with ``phase`` and the
+    reference's ``ref_small``, the transform is measured by phase correlation
+    (``phase_align``) without extracting stars; failing that (or without
+    ``phase``) it is fitted to star positions from ``guess``
+    (``warm_transform``), and only solved by triangle matching if that fails
+    too. With ``limits``, the frame is prescreened first and a bad frame is
+    rejected before any of that. Alignment failures and rejections are
+    reported in ``error``; decode failures raise.
+    """
+    header, rgb = decode_frame(data)
+    quality = None
+    aligned_by = "cache" if matrix is not None else None
+    small = None
+    if limits is not None:
+        quality = prescreen.measure(rgb)
+        reason = prescreen.reject_reason(quality, limits)
+        if reason:
+            return PreparedFrame(header, np.empty((0, 2)), error=f"rejected: {reason}", quality=quality)
+    try:
+        if ref_points is None:
+            if points is None:
+                points = control_points(luminance(rgb))
+            if len(points) < 3:
+                raise ValueError(f"only {len(points)} stars detected")
+            if phase:
+                small = phase_align.binned(rgb)
+            frame = rgb
+        else:
+            if matrix is None and phase and ref_small is not None:
+                matrix = phase_align.transform(phase_align.binned(rgb), ref_small, guess)
+                aligned_by = "phase" if matrix is not None else None
+            if matrix is None:
+                if points is None:
+                    points = control_points(luminance(rgb))
+                matrix = warm_transform(points, ref_points, guess)
+                aligned_by = "warm" if matrix is not None else None
+            if matrix is None:
+                transform, _ = astroalign.find_transform(points, ref_points)
+                matrix = transform.params[:2]
+                aligned_by = "triangles"
+            frame = warp_frame(rgb, matrix, ref_shape)
+    except Exception as e:
+        return PreparedFrame(header, np.empty((0, 2)), error=f"alignment failed ({e})", quality=quality)
+
+    if points is None:
+        points = np.empty((0, 2))
+    return PreparedFrame(
+        header, points, share(frame) if shared else frame, matrix=matrix, quality=quality,
+        aligned_by=aligned_by, small=small,
+    )
+
+
+def iter_prepared(
+    frames: Iterable[Tuple[str, bytes]],
+    pool,
+    cache: Optional[LRUCache] = None,
+    screen: bool = True,
+    reference: Optional[Reference] = None,
+    phase: bool = False,
+) -> Iterator[Tuple[str, PreparedFrame]]:
+    """
+    Yield ``(name, PreparedFrame)`` for every frame, with ``frame`` as a plain
+    array (frames that could not be decoded, were rejected by the prescreen or
+    could not be aligned carry an ``error``). The first frame that passes the
+    prescreen with enough stars becomes the reference. Prescreen limits
+    tighten as accepted frames come in (``prescreen.RunningLimits``).
+
+    ``reference`` is updated in place with the reference in use and the most
+    recent transform, the warm start for the next frame. If it already holds
+    an earlier chunk's reference, that one is used instead of picking a frame;
+    it is dropped for a fresh one if the first frame checked against it does
+    not align. With ``phase``, frames are aligned by phase correlation
+    against the reference's binned luminance where possible.
+
+    With a pool, frames after the reference are prepared in parallel, with at
+    most two in flight per process so shared memory stays bounded.
+    """
+    if reference is None:
+        reference = Reference()
+    inherited = reference.points is not None
+    pending = {}
+    frames = iter(frames)
+    running = prescreen.RunningLimits() if screen else None
+
+    def lookup(key):
+        """Cached (points, matrix) of a frame, each None on a miss."""
+        if cache is None:
+            return None, None
+        stars = cache.get_arrays(f"stars-{key}")
+        xform = cache.get_arrays(f"xform-{key}-{reference.key}") if reference.key else None
+        return (
+            stars["points"] if stars else None,
+            xform["matrix"] if xform else None,
+        )
+
+    def resolve(prepared: PreparedFrame, key, points, matrix) -> PreparedFrame:
+        if isinstance(prepared.frame, SharedArray):
+            prepared.frame = take(prepared.frame)
+        if prepared.error is None and prepared.matrix is not None:
+            reference.matrix = prepared.matrix
+        if running is not None and prepared.error is None and prepared.quality is not None:
+            running.add(prepared.quality)
+        if cache is not None and prepared.error is None:
+            if points is None and len(prepared.points):
+                cache.put_arrays(f"stars-{key}", points=prepared.points)
+            if matrix is None and prepared.matrix is not None:
+                cache.put_arrays(f"xform-{key}-{reference.key}", matrix=prepared.matrix)
+        return prepared
+
+    def prepare(data, key, points, matrix, limits) -> PreparedFrame:
+        """Prepare one frame on this thread (or one pool process) and resolve it."""
+        return resolve(run_stage(
+            pool, prepare_frame, data, reference.points, reference.shape, pool is not None,
+            points, matrix, limits, reference.matrix, phase, reference.small,
+        ), key, points, matrix)
+
+    try:
+        for name, data in frames:
+            key = content_key(data) if cache is not None else None
+            points, matrix = lookup(key)
+            limits = running.limits if running is not None else None
+            if reference.points is None or pool is None or inherited:
+                try:
+                    prepared = prepare(data, key, points, matrix, limits)
+                    if inherited and (prepared.error or "").startswith("alignment failed"):
+                        logger.info(f"{name}: does not align to the pointing's reference, choosing a new one")
+                        reference.points = reference.shape = reference.key = None
+                        reference.matrix = reference.small = None
+                        inherited = False
+                        prepared = prepare(data, key, points, None, limits)
+                except Exception as e:
+                    yield name, _undecodable(e)
+                    continue
+                if prepared.error is None:
+                    inherited = False
+                if reference.points is None and prepared.error is None:
+                    reference.points, reference.shape = prepared.points, prepared.frame.shape[:2]
+                    reference.key = key
+                    reference.matrix = np.eye(2, 3)
+                    reference.small, prepared.small = prepared.small, None
+                yield name, prepared
+                continue
+
+            future = submit_timed(
+                pool, prepare_frame, data, reference.points, reference.shape, True, points, matrix,
+                limits, reference.matrix, phase, reference.small,
+            )
+            pending[future] = (name, key, points, matrix)
+            while len(pending) >= 2 * pool.n_procs:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from _resolve_future(future, *pending.pop(future), resolve)
+
+        for future in as_completed(list(pending)):
+            yield from _resolve_future(future, *pending.pop(future), resolve)
+    finally:
+        # Release shared memory of frames nobody will consume
+        for future in pending:
+            if not future.cancel() and future.exception() is None:
+                frame = future.result().value.frame
+                if isinstance(frame, SharedArray):
+                    take(frame)
+
+
+def _resolve_future(
+    future, name, key, points, matrix, resolve,
+) -> Iterator[Tuple[str, PreparedFrame]]:
+    try:
+        prepared = resolve(unwrap(future.result()), key, points, matrix)
+    except Exception as e:
+        prepared = _undecodable(e)
+    yield name, prepared
+
+
+def _undecodable(exc: Exception) -> PreparedFrame:
+    return PreparedFrame(fits.Header(), np.empty((0, 2)), error=f"could not decode frame ({exc})")
+
+
+def write_product(
+    output_path: Path,
+    image: np.ndarray,
+    count: np.ndarray,
+    headers: list,
+    metadata: Optional[dict] = None,
+    **fields,
+) -> StackResult:
+    """
+    Detect stars on a stacked image, write it with its previews and describe
+    it. ``metadata`` (as from ``summarize_headers``) replaces the summary of
+    ``headers`` when given.
+    """
+    stars = None
+    try:
+        stars = extract_stars(luminance(image))
+    except Exception as e:
+        logger.warning(f"Star detection on {output_path.name} failed: {e}")
+
+    if metadata is None:
+        metadata = summarize_headers(headers)
+    write_stack(output_path, image, count, stars, metadata)
+
+    previews = {}
+    try:
+        previews = render_previews(image, preview_paths(output_path))
+    except Exception as e:
+        logger.warning(f"Previews of {output_path.name} failed: {e}")
+
+    return StackResult(
+        output_path=output_path,
+        n_stars_detected=len(stars) if stars is not None else None,
+        previews=previews,
+        **fields,
+        **metadata,
+    )
+
+
+def stack_stream(
+    frames: Iterable[Tuple[str, bytes]],
+    output_path: Path,
+    method: str = "mean",
+    sigma_clip: float = 3.0,
+    pool=None,
+    cache: Optional[LRUCache] = None,
+    cadences: Sequence[int] = (CHUNK_MINUTES,),
+    frame_offsets: Optional[Dict[str, float]] = None,
+    screen: bool = True,
+    references: Optional[ReferenceCache] = None,
+    pointing: Optional[str] = None,
+    align: str = "stars",
+) -> StackResult:
+    """
+    Stack frames as they arrive, without writing raws to disk.
+
+    Args:
+        frames: ``(filename, fits_bytes)`` pairs in any order; the first frame
+            with enough stars becomes the alignment reference, unless the
+            pointing already has one.
+        output_path: Where to write the stacked FITS output.
+        method: Only ``'mean'`` (winsorized sigma-clipped mean) is supported.
+        sigma_clip: Sigma for outlier rejection.
+        pool: Optional ``StackPool``; decoding and alignment then run in its
+            processes and frames come back through shared memory.
+        cache: Optional ``LRUCache`` for control points and transforms.
+        cadences: Cadences in minutes to produce, e.g. ``(15, 3, 1)``. Finer
+            products are written next to ``output_path`` as
+            ``{stem}_{cadence}m{slot:02d}.fits``.
+        frame_offsets: Seconds since chunk start per filename; required for
+            cadences below ``CHUNK_MINUTES``.
+        screen: Reject clouded, trailed and blurred frames before alignment
+            (see ``prescreen``).
+        references: Optional ``pointing.ReferenceCache``; the chunk starts from
+            the reference of ``pointing`` and leaves its own reference there.
+        pointing: Key of the chunk's pointing (``pointing.pointing_key``).
+        align: ``'stars'`` (star positions from a warm start, else triangle
+            matching) or ``'phase'`` (phase correlation of binned frames,
+            falling back to ``'stars'`` per frame).
+
+    Returns:
+        StackResult for the whole chunk; finer-cadence products are listed in
+        its ``products`` (finest cadence first, then by slot). Frames left out
+        are listed in ``rejected`` with the reason.
+    """
+    if method != "mean":
+        raise ValueError(f"Streaming stacking only supports method='mean', got {method!r}")
+    if align not in ("stars", "phase"):
+        raise ValueError(f"Unknown alignment method {align!r}")
+
+    tiers = None
+    products: List[StackResult] = []
+    chunk = {}
+
+    if set(cadences) - {CHUNK_MINUTES}:
+        def emit(cadence, index, image, count, b):
+            if cadence == CHUNK_MINUTES:
+                chunk.update(image=image, count=count)
+                return
+            products.append(write_product(
+                output_path.with_name(f"{output_path.stem}_{cadence}m{index:02d}.fits"),
+                image, count, b.headers,
+                n_frames_input=b.n_input, n_aligned=b.n_aligned,
+                cadence_min=cadence, slot_index=index,
+            ))
+
+        tiers = TierSums(cadences, frame_offsets or {}, emit)
+
+    acc = WinsorizedAccumulator(sigma_clip, sink=tiers.add if tiers else None)
+    headers = []
+    rejected = {}
+    n_input = 0
+    aligned_by = Counter()
+
+    cached = references.get(pointing) if references is not None else None
+    # A copy: chunks of one pointing may be stacked concurrently
+    reference = replace(cached) if cached is not None else Reference()
+
+    def counted():
+        nonlocal n_input
+        for item in frames:
+            n_input += 1
+            yield item
+
+    for name, prepared in iter_prepared(
+        counted(), pool, cache, screen, reference, phase=align == "phase",
+    ):
+        if prepared.error is not None:
+            logger.warning(f"{name}: {prepared.error}, skipping")
+            rejected[name] = prepared.error
+            if tiers is not None:
+                tiers.skip(name)
+            continue
+        # Only kept frames count toward exposure, dates and position, as in
+        # disk mode
+        headers.append(prepared.header)
+        if tiers is not None:
+            tiers.header(name, prepared.header)
+        aligned_by[prepared.aligned_by or "reference"] += 1
+        acc.add(prepared.frame, name)
+
+    if references is not None:
+        if reference.points is not None and not reference.drifted():
+            references.put(pointing, reference)
+        else:
+            references.invalidate(pointing)
+
+    image, count = acc.finalize()
+    if tiers is not None:
+        # The chunk-level image is the sum of the partials (equal to the
+        # running mean up to rounding)
+        tiers.finish()
+        image, count = chunk["image"], chunk["count"]
+        products.sort(key=lambda p: (p.cadence_min, p.slot_index))
+
+    result = write_product(
+        output_path, image, count, headers,
+        n_frames_input=n_input, n_aligned=acc.n_frames, products=products,
+        rejected=rejected,
+    )
+    logger.info(
+        f"Streamed {acc.n_frames}/{n_input} frames into {output_path.name} "
+        f"({len(rejected)} rejected, aligned by "
+        f"{', '.join(f'{how} {n}' for how, n in aligned_by.most_common())}, "
+        f"{'inherited' if cached is not None and reference.points is cached.points else 'new'} reference, "
+        f"{acc.n_clipped} pixels clipped, "
+        f"{len(products)} finer-cadence products)"
+    )
+    return result
@@ -1,17 +1,184 @@
 """
-Generate PNG thumbnail from a stacked FITS file.
+Generate PNG previews of stacked images.
+
+The stack is first block-averaged down to about the largest preview size, so
+the percentile stretch, normalization and Pillow resampling only ever touch a
+small array. The stretch limits are estimated from a strided subsample of that
+array, and normalization happens in place.
+
+The streaming stacker renders previews straight from the in-memory stack
+(``render_previews``). Stacks written by seestarpy are read back from FITS with
+memory mapping (``generate_previews``), one row band at a time.
 """
 
+import warnings
 from pathlib import Path
+from typing import Dict, Iterable, Optional
+
 import numpy as np
 from PIL import Image
 from astropy.io import fits
 
+from .compression import image_hdu
+
+# Preview widths for stacks.php; THUMB_SIZE is the one stored as thumbnail_path
+PREVIEW_SIZES = (256, 512, 1024)
+THUMB_SIZE = 512
+# Stretch limits (percentiles) mapped to 0 and 255
+STRETCH_PERCENTILES = (1, 99.5)
+# Pixels sampled to estimate the stretch limits
+STRETCH_SAMPLES = 250_000
+# Rows of the reduced image computed per band (bounds temporaries on big stacks)
+_BAND_ROWS = 64
+
+
+def preview_paths(stack_path: Path, sizes: Iterable[int] = PREVIEW_SIZES) -> Dict[int, Path]:
+    """
+    Output paths for the previews of ``stack_path``.
+
+    The ``THUMB_SIZE`` preview keeps the ``{stem}_thumb.png`` name; the others
+    are ``{stem}_thumb_{size}.png`` (see thumbnail.php).
+    """
+    return {
+        size: stack_path.with_name(
+            f"{stack_path.stem}_thumb.png" if size == THUMB_SIZE
+            else f"{stack_path.stem}_thumb_{size}.png"
+        )
+        for size in sizes
+    }
+
+
+def _channels(data: np.ndarray) -> np.ndarray:
+    """View of the image as (C, H, W), without copying."""
+    if data.ndim == 3 and data.shape[0] == 3:
+        return data
+    if data.ndim == 3 and data.shape[2] == 3:
+        # (H, W, 3) — seestarpy and the streaming stacker output this format
+        return np.moveaxis(data, 2, 0)
+    if data.ndim == 2:
+        return data[np.newaxis]
+    raise ValueError(f"Unexpected data shape: {data.shape}")
+
+
+def block_reduce(data: np.ndarray, max_size: int) -> np.ndarray:
+    """
+    Block-average an image so its longer side is between ``max_size`` and
+    ``2 * max_size`` pixels (or unchanged if it is already smaller).
+
+    Returns a (C, h, w) float32 array. NaNs (pixels outside the stack
+    footprint) are ignored; blocks with no valid pixel stay NaN.
+    """
+    chans = _channels(data)
+    n_chan, height, width = chans.shape
+    factor = max(1, max(height, width) // max_size)
+    rows, cols = height // factor, width // factor
+
+    out = np.empty((n_chan, rows, cols), dtype=np.float32)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN blocks
+        for c in range(n_chan):
+            for r0 in range(0, rows, _BAND_ROWS):
+                r1 = min(r0 + _BAND_ROWS, rows)
+                band = np.asarray(
+                    chans[c, r0 * factor:r1 * factor, :cols * factor], dtype=np.float32
+                )
+                if factor == 1:
+                    out[c, r0:r1] = band
+                else:
+                    out[c, r0:r1] = np.nanmean(
+                        band.reshape(r1 - r0, factor, cols, factor), axis=(1, 3)
+                    )
+    return out
+
+
+def stretch_limits(
+    data: np.ndarray,
+    percentiles=STRETCH_PERCENTILES,
+    n_samples: int = STRETCH_SAMPLES,
+):
+    """Estimate the stretch percentiles from a strided subsample of ``data``."""
+    flat = data.ravel()
+    sample = flat[::max(1, flat.size // n_samples)]
+    sample = sample[np.isfinite(sample)]
+    if not sample.size:
+        return 0.0, 0.0
+    vmin, vmax = np.percentile(sample, percentiles)
+    return float(vmin), float(vmax)
+
+
+def to_uint8(reduced: np.ndarray) -> np.ndarray:
+    """
+    Stretch a (C, h, w) float32 array to 0-255 in place and return it as an
+    (h, w, C) uint8 image.
+    """
+    vmin, vmax = stretch_limits(reduced)
+    if vmax > vmin:
+        reduced -= vmin
+        reduced *= 255.0 / (vmax - vmin)
+        np.clip(reduced, 0, 255, out=reduced)
+        np.nan_to_num(reduced, copy=False, nan=0.0)
+    else:
+        reduced[...] = 0
+    return np.ascontiguousarray(np.moveaxis(reduced.astype(np.uint8), 0, -1))
+
+
+def render_previews(data: np.ndarray, output_paths: Dict[int, Path]) -> Dict[int, Path]:
+    """
+    Write PNG previews of an in-memory image.
+
+    Args:
+        data: Stacked image, (H, W, 3), (3, H, W) or (H, W).
+        output_paths: Output path per maximum dimension in pixels, e.g. from
+            ``preview_paths()``.
+
+    Returns:
+        ``output_paths``.
+    """
+    if not output_paths:
+        return output_paths
+    pixels = to_uint8(block_reduce(data, max(output_paths)))
+    if pixels.shape[2] == 1:
+        base = Image.fromarray(pixels[..., 0]).convert("RGB")
+    else:
+        base = Image.fromarray(pixels)
+
+    w, h = base.size
+    for size, path in sorted(output_paths.items(), reverse=True):
+        img = base
+        scale = size / max(w, h)
+        if scale < 1:
+            img = base.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        img.save(path, "PNG")
+    return output_paths
+
+
+def generate_previews(
+    fits_path: Path,
+    output_paths: Optional[Dict[int, Path]] = None,
+) -> Dict[int, Path]:
+    """
+    Write PNG previews of a stacked FITS file (primary HDU = image data, or
+    the first extension of a tile-compressed stack).
+
+    Uncompressed files are memory-mapped, so only the rows being reduced are
+    read at a time. ``output_paths`` defaults to ``preview_paths(fits_path)``.
+    """
+    if output_paths is None:
+        output_paths = preview_paths(fits_path)
+    with fits.open(fits_path, memmap=True) as hdul:
+        data = image_hdu(hdul).data
+        if data is None:
+            raise ValueError(f"No image data in {fits_path}")
+        render_previews(data, output_paths)
+        del data
+    return output_paths
+
 
 def generate_thumbnail(
     fits_path: Path,
     output_path: Path,
-    max_size: int = 512,
+    max_size: int = THUMB_SIZE,
 ) -> Path:
     """
     Create a PNG thumbnail from a stacked RGB FITS file.
@@ -24,40 +191,4 @@ def generate_thumbnail(
     Returns:
         Path to the saved thumbnail.
     """
-    with fits.open(fits_path) as hdul:
-        data = hdul[0].data  # shape: (3, H, W) for RGB
-
-    if data is None:
-        raise ValueError(f"No data in primary HDU of {fits_path}")
-
-    # Handle different shapes
-    if data.ndim == 3 and data.shape[0] == 3:
-        # (3, H, W) -> (H, W, 3)
-        rgb = np.transpose(data, (1, 2, 0))
-    elif data.ndim == 3 and data.shape[2] == 3:
-        # Already (H, W, 3) — seestarpy outputs this format
-        rgb = data
-    elif data.ndim == 2:
-        # Grayscale -> fake RGB
-        rgb = np.stack([data, data, data], axis=-1)
-    else:
-        raise ValueError(f"Unexpected data shape: {data.shape}")
-
-    # Normalize to 0-255
-    vmin, vmax = np.percentile(rgb, [1, 99.5])
-    if vmax > vmin:
-        rgb = np.clip((rgb - vmin) / (vmax - vmin) * 255, 0, 255).astype(np.uint8)
-    else:
-        rgb = np.zeros_like(rgb, dtype=np.uint8)
-
-    img = Image.fromarray(rgb)
-
-    # Resize preserving aspect ratio
-    w, h = img.size
-    scale = max_size / max(w, h)
-    if scale < 1:
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    img.save(output_path, "PNG")
-    return output_path
+    return generate_previews(fits_path, {max_size: output_path})[max_size]
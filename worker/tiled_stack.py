@@ -0,0 +1,204 @@
+"""
+Bounded-memory sigma-clipped combine for disk mode (``STACK_COMBINE=tiled``).
+
+seestarpy combines a chunk from an N x H x W x 3 float cube in memory, which
+is what limits how many jobs a node can stack at once. Here frames are
+aligned one at a time (the streaming engine's ``iter_prepared``) and written
+to a memory-mapped cube in the job's work directory; the combine then reads
+it in bands of full-width rows, so each band is contiguous in every frame,
+and clips and averages each band with vectorized NumPy on a few threads
+(NumPy releases the GIL in sorts and reductions). Peak memory is set by
+``COMBINE_MEMORY_MB``, not by the number of frames.
+
+Clipping is per pixel, so the result does not depend on the band size or
+thread count: it is bit-for-bit the result of running ``combine_band()`` on
+the whole cube at once. The kept values per pixel are those
+``astropy.stats.sigma_clip`` keeps with ``cenfunc="median"``,
+``stdfunc="std"`` and ``maxiters=5``.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from . import config
+from .executor import physical_cores, stack_processes
+from .stacking_adapter import StackResult
+from .streaming_stack import iter_prepared, write_product
+
+logger = logging.getLogger(__name__)
+
+# Clipping iterations (stops earlier once nothing changes)
+MAX_ITERS = 5
+# Band working set per byte of input: the sorted band (float32) and two
+# float64 prefix sums
+_BAND_OVERHEAD = 5.5
+
+
+def combine_threads() -> int:
+    """Threads for the combine; ``auto`` shares the physical cores among stack processes."""
+    if config.COMBINE_THREADS != "auto":
+        return max(1, int(config.COMBINE_THREADS))
+    return max(1, physical_cores() // max(1, stack_processes()))
+
+
+def _take(a: np.ndarray, index: np.ndarray) -> np.ndarray:
+    return np.take_along_axis(a, index[None], axis=0)[0]
+
+
+def _range_median(ordered: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Median of ``ordered[lo:hi]`` per pixel (NaN where the range is empty)."""
+    n = hi - lo
+    below = _take(ordered, lo + np.maximum(n - 1, 0) // 2)
+    above = _take(ordered, np.minimum(lo + n // 2, np.maximum(hi - 1, lo)))
+    return np.where(n > 0, (below + above) / 2, np.nan)
+
+
+def clip_range(
+    ordered: np.ndarray, sigma: float, max_iters: int = MAX_ITERS,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Iterative sigma clipping along axis 0 of values sorted along that axis
+    (NaN = missing, sorted last): median centre, standard deviation about the
+    mean, like ``astropy.stats.sigma_clip``.
+
+    Clipping only ever removes the lowest and highest values, so what is kept
+    is a range ``ordered[lo:hi]`` per pixel; its mean and variance come from
+    prefix sums, and the data is sorted once instead of once per iteration.
+
+    Returns:
+        ``lo``, ``hi`` and the prefix sums of values and squares (float64,
+        one row longer than ``ordered``).
+    """
+    finite = np.nan_to_num(ordered, nan=0.0).astype(np.float64)
+    zero = np.zeros((1,) + ordered.shape[1:])
+    sums = np.concatenate([zero, np.cumsum(finite, axis=0)])
+    squares = np.concatenate([zero, np.cumsum(finite * finite, axis=0)])
+    del finite
+
+    lo = np.zeros(ordered.shape[1:], np.intp)
+    hi = (~np.isnan(ordered)).sum(axis=0)
+    for _ in range(max_iters):
+        n = hi - lo
+        if not n.any():
+            break
+        centre = _range_median(ordered, lo, hi)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (_take(sums, hi) - _take(sums, lo)) / n
+            var = (_take(squares, hi) - _take(squares, lo)) / n - mean * mean
+        bound = sigma * np.sqrt(np.maximum(var, 0))
+        with np.errstate(invalid="ignore"):
+            new_lo = np.maximum(lo, (ordered < centre - bound).sum(axis=0))
+            new_hi = np.minimum(hi, (ordered <= centre + bound).sum(axis=0))
+        new_hi = np.maximum(new_hi, new_lo)
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            break
+        lo, hi = new_lo, new_hi
+    return lo, hi, sums, squares
+
+
+def combine_band(values: np.ndarray, method: str, sigma: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clipped mean or median of an (N, rows, W, 3) band and its coverage count.
+    ``values`` is sorted in place.
+    """
+    count = (~np.isnan(values[..., :1])).sum(axis=0, dtype=np.uint16)
+    values.sort(axis=0)
+    lo, hi, sums, _ = clip_range(values, sigma)
+    n = hi - lo
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if method == "median":
+            image = _range_median(values, lo, hi)
+        else:
+            image = (_take(sums, hi) - _take(sums, lo)) / n
+    image = np.where(n > 0, image, 0).astype(np.float32)
+    return image, count
+
+
+def band_rows(shape: Tuple[int, ...], memory_bytes: int, threads: int) -> int:
+    """Rows per band so that ``threads`` bands fit in ``memory_bytes``."""
+    n, _, w, c = shape
+    per_row = n * w * c * 4 * _BAND_OVERHEAD
+    return max(1, int(memory_bytes // (threads * per_row)))
+
+
+def combine(
+    cube: np.ndarray,
+    method: str = "mean",
+    sigma: float = 3.0,
+    memory_bytes: Optional[int] = None,
+    threads: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sigma-clipped combine of an (N, H, W, 3) cube (typically memory-mapped),
+    band by band. Returns the (H, W, 3) image and the (H, W, 1) count of
+    frames covering each pixel.
+    """
+    if method not in ("mean", "median"):
+        raise ValueError(f"Unknown combine method {method!r}")
+    if memory_bytes is None:
+        memory_bytes = config.COMBINE_MEMORY_MB * 1024 * 1024
+    threads = threads or combine_threads()
+    _, h, w, c = cube.shape
+    rows = band_rows(cube.shape, memory_bytes, threads)
+    image = np.empty((h, w, c), np.float32)
+    count = np.empty((h, w, 1), np.uint16)
+
+    def run(start: int) -> None:
+        band = np.array(cube[:, start:start + rows])
+        image[start:start + rows], count[start:start + rows] = combine_band(band, method, sigma)
+
+    with ThreadPoolExecutor(max_workers=threads) as workers:
+        list(workers.map(run, range(0, h, rows)))
+    return image, count
+
+
+def stack_tiled(
+    fits_paths: List[Path],
+    output_path: Path,
+    method: str = "mean",
+    sigma_clip: float = 3.0,
+    align: str = "stars",
+) -> StackResult:
+    """
+    Align frames one at a time into a memory-mapped cube next to
+    ``output_path``, combine it band by band, and write the stack with its
+    previews. Frames are expected to be prescreened already.
+    """
+    cube_path = output_path.with_suffix(".aligned")
+    cube = None
+    headers = []
+    rejected = {}
+    n = 0
+    frames = ((p.name, p.read_bytes()) for p in fits_paths)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        for name, prepared in iter_prepared(frames, None, screen=False, phase=align == "phase"):
+            if prepared.error is not None:
+                logger.warning(f"{name}: {prepared.error}, skipping")
+                rejected[name] = prepared.error
+                continue
+            headers.append(prepared.header)
+            if cube is None:
+                cube = np.memmap(
+                    cube_path, dtype=np.float32, mode="w+",
+                    shape=(len(fits_paths), *prepared.frame.shape),
+                )
+            cube[n] = prepared.frame
+            n += 1
+        if n == 0:
+            raise ValueError("No frames could be aligned")
+        cube.flush()
+        image, count = combine(cube[:n], method, sigma_clip)
+    finally:
+        del cube
+        cube_path.unlink(missing_ok=True)
+
+    logger.info(f"Combined {n}/{len(fits_paths)} frames into {output_path.name} ({method}, tiled)")
+    return write_product(
+        output_path, image, count, headers,
+        n_frames_input=len(fits_paths), n_aligned=n, rejected=rejected,
+    )
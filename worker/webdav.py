@@ -1,55 +1,250 @@
 """
 WebDAV helpers for downloading/uploading/deleting files on u:cloud.
+
+All calls are coroutines sharing one pooled keep-alive client (see
+``sessions.py``). Remote collections known to exist are cached, so ``mkcol``
+only issues MKCOL requests for directories this process has not seen yet.
+
+Uploads are verified (remote size, via PROPFIND) and retried on transient
+errors; large files go through chunked, resumable uploads when configured
+(the Nextcloud protocol described in ``chunked_upload.py``, whose helpers
+are shared with the blocking uploader in ``upload.py``).
 """
 
+import asyncio
+import logging
+import threading
+import time
 from pathlib import Path
-from typing import List
-import requests
+from typing import Callable, Dict, List, Optional, Set
+
+import aiohttp
+
 from . import config
+from .chunked_upload import (
+    PROPFIND_BODY, RETRY_BACKOFF, UploadReport, check_remote, chunk_layout,
+    parse_propfind, resumable_chunks, sha1_file, transfer_id,
+)
+from .sessions import Client, chunking_session, webdav_session
+
+logger = logging.getLogger(__name__)
+
+_known_collections: Set[str] = set()
+_known_lock = threading.Lock()
+
+
+def _url(remote_path: str) -> str:
+    return f"{config.UCLOUD_WEBDAV_URL}/{remote_path.lstrip('/')}"
+
+
+def _forget_collections(remote_path: str) -> None:
+    """Drop cached collections on the way to ``remote_path`` (e.g. deleted remotely)."""
+    parts = [p for p in remote_path.split("/") if p]
+    prefixes = {"/" + "/".join(parts[:i]) for i in range(1, len(parts) + 1)}
+    with _known_lock:
+        _known_collections.difference_update(prefixes)
+
+
+async def _retrying(fn, retries: int, what: str):
+    """Await ``fn()``, retrying connection errors and 5xx/429 with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = e.status if isinstance(e, aiohttp.ClientResponseError) else None
+            if attempt >= retries or (status is not None and status < 500 and status != 429):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            attempt += 1
+            logger.warning(f"{what} failed ({e}), retry {attempt}/{retries} in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+
+async def _send(client: Client, method: str, url: str, ok=(), **kwargs) -> None:
+    """Send a request and raise for error statuses not in ``ok``."""
+    resp = await client.request(method, url, **kwargs)
+    async with resp:
+        if resp.status not in ok:
+            resp.raise_for_status()
+
+
+async def _propfind(client: Client, url: str, depth: int = 0) -> Dict[str, dict]:
+    resp = await client.request(
+        "PROPFIND", url, data=PROPFIND_BODY,
+        headers={"Depth": str(depth), "Content-Type": "application/xml"},
+    )
+    async with resp:
+        if resp.status == 404:
+            return {}
+        resp.raise_for_status()
+        return parse_propfind(await resp.read())
 
 
-def _auth():
-    return (config.UCLOUD_SHARE_TOKEN, "")
+async def _put_file(client: Client, url: str, local_path: Path, retries: int) -> UploadReport:
+    """Upload a file in a single streamed PUT, retrying transient failures."""
+    size = local_path.stat().st_size
+    start = time.monotonic()
 
+    async def put():
+        with open(local_path, "rb") as f:
+            await _send(client, "PUT", url, data=f, timeout=300)
 
-def download_file(remote_path: str, local_path: Path) -> None:
+    await _retrying(put, retries, f"PUT {local_path.name}")
+    check_remote(await _propfind(client, url), url, size)
+    return UploadReport(n_bytes=size, n_chunks=1, elapsed=time.monotonic() - start)
+
+
+async def _upload_chunked(
+    client: Client,
+    uploads_url: str,
+    destination_url: str,
+    local_path: Path,
+    chunk_size: int,
+    parallel: int,
+    retries: int,
+) -> UploadReport:
+    """Nextcloud chunked upload v2, resuming earlier attempts (see ``chunked_upload.upload_chunked``)."""
+    size = local_path.stat().st_size
+    chunk_size, n_chunks = chunk_layout(size, chunk_size)
+    sha1 = await asyncio.to_thread(sha1_file, local_path)
+    start = time.monotonic()
+
+    transfer_url = f"{uploads_url.rstrip('/')}/{transfer_id(destination_url, local_path)}"
+    headers = {"Destination": destination_url, "OC-Total-Length": str(size)}
+
+    # Find chunks left over from an earlier attempt
+    existing = await _propfind(client, transfer_url, depth=1)
+    if not existing:
+        await _retrying(
+            lambda: _send(client, "MKCOL", transfer_url, ok=(201, 405), headers=headers),
+            retries, f"MKCOL {transfer_url}",
+        )
+    done = resumable_chunks(existing, size, chunk_size, n_chunks)
+    slots = asyncio.Semaphore(max(1, parallel))
+
+    def read_chunk(index: int) -> bytes:
+        with open(local_path, "rb") as f:
+            f.seek(index * chunk_size)
+            return f.read(chunk_size)
+
+    async def put_chunk(index: int) -> None:
+        name = f"{index + 1:05d}"
+        if name in done:
+            return
+        async with slots:
+            data = await asyncio.to_thread(read_chunk, index)
+            await _retrying(
+                lambda: _send(client, "PUT", f"{transfer_url}/{name}", data=data,
+                              headers=headers, timeout=300),
+                retries, f"chunk {name} of {local_path.name}",
+            )
+
+    await asyncio.gather(*(put_chunk(i) for i in range(n_chunks)))
+
+    await _retrying(
+        lambda: _send(
+            client, "MOVE", f"{transfer_url}/.file",
+            headers={
+                **headers,
+                "OC-Checksum": f"SHA1:{sha1}",
+                "X-OC-Mtime": str(int(local_path.stat().st_mtime)),
+                "Overwrite": "T",
+            },
+            timeout=600,
+        ),
+        retries, f"MOVE {local_path.name}",
+    )
+    check_remote(await _propfind(client, destination_url), destination_url, size, sha1)
+
+    return UploadReport(
+        n_bytes=size,
+        n_chunks=n_chunks,
+        n_chunks_resumed=len(done),
+        elapsed=time.monotonic() - start,
+    )
+
+
+async def download_file(remote_path: str, local_path: Path) -> None:
     """Download a file from u:cloud to a local path."""
-    url = f"{config.UCLOUD_WEBDAV_URL}/{remote_path.lstrip('/')}"
     local_path.parent.mkdir(parents=True, exist_ok=True)
 
-    resp = requests.get(url, auth=_auth(), stream=True, timeout=300)
-    resp.raise_for_status()
+    resp = await webdav_session().request("GET", _url(remote_path), timeout=300)
+    async with resp:
+        resp.raise_for_status()
+        with open(local_path, "wb") as f:
+            async for chunk in resp.content.iter_chunked(65536):
+                f.write(chunk)
+
+
+async def fetch_file(
+    remote_path: str,
+    progress: Optional[Callable[[int], None]] = None,
+) -> bytes:
+    """Download a file from u:cloud into memory (``progress`` gets each chunk's size)."""
+    buf = bytearray()
+    resp = await webdav_session().request("GET", _url(remote_path), timeout=300)
+    async with resp:
+        resp.raise_for_status()
+        async for chunk in resp.content.iter_chunked(65536):
+            buf.extend(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    return bytes(buf)
 
-    with open(local_path, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=65536):
-            f.write(chunk)
 
+async def upload_file(local_path: Path, remote_path: str) -> UploadReport:
+    """
+    Upload a local file to u:cloud.
 
-def upload_file(local_path: Path, remote_path: str) -> None:
-    """Upload a local file to u:cloud."""
-    url = f"{config.UCLOUD_WEBDAV_URL}/{remote_path.lstrip('/')}"
-    with open(local_path, "rb") as f:
-        resp = requests.put(url, data=f, auth=_auth(), timeout=300)
-    resp.raise_for_status()
+    Files larger than ``UPLOAD_CHUNK_SIZE_MB`` are sent in parallel chunks when
+    ``UCLOUD_UPLOADS_URL`` is set; a failed chunked upload resumes from the
+    chunks already on the server when it is retried.
 
+    If the parent collection turns out to be missing (404/409, e.g. deleted on
+    u:cloud after it was cached), it is recreated and the upload retried once.
+    """
+    local_path = Path(local_path)
+    chunk_size = config.UPLOAD_CHUNK_SIZE_MB * 1024 * 1024
+    chunked = bool(config.UCLOUD_UPLOADS_URL) and local_path.stat().st_size > chunk_size
 
-def mkcol(remote_path: str) -> None:
+    for attempt in range(2):
+        try:
+            if chunked:
+                return await _upload_chunked(
+                    chunking_session(),
+                    config.UCLOUD_UPLOADS_URL,
+                    f"{config.UCLOUD_FILES_URL}/{remote_path.lstrip('/')}",
+                    local_path,
+                    chunk_size=chunk_size,
+                    parallel=config.UPLOAD_PARALLEL,
+                    retries=config.UPLOAD_RETRIES,
+                )
+            return await _put_file(webdav_session(), _url(remote_path), local_path,
+                                   retries=config.UPLOAD_RETRIES)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in (404, 409) or attempt > 0:
+                raise
+            parent = remote_path.rsplit("/", 1)[0]
+            _forget_collections(parent)
+            await mkcol(parent)
+
+
+async def mkcol(remote_path: str) -> None:
     """Create directory on u:cloud (recursive, ignores 'already exists')."""
     parts = [p for p in remote_path.split("/") if p]
     current = ""
     for part in parts:
         current += f"/{part}"
-        url = f"{config.UCLOUD_WEBDAV_URL}{current}"
-        resp = requests.request("MKCOL", url, auth=_auth(), timeout=30)
-        if resp.status_code not in (201, 405):
-            resp.raise_for_status()
+        if current in _known_collections:
+            continue
+        await _send(webdav_session(), "MKCOL", _url(current), ok=(201, 405))
+        with _known_lock:
+            _known_collections.add(current)
 
 
-def delete_files(remote_paths: List[str]) -> None:
+async def delete_files(remote_paths: List[str]) -> None:
     """Delete multiple files from u:cloud."""
     for path in remote_paths:
-        url = f"{config.UCLOUD_WEBDAV_URL}/{path.lstrip('/')}"
-        resp = requests.delete(url, auth=_auth(), timeout=30)
         # 204 = deleted, 404 = already gone — both OK
-        if resp.status_code not in (200, 204, 404):
-            resp.raise_for_status()
+        await _send(webdav_session(), "DELETE", _url(path), ok=(200, 204, 404))